@@ -0,0 +1,170 @@
+"""
+Microbenchmark for hook context allocation.
+
+Dispatches channel messages through ``Client._run_hooks`` to a typical set of
+command handlers, with a stub bot and client, and counts the hook contexts
+and memory blocks allocated per message. It compares the dispatcher as it
+was before (every handler gets a context, each with its own translation
+catalog) with the one we have now (handlers are picked out by the command
+index and filtered before a slotted context is built for them).
+
+Run with ``PYTHONPATH=. python bench/hookcontext.py`` from the repository
+root.
+"""
+
+import gettext
+import sys
+import tracemalloc
+
+from kochira.client import Client
+from kochira.dispatch import CommandIndex
+from kochira.service import Service, HookContext
+
+
+MESSAGES = [
+    "hello everyone, how's it going?",
+    "!quote rand",
+    "kochira: who is rfw?",
+    "lol",
+]
+
+PATTERNS = [
+    (r"!quote (?:add|del|read|info|rand|find) .+$", False),
+    (r"!seen (?P<who>\S+)$", False),
+    (r"!karma (?P<who>\S+)$", False),
+    (r"(?P<who>\S+)\+\+$", False),
+    (r"!w (?P<term>.+)$", False),
+    (r"!wa (?P<query>.+)$", False),
+    (r"!setgreet (?P<text>.+)$", False),
+    (r"!topic (?P<topic>.+)$", False),
+    (r"!pipe (?P<commands>.+)$", False),
+    (r"!map$", False),
+    (r"who(?: is|'s) (?P<who>\S+?)\??$", True),
+    (r"have you seen (?P<who>\S+)\??$", True),
+    (r"(?:list )?ignores$", True),
+    (r"rehash$", True),
+    (r"(?:remind|tell) (?P<whos>.+?) (?:about|to|that) (?P<message>.+)$", True),
+    (r"(?:list )?bad words$", True),
+    (r"last quote$", True),
+    (r"what is quote (?P<qid>\d+)\??$", True),
+] * 3
+
+
+class EagerHookContext:
+    """
+    The hook context as it was before: a full object with a translation
+    catalog built in the constructor.
+    """
+
+    def __init__(self, service, bot, client=None, target=None, origin=None):
+        self.service = service
+        self.bot = bot
+        self.client = client
+        self.target = target
+        self.origin = origin
+        self.t = gettext.NullTranslations()
+
+
+class _Enabled:
+    enabled = True
+
+
+class _Profiler:
+    def call(self, hook, ctx, *args, **kwargs):
+        return hook(ctx, *args, **kwargs)
+
+
+class StubBot:
+    """
+    Just enough of ``Bot`` for ``Client._run_hooks``.
+    """
+
+    def __init__(self, services, indexed):
+        self.profiler = _Profiler()
+        self.command_indexes = {}
+        self._hooks = {}
+
+        for service in services:
+            for name, hooks in service.hooks.items():
+                for _, _, hook in hooks:
+                    self._hooks.setdefault(name, []).append(hook)
+
+                    if indexed and getattr(hook, "command", None) is not None:
+                        self.command_indexes.setdefault(name, CommandIndex()).add(hook)
+
+    def get_hooks(self, name):
+        return self._hooks.get(name, ())
+
+    def has_hooks(self, name):
+        return bool(self.get_hooks(name))
+
+    def config_for(self, service, client, target):
+        return _Enabled
+
+
+def _make_service():
+    service = Service("bench", __doc__)
+
+    for i, (pattern, mention) in enumerate(PATTERNS):
+        @service.command(pattern, mention=mention, priority=i)
+        def handler(ctx, **kwargs):
+            pass
+
+    return service
+
+
+def _make_client(bot, context_factory):
+    contexts = []
+
+    def _factory(*args):
+        ctx = context_factory(*args)
+        contexts.append(ctx)
+        return ctx
+
+    # skip pydle's constructor: the hook runner doesn't need a connection
+    client = Client.__new__(Client)
+    client.bot = bot
+    client.nickname = "kochira"
+    client.context_factory = _factory
+
+    return client, contexts
+
+
+def _measure(client, contexts, rounds):
+    tracemalloc.start()
+    snapshot = tracemalloc.take_snapshot()
+
+    # keep everything alive so the snapshot sees every allocation
+    kept = []
+    for _ in range(rounds):
+        for message in MESSAGES:
+            kept.append(client._run_hooks("channel_message", "#channel", "someone",
+                                          ["#channel", "someone", message]))
+
+    stats = tracemalloc.take_snapshot().compare_to(snapshot, "filename")
+    tracemalloc.stop()
+
+    n = rounds * len(MESSAGES)
+    return len(contexts) / n, sum(stat.count_diff for stat in stats if stat.count_diff > 0) / n
+
+
+def main(rounds=1000):
+    service = _make_service()
+
+    results = [
+        ("before", _measure(*_make_client(StubBot([service], False), EagerHookContext),
+                            rounds=rounds)),
+        ("after", _measure(*_make_client(StubBot([service], True), HookContext),
+                           rounds=rounds))
+    ]
+
+    sys.stdout.write("{} command handlers, {} messages x {} rounds\n".format(
+        len(PATTERNS), len(MESSAGES), rounds))
+
+    for name, (contexts, blocks) in results:
+        sys.stdout.write("{:>6}: {:6.2f} contexts/message, {:8.2f} blocks/message\n".format(
+            name, contexts, blocks))
+
+
+if __name__ == "__main__":
+    main()
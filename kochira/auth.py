@@ -1,4 +1,5 @@
 import fnmatch
+import re
 
 
 def acl_for(client, target=None):
@@ -16,22 +17,87 @@ def acl_for(client, target=None):
     return acl
 
 
-CHECKERS = {
-    "a": lambda account, user: user.account == account,
-    None: lambda hostmask, user: fnmatch.fnmatch(user.hostmask, hostmask)
-}
+class CompiledACL:
+    """
+    An access control list compiled for fast lookups.
 
-def has_permission(client, user, permission, target=None):
-    for mask, permissions in acl_for(client, target).items():
-        if mask[0] == "$":
-            matcher = CHECKERS[mask[1]]
-            mask = mask[3:]
-        else:
-            matcher = CHECKERS[None]
+    Hostmasks are grouped by the permissions they grant, and each group is
+    compiled into a single regular expression. Account entries (``$a:``) are
+    looked up by hash. The effective permissions of each user are cached by
+    hostmask and account, so a user whose hostmask or account changes is
+    simply looked up again.
+    """
+
+    MAX_CACHED_USERS = 4096
+
+    def __init__(self, acl):
+        self.accounts = {}
+        hostmasks = {}
+
+        for mask, permissions in acl.items():
+            permissions = frozenset(permissions)
+
+            if mask[0] == "$":
+                if mask[1] == "a":
+                    self.accounts.setdefault(mask[3:], set([])).update(permissions)
+                continue
+
+            hostmasks.setdefault(permissions, []).append(mask)
+
+        self.hostmasks = [
+            (re.compile("|".join("(?:{})".format(fnmatch.translate(mask))
+                                 for mask in masks)), permissions)
+            for permissions, masks in hostmasks.items()
+        ]
+
+        self._users = {}
+
+    def permissions_for(self, user):
+        key = (user.hostmask, user.account)
+
+        if key not in self._users:
+            permissions = set(self.accounts.get(user.account, set([]))) \
+                if user.account is not None else set([])
+
+            for pat, mask_permissions in self.hostmasks:
+                if pat.match(user.hostmask) is not None:
+                    permissions.update(mask_permissions)
+
+            if len(self._users) >= self.MAX_CACHED_USERS:
+                self._users.clear()
 
-        if matcher(mask, user) and (permission in permissions or "admin" in permissions):
-            return True
-    return False
+            self._users[key] = frozenset(permissions)
+
+        return self._users[key]
+
+
+_compiled_acls = {}
+
+
+def compiled_acl_for(client, target=None):
+    """
+    Get the compiled ACL for a client and target. It is recompiled whenever
+    the client's configuration is replaced, e.g. by a rehash.
+    """
+
+    config = client.config
+
+    if target is not None and target not in config.channels:
+        target = None
+
+    key = (client.name, target)
+    cached = _compiled_acls.get(key)
+
+    if cached is None or cached[0] is not config:
+        cached = (config, CompiledACL(acl_for(client, target)))
+        _compiled_acls[key] = cached
+
+    return cached[1]
+
+
+def has_permission(client, user, permission, target=None):
+    permissions = compiled_acl_for(client, target).permissions_for(user)
+    return permission in permissions or "admin" in permissions
 
 
 def requires_permission(permission):
@@ -0,0 +1,323 @@
+"""
+Message backlogs.
+
+Each client remembers the most recent lines said in every channel and query
+it's in, so services can look back at what was said. Backlogs are fixed-size
+ring buffers: nicks are interned to integer ids and timestamps are kept as
+whole seconds, both in arrays, so a deep backlog costs little more than the
+text itself. They are written to the database when the bot shuts down and
+read back the first time each one is needed.
+"""
+
+import array
+import datetime
+import threading
+import time
+from collections import namedtuple
+
+import peewee
+
+from . import saferegex
+from .db import database, Model
+
+BacklogEntry = namedtuple("BacklogEntry", "who text ts")
+
+SAVE_CHUNK_SIZE = 100
+
+
+def _timestamp(t):
+    if isinstance(t, datetime.datetime):
+        return (t - datetime.datetime(1970, 1, 1)).total_seconds()
+    return t
+
+
+class BacklogLine(Model):
+    """
+    A backlog line kept across restarts.
+    """
+
+    client = peewee.CharField(255)
+    target = peewee.CharField(255)
+    who = peewee.CharField(255)
+    text = peewee.TextField()
+    ts = peewee.IntegerField()
+
+    class Meta:
+        indexes = (
+            (("client", "target"), False),
+        )
+
+
+class Nicks:
+    """
+    Interns nicks as small integers, so each one is only stored once.
+
+    Every ``intern`` has to be matched by a ``release`` once the id is no
+    longer used. Nicks nobody uses any more are forgotten and their ids are
+    handed out again, so the table only ever holds nicks still in a backlog.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+
+        self._refs = array.array("I")
+        self._free = []
+        self._lock = threading.Lock()
+
+    def intern(self, nick):
+        with self._lock:
+            id = self.ids.get(nick)
+
+            if id is None:
+                if self._free:
+                    id = self._free.pop()
+                    self.names[id] = nick
+                else:
+                    id = len(self.names)
+                    self.names.append(nick)
+                    self._refs.append(0)
+
+                self.ids[nick] = id
+
+            self._refs[id] += 1
+            return id
+
+    def release(self, id):
+        with self._lock:
+            self._refs[id] -= 1
+
+            if not self._refs[id]:
+                del self.ids[self.names[id]]
+                self.names[id] = None
+                self._free.append(id)
+
+
+class Backlog:
+    """
+    The most recent lines said in one place, newest first.
+
+    Indexing and iteration give ``BacklogEntry`` tuples, with ``ts`` as a UTC
+    ``datetime``. Lines can be appended from the event loop while they're
+    being read from an executor thread: reads work on a snapshot taken when
+    they start.
+    """
+
+    def __init__(self, nicks, size):
+        self.nicks = nicks
+        self.size = size
+        self.count = 0
+
+        self._who = array.array("I", [0]) * size
+        self._ts = array.array("q", [0]) * size
+        self._text = [None] * size
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def append(self, who, text, ts=None):
+        if ts is None:
+            ts = time.time()
+
+        with self._lock:
+            i = self.count % self.size
+
+            who = self.nicks.intern(who)
+
+            if self.count >= self.size:
+                self.nicks.release(self._who[i])
+
+            self._who[i] = who
+            self._ts[i] = int(ts)
+            self._text[i] = text
+            self.count += 1
+
+    def resize(self, size):
+        """
+        Change how many lines are kept, keeping as many of the newest lines as
+        will fit.
+        """
+        lines = list(self._lines())[:size]
+        lines.reverse()
+
+        with self._lock:
+            for i in range(min(self.count, self.size)):
+                self.nicks.release(self._who[i])
+
+            self.size = size
+            self.count = 0
+            self._who = array.array("I", [0]) * size
+            self._ts = array.array("q", [0]) * size
+            self._text = [None] * size
+
+        for who, text, ts in lines:
+            self.append(who, text, ts)
+
+    def _entry(self, who, text, ts):
+        return BacklogEntry(who, text, datetime.datetime.utcfromtimestamp(ts))
+
+    def _lines(self):
+        # ids can be handed out again once the lock is let go of, so look up
+        # the nicks while it's held
+        with self._lock:
+            count = self.count
+            size = self.size
+            who = [self.nicks.names[id] for id in self._who[:min(count, size)]]
+            ts = self._ts[:]
+            text = self._text[:]
+
+        for n in range(count - 1, max(count - size, 0) - 1, -1):
+            i = n % size
+            yield who[i], text[i], ts[i]
+
+    def __getitem__(self, n):
+        if n < 0:
+            n += len(self)
+
+        with self._lock:
+            if not 0 <= n < min(self.count, self.size):
+                raise IndexError("backlog index out of range")
+
+            i = (self.count - 1 - n) % self.size
+            return self._entry(self.nicks.names[self._who[i]], self._text[i],
+                               self._ts[i])
+
+    def __iter__(self):
+        for line in self._lines():
+            yield self._entry(*line)
+
+    def find(self, who=None, pattern=None, since=None, until=None, skip=0):
+        """
+        Find lines, newest first, optionally only those said by ``who``,
+        matching the regular expression ``pattern``, or said between ``since``
+        and ``until`` (UTC ``datetime`` objects or UNIX timestamps). The newest
+        ``skip`` lines aren't searched.
+        """
+        if who is not None and who not in self.nicks.ids:
+            return
+
+        if isinstance(pattern, str):
+            pattern = saferegex.compile(pattern)
+
+        since = _timestamp(since)
+        until = _timestamp(until)
+
+        for n, (line_who, text, ts) in enumerate(self._lines()):
+            if n < skip:
+                continue
+
+            if since is not None and ts < since:
+                break
+
+            if until is not None and ts > until:
+                continue
+
+            if who is not None and line_who != who:
+                continue
+
+            if pattern is not None and pattern.search(text) is None:
+                continue
+
+            yield self._entry(line_who, text, ts)
+
+    def by_nick(self, who, skip=0):
+        return self.find(who=who, skip=skip)
+
+    def matching(self, pattern, skip=0):
+        return self.find(pattern=pattern, skip=skip)
+
+    def between(self, since, until=None, skip=0):
+        return self.find(since=since, until=until, skip=skip)
+
+    def latest(self, n, skip=0):
+        """
+        Get the newest ``n`` lines, after skipping the newest ``skip``.
+        """
+        lines = []
+
+        for i, line in enumerate(self._lines()):
+            if i >= skip + n:
+                break
+
+            if i >= skip:
+                lines.append(self._entry(*line))
+
+        return lines
+
+
+class Backlogs:
+    """
+    All of a client's backlogs, by target.
+
+    Looking up a target that has no backlog yet reads back whatever was saved
+    for it when the bot last shut down.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.nicks = Nicks()
+        self._backlogs = {}
+
+    @property
+    def size(self):
+        return self.client.bot.config.core.max_backlog
+
+    def _key(self, target):
+        return self.client.normalize(target)
+
+    def __contains__(self, target):
+        return self._key(target) in self._backlogs
+
+    def __iter__(self):
+        return iter(self._backlogs)
+
+    def __getitem__(self, target):
+        key = self._key(target)
+        backlog = self._backlogs.get(key)
+
+        if backlog is None:
+            backlog = self._backlogs[key] = Backlog(self.nicks, self.size)
+            self._load(key, backlog)
+
+        return backlog
+
+    def add(self, target, who, text):
+        backlog = self[target]
+
+        if backlog.size != self.size:
+            backlog.resize(self.size)
+
+        backlog.append(who, text)
+
+    def _load(self, key, backlog):
+        q = BacklogLine.select() \
+            .where(BacklogLine.client == self.client.name,
+                   BacklogLine.target == key) \
+            .order_by(BacklogLine.ts.desc(), BacklogLine.id.desc()) \
+            .limit(backlog.size)
+
+        for line in reversed(list(q)):
+            backlog.append(line.who, line.text, line.ts)
+
+    def save(self):
+        """
+        Write every backlog to the database, replacing what was saved before.
+        """
+        with database.transaction():
+            for key, backlog in self._backlogs.items():
+                BacklogLine.delete() \
+                    .where(BacklogLine.client == self.client.name,
+                           BacklogLine.target == key) \
+                    .execute()
+
+                rows = [{
+                    "client": self.client.name,
+                    "target": key,
+                    "who": who,
+                    "text": text,
+                    "ts": ts
+                } for who, text, ts in reversed(list(backlog._lines()))]
+
+                for i in range(0, len(rows), SAVE_CHUNK_SIZE):
+                    BacklogLine.insert_many(rows[i:i + SAVE_CHUNK_SIZE]).execute()
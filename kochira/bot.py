@@ -8,16 +8,18 @@ import locale
 import heapq
 import logging
 import multiprocessing
-from playhouse.sqlite_ext import SqliteExtDatabase
 import signal
 import yaml
 
 from pydle.async import EventLoop, coroutine
 
-from . import config
+from . import config, saferegex
+from .backlog import BacklogLine
 from .client import Client
-from .db import database
-from .scheduler import Scheduler
+from .db import database, Database
+from .dispatch import CommandIndex
+from .profiler import Profiler
+from .scheduler import Scheduler, Job
 from .util import Expando
 from .service import Service, BoundService, HookContext, Config as ServiceConfig
 from .userdata import UserDataKVPair
@@ -104,8 +106,15 @@ def _config_class_factory(bot):
                 acl = config.Field(doc="Mapping of per-channel access control lists.", type=config.Mapping(config.Many(str, is_set=True)))
                 locale = config.Field(doc="Per-channel locale.", default=None)
 
+            class Flood(config.Config):
+                burst = config.Field(doc="Number of messages that can be sent at once.", default=5)
+                rate = config.Field(doc="Number of messages per second that can be sent after a burst.", default=0.5)
+                penalty_bytes = config.Field(doc="If set, a message costs one more message for every this many bytes in it.", default=0)
+                max_age = config.Field(doc="Drop messages and notices that have been waiting this many seconds to be sent.", default=30)
+
             tls = config.Field(doc="TLS settings.", type=TLS, default=TLS())
             sasl = config.Field(doc="SASL settings.", type=SASL, default=SASL())
+            flood = config.Field(doc="Flood control settings.", type=Flood, default=Flood())
 
             channels = config.Field(doc="Mapping of channel settings.", type=config.Mapping(Channel))
             services = config.Field(doc="Mapping of per-client service settings.", type=service_config_loader)
@@ -114,7 +123,12 @@ def _config_class_factory(bot):
 
         class Core(config.Config):
             database = config.Field(doc="Database file to use", default="kochira.db")
-            max_backlog = config.Field(doc="Maximum backlog lines to store.", default=10)
+            database_journal_mode = config.Field(doc="SQLite journal mode.", default="wal")
+            database_synchronous = config.Field(doc="SQLite synchronous setting.", default="normal")
+            database_busy_timeout = config.Field(doc="Time, in milliseconds, to wait for a locked database.", default=5000)
+            database_cache_size = config.Field(doc="SQLite page cache size. Negative values are in KiB.", default=-8192)
+            database_mmap_size = config.Field(doc="Maximum bytes of the database to memory-map.", default=0)
+            max_backlog = config.Field(doc="Maximum backlog lines to store per channel.", default=1000)
             max_workers = config.Field(doc="Max thread pool workers.", default=0)
             version = config.Field(doc="CTCP VERSION reply.", default="kochira IRC bot")
             locale_path = config.Field(doc="Path to locales.", default="/usr/share/locale")
@@ -135,7 +149,11 @@ class Bot:
     def __init__(self, config_file="config.yml"):
         self.services = {}
         self.clients = {}
+        self.command_indexes = {}
+        self._hook_tables = {}
+        self._config_cache = {}
         self.event_loop = EventLoop()
+        self.profiler = Profiler(self)
 
         self.config_class = _config_class_factory(self)
         self.config_file = config_file
@@ -148,6 +166,7 @@ class Bot:
     def run(self):
         self.executor = ThreadPoolExecutor(self.config.core.max_workers or multiprocessing.cpu_count())
         self.scheduler = Scheduler(self)
+        self.profiler.start()
 
         signal.signal(signal.SIGHUP, self._handle_sighup)
 
@@ -161,9 +180,17 @@ class Bot:
 
     def stop(self):
         self.stopping = True
+        self.profiler.stop()
         self.event_loop.stop()
         for service in list(self.services.keys()):
             self.unload_service(service)
+        for client in list(self.clients.values()):
+            try:
+                client.backlogs.save()
+            except:
+                logger.exception("Could not save backlogs for %s", client.name)
+        database.close_writer()
+        saferegex.shutdown()
 
     def connect(self, name):
         client = Client.from_config(self, name,
@@ -181,10 +208,19 @@ class Bot:
         del self.clients[name]
 
     def _connect_to_db(self):
-        db_name = self.config.core.database
-        database.initialize(SqliteExtDatabase(db_name, check_same_thread=False))
+        core = self.config.core
+        db_name = core.database
+        database.initialize(Database(db_name, pragmas=[
+            ("journal_mode", core.database_journal_mode),
+            ("synchronous", core.database_synchronous),
+            ("busy_timeout", core.database_busy_timeout),
+            ("cache_size", core.database_cache_size),
+            ("mmap_size", core.database_mmap_size)
+        ]))
         logger.info("Opened database connection: %s", db_name)
         UserDataKVPair.create_table(True)
+        Job.create_table(True)
+        BacklogLine.create_table(True)
 
     def _connect_to_irc(self):
         for name, config in self.config.clients.items():
@@ -237,6 +273,7 @@ class Bot:
         if name in self.services:
             service = self.services[name].service
             service.run_shutdown(self)
+            self._unregister_service(service)
 
         # we create an expando storage first for bots to load any locals they
         # need
@@ -259,8 +296,11 @@ class Bot:
             logger.exception("Couldn't load service %s", name)
             if service is not None:
                 del self.services[service.name]
+            self._hook_tables.clear()
             raise
 
+        self._register_service(service)
+
         logger.info("Loaded service %s", name)
 
     def unload_service(self, name):
@@ -281,15 +321,49 @@ class Bot:
             logger.exception("Couldn't unload service %s", name)
             raise
 
+        self._unregister_service(service)
+
+    def _register_service(self, service):
+        self._hook_tables.clear()
+        self._config_cache.clear()
+
+        for name, hooks in service.hooks.items():
+            for _, _, hook in hooks:
+                if getattr(hook, "command", None) is not None:
+                    self.command_indexes.setdefault(name, CommandIndex()).add(hook)
+
+    def _unregister_service(self, service):
+        self._hook_tables.clear()
+        self._config_cache.clear()
+
+        for name, hooks in service.hooks.items():
+            for _, _, hook in hooks:
+                if getattr(hook, "command", None) is not None and \
+                    name in self.command_indexes:
+                    self.command_indexes[name].remove(hook)
+
     def get_hooks(self, hook):
         """
-        Create an ordering of hooks to run.
+        Get the ordering of hooks to run.
+
+        Orderings are computed once per hook name and kept until a service is
+        loaded or unloaded.
         """
 
-        return (hook for _, _, hook in heapq.merge(*[
-            bound.service.hooks.get(hook, [])
-            for bound in list(self.services.values())
-        ]))
+        if hook not in self._hook_tables:
+            self._hook_tables[hook] = tuple(hook for _, _, hook in heapq.merge(*[
+                bound.service.hooks.get(hook, [])
+                for bound in list(self.services.values())
+            ]))
+
+        return self._hook_tables[hook]
+
+    def has_hooks(self, hook):
+        """
+        Check if any loaded service has a hook registered for the given name.
+        """
+
+        return bool(self.get_hooks(hook))
 
     def run_hooks(self, hook, *args, **kwargs):
         """
@@ -300,13 +374,44 @@ class Bot:
             ctx = HookContext(hook.service, self)
 
             try:
-                r = hook(ctx, *args, **kwargs)
+                r = self.profiler.call(hook, ctx, *args, **kwargs)
 
                 if r is Service.EAT:
                     return Service.EAT
             except BaseException:
                 logger.exception("Hook processing failed")
 
+    def config_for(self, service, client=None, target=None):
+        """
+        Get the resolved configuration of a service for a client and target.
+
+        The global, per-client and per-channel settings are combined once and
+        the frozen result is kept until the configuration is rehashed.
+        """
+
+        client_name = client.name if client is not None else None
+
+        if client is not None and target is not None and \
+            target not in self.config.clients[client_name].channels:
+            target = None
+
+        key = (service.name, client_name, target)
+
+        if key not in self._config_cache:
+            config = self.config.services.get(service.name, service.config_factory())
+
+            if client is not None:
+                client_config = self.config.clients[client_name]
+                config = config.combine(client_config.services.get(service.name, service.config_factory()))
+
+                if target is not None:
+                    channel_config = client_config.channels[target]
+                    config = config.combine(channel_config.services.get(service.name, service.config_factory()))
+
+            self._config_cache[key] = config.freeze()
+
+        return self._config_cache[key]
+
     def rehash(self):
         """
         Reload configuration information.
@@ -315,6 +420,8 @@ class Bot:
         with open(self.config_file, "r") as f:
             self.config = self.config_class(yaml.load(f))
 
+        self._config_cache.clear()
+
     def _handle_sighup(self, signum, frame):
         logger.info("Received SIGHUP; running SIGHUP hooks and rehashing")
 
@@ -1,21 +1,28 @@
-import datetime
 import logging
-from collections import deque, namedtuple
 import textwrap
 
 from pydle import Client as _Client
 from pydle.async import Future, coroutine
 from pydle.features.rfc1459.protocol import MESSAGE_LENGTH_LIMIT
 
+from . import metrics
+from .backlog import Backlogs
+from .outbound import OutboundQueue
 from .service import Service, HookContext
+from .userdata import IdentityCache
 
 logger = logging.getLogger(__name__)
 
-BacklogEntry = namedtuple("BacklogEntry", "who text ts")
+
+MESSAGES_RECEIVED = metrics.counter("kochira_irc_messages_received_total",
+                                    "IRC messages received.", ["client"])
+MESSAGES_SENT = metrics.counter("kochira_irc_messages_sent_total",
+                                "IRC messages sent.", ["client"])
 
 
 class Client(_Client):
     RECONNECT_MAX_ATTEMPTS = None
+    NICKSERV = "NickServ"
     context_factory = HookContext
 
     def __init__(self, bot, name, *args, **kwargs):
@@ -24,7 +31,9 @@ class Client(_Client):
         self._reconnect_timeout = None
         self._fd = None
 
-        self.backlogs = {}
+        self.backlogs = Backlogs(self)
+        self.identities = IdentityCache()
+        self.outbound = OutboundQueue(self, self._flush_message)
         self.bot = bot
 
         self.name = name
@@ -72,11 +81,26 @@ class Client(_Client):
             self.on_disconnect(False)
 
     def on_disconnect(self, expected):
+        # anything still waiting was meant for the connection we just lost
+        self.outbound.clear()
+
+        # we can't see who takes whose nickname while we're gone
+        self.identities.clear()
+
         super().on_disconnect(expected)
         self._run_hooks("disconnect", None, None, [expected])
 
     def _send_message(self, message):
-        self.bot.defer_from_thread(super()._send_message, message)
+        self.bot.defer_from_thread(self.outbound.put, message,
+                                   self.outbound.current_response())
+
+    def _flush_message(self, message):
+        MESSAGES_SENT.labels(client=self.name).inc()
+        super()._send_message(message)
+
+    def on_raw(self, message):
+        MESSAGES_RECEIVED.labels(client=self.name).inc()
+        super().on_raw(message)
 
     def on_ctcp_version(self, by, what, contents):
         self.ctcp_reply(by, "VERSION", self.bot.config.core.version)
@@ -90,6 +114,8 @@ class Client(_Client):
         for name, channel in self.bot.config.clients[self.name].channels.items():
             self.join(name, password=channel.password)
 
+        self.bot.scheduler.connected()
+
     def _autotruncate(self, command, target, message, suffix="..."):
         hostmask = self._format_user_mask(self.nickname)
         chunklen = MESSAGE_LENGTH_LIMIT - len("{hostmask} {command} {target} :".format(
@@ -104,24 +130,32 @@ class Client(_Client):
 
         return message
 
-    def message(self, target, message):
+    def message(self, target, message, response=None):
         message = self._autotruncate("PRIVMSG", target, message)
 
         @self.bot.defer_from_thread
         def _callback():
-            super(Client, self).message(target, message)
+            with self.outbound.response(response):
+                super(Client, self).message(target, message)
             self._add_to_backlog(target, self.nickname, message)
             self._run_hooks("own_message", target, self.nickname, [target, message])
 
-    def notice(self, target, message):
+    def notice(self, target, message, response=None):
         message = self._autotruncate("PRIVMSG", target, message)
 
         @self.bot.defer_from_thread
         def _callback():
-            super(Client, self).notice(target, message)
+            with self.outbound.response(response):
+                super(Client, self).notice(target, message)
             self._run_hooks("own_notice", target, self.nickname, [target, message])
 
     def _run_hooks(self, name, target, origin, args=None, kwargs=None):
+        if not self.bot.has_hooks(name):
+            # nothing is listening, so don't bother spinning up a coroutine
+            fut = Future()
+            fut.set_result(None)
+            return fut
+
         @coroutine
         def _coro():
             nonlocal args, kwargs
@@ -132,14 +166,31 @@ class Client(_Client):
             if kwargs is None:
                 kwargs = {}
 
+            # only run the command handlers that could match the message
+            command_index = self.bot.command_indexes.get(name)
+
+            if command_index is not None:
+                candidates = command_index.candidates(args[-1], self.nickname,
+                                                      origin == target)
+
             for hook in self.bot.get_hooks(name):
-                ctx = self.context_factory(hook.service, self.bot, self, target, origin)
+                if command_index is not None and \
+                    getattr(hook, "command", None) is not None and \
+                    hook not in candidates:
+                    continue
 
-                if not ctx.config.enabled:
+                # filter out as much as we can before building a context
+                if not self.bot.config_for(hook.service, self, target).enabled:
                     continue
 
+                guard = getattr(hook, "guard", None)
+
                 try:
-                    r = hook(ctx, *args, **kwargs)
+                    if guard is not None and not guard(self, target, origin):
+                        continue
+
+                    ctx = self.context_factory(hook.service, self.bot, self, target, origin)
+                    r = self.bot.profiler.call(hook, ctx, *args, **kwargs)
 
                     if isinstance(r, Future):
                         r = yield r
@@ -161,11 +212,7 @@ class Client(_Client):
         return fut
 
     def _add_to_backlog(self, target, by, message):
-        backlog = self.backlogs.setdefault(target, deque([]))
-        backlog.appendleft(BacklogEntry(by, message, datetime.datetime.utcnow()))
-
-        while len(backlog) > self.bot.config.core.max_backlog:
-            backlog.pop()
+        self.backlogs.add(target, by, message)
 
     def on_invite(self, channel, by):
         self._run_hooks("invite", by.name, by.name, [channel.name, by.name])
@@ -174,9 +221,11 @@ class Client(_Client):
         self._run_hooks("join", channel.name, user.name, [channel.name, user.name])
 
     def on_kill(self, target, by, reason):
+        self.identities.invalidate(self.normalize(target.name))
         self._run_hooks("kill", by.name, by.name, [target.name, by.name, reason])
 
     def on_kick(self, channel, target, by, reason=None):
+        self._forget_identities(channel.name, target.name)
         self._run_hooks("kick", channel.name, by.name, [channel.name, target.name, by.name, reason])
 
     def on_mode_change(self, channel, modes, by):
@@ -194,21 +243,28 @@ class Client(_Client):
         self._run_hooks("private_message", by.name, by.name, [by.name, message])
 
     def on_nick_change(self, old, new):
+        self.identities.invalidate(self.normalize(old.name))
+        self.identities.invalidate(self.normalize(new))
         self._run_hooks("nick_change", new, new, [old.name, new])
 
     def on_channel_notice(self, target, by, message):
         self._run_hooks("channel_notice", target.name, by.name, [target.name, by.name, message])
 
     def on_private_notice(self, by, message):
+        if self.normalize(by.name) == self.normalize(self.NICKSERV):
+            self._forget_mentioned_identities(message)
+
         self._run_hooks("private_notice", by.name, by.name, [by.name, message])
 
     def on_part(self, channel, user, message=None):
+        self._forget_identities(channel.name, user.name)
         self._run_hooks("part", channel.name, user.name, [channel.name, user.name, message])
 
     def on_topic_change(self, channel, message, by):
         self._run_hooks("topic_change", channel.name, by.name, [channel.name, message, by.name])
 
     def on_quit(self, user, message=None):
+        self.identities.invalidate(self.normalize(user.name))
         self._run_hooks("quit", user.name, user.name, [user.name, message])
 
     def on_ctcp(self, by, target, what, contents):
@@ -217,6 +273,52 @@ class Client(_Client):
     def on_ctcp_action(self, by, what, contents):
         self._run_hooks("ctcp_action", by.name, by.name, [by.name, what, contents])
 
+    def _shares_channel(self, nickname, excluding=None):
+        return any(nickname in info.users
+                   for name, info in self.channels.items()
+                   if name != excluding)
+
+    def _forget_identities(self, channel, nickname):
+        """
+        Someone left a channel. If that was us, forget everyone we no longer
+        share a channel with, otherwise just them if we share none.
+        """
+        if self.normalize(nickname) == self.normalize(self.nickname):
+            for nick in self.identities:
+                if not self._shares_channel(nick, channel):
+                    self.identities.invalidate(nick)
+        elif not self._shares_channel(nickname, channel):
+            self.identities.invalidate(self.normalize(nickname))
+
+    def _forget_mentioned_identities(self, message):
+        """
+        NickServ told us about a change, e.g. a ghost, release or logout, so
+        forget whoever it mentions, and ourselves.
+        """
+        self.identities.invalidate(self.normalize(self.nickname))
+
+        for word in message.split():
+            self.identities.invalidate(self.normalize(word.strip("\x02\x1f\"'.,:;!?()[]")))
+
+    def on_raw_account(self, message):
+        """ account-notify: a user logged in or out. """
+        handler = getattr(super(), "on_raw_account", None)
+        if handler is not None:
+            handler(message)
+
+        nickname, _ = self._parse_user(message.source)
+        account = message.params[0]
+        self.identities.update(self.normalize(nickname), account if account != "*" else None)
+
+    def on_raw_join(self, message):
+        super().on_raw_join(message)
+
+        # extended-join tells us the account of whoever joined
+        if len(message.params) == 3:
+            nickname, _ = self._parse_user(message.source)
+            account = message.params[1]
+            self.identities.update(self.normalize(nickname), account if account != "*" else None)
+
     # hacks:
 
     def on_raw_004(self, message):
@@ -1,10 +1,24 @@
 import abc
 import collections
+import types
 
 def _id(x):
     return x
 
 
+def _freeze(v):
+    # dicts pass for Configs with isinstance, so check for them first
+    if isinstance(v, dict):
+        return types.MappingProxyType({k: _freeze(x) for k, x in v.items()})
+    elif isinstance(v, Config):
+        return v.freeze()
+    elif isinstance(v, (list, tuple)):
+        return tuple(_freeze(x) for x in v)
+    elif isinstance(v, set):
+        return frozenset(_freeze(x) for x in v)
+    return v
+
+
 class Field:
     _sentinel = object()
     _total_creation_order = 0
@@ -23,17 +37,26 @@ class Field:
         if obj is None:
             return self
 
-        v = obj._fields.get(self.name, self.default)
+        try:
+            return obj._fields[self.name]
+        except KeyError:
+            pass
+
+        v = self.default
 
         if v is Field._sentinel:
             if hasattr(self.type, "get_default"):
-                return self.type.get_default()
-
-            raise AttributeError(self.name)
+                v = self.type.get_default()
+            else:
+                raise AttributeError(self.name)
 
-        return v
+        # defaults are shared, so don't hand out a mutable one from a frozen
+        # configuration
+        return _freeze(v) if obj._frozen else v
 
     def __set__(self, obj, v):
+        if obj._frozen:
+            raise TypeError("configuration is frozen")
         obj._fields[self.name] = v
 
 
@@ -60,6 +83,8 @@ class ConfigMeta(abc.ABCMeta):
 
 
 class Config(collections.MutableMapping, metaclass=ConfigMeta):
+    _frozen = False
+
     def __init__(self, values=None):
         if values is None:
             values = {}
@@ -115,6 +140,18 @@ class Config(collections.MutableMapping, metaclass=ConfigMeta):
 
         return self.__class__(fields)
 
+    def freeze(self):
+        """
+        Get an immutable copy of this configuration. Nested configurations are
+        frozen too, and dicts, lists and sets are turned into their read-only
+        counterparts.
+        """
+
+        frozen = self.__class__.__new__(self.__class__)
+        frozen._fields = {k: _freeze(v) for k, v in self._fields.items()}
+        frozen._frozen = True
+        return frozen
+
     @classmethod
     def interior_type(cls):
         return cls
@@ -123,9 +160,13 @@ class Config(collections.MutableMapping, metaclass=ConfigMeta):
         return self._fields[name]
 
     def __setitem__(self, name, value):
+        if self._frozen:
+            raise TypeError("configuration is frozen")
         self._fields[name] = value
 
     def __delitem__(self, name):
+        if self._frozen:
+            raise TypeError("configuration is frozen")
         raise TypeError("does not support item deletion")
 
     def __iter__(self):
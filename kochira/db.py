@@ -1,9 +1,55 @@
-import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from peewee import Proxy, Model, SqliteDatabase
+from playhouse.sqlite_ext import SqliteExtDatabase
+
+from . import metrics
 
 database = Proxy()
 
+QUERY_SECONDS = metrics.histogram("kochira_db_query_seconds",
+                                  "Time taken by database queries.")
+
+
+class Database(SqliteExtDatabase):
+    """
+    A SQLite database with one connection per thread.
+
+    Every new connection has the given pragmas applied, so WAL mode lets
+    readers on executor threads run alongside writes from the event loop.
+    Writes that don't need to happen inline can be handed to ``submit_write``,
+    which runs them one at a time on a dedicated writer thread.
+    """
+
+    def __init__(self, database, pragmas=(), **kwargs):
+        super().__init__(database, threadlocals=True, **kwargs)
+        self.connection_pragmas = list(pragmas)
+        self.writer = ThreadPoolExecutor(1)
+
+    def _connect(self, database, **kwargs):
+        conn = super()._connect(database, **kwargs)
+
+        for pragma, value in self.connection_pragmas:
+            conn.execute("PRAGMA {} = {}".format(pragma, value))
+
+        return conn
+
+    def execute_sql(self, *args, **kwargs):
+        with QUERY_SECONDS.time():
+            return super().execute_sql(*args, **kwargs)
+
+    def submit_write(self, fn, *args, **kwargs):
+        """
+        Run a write on the writer thread, returning a future for its result.
+        """
+        return self.writer.submit(fn, *args, **kwargs)
+
+    def close_writer(self):
+        """
+        Wait for pending writes to finish and stop the writer thread.
+        """
+        self.writer.shutdown(wait=True)
+
 
 class Model(Model):
     class Meta:
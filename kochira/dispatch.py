@@ -0,0 +1,120 @@
+import re
+import sre_constants
+import sre_parse
+
+
+def literal_prefix(pattern, flags=0):
+    """
+    Find the literal prefix that any string matched by ``pattern`` must start
+    with. The prefix is lowercased, so it may be compared against lowercased
+    messages regardless of ``re.I``.
+    """
+
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except (sre_constants.error, TypeError):
+        return ""
+
+    prefix = []
+
+    for op, av in parsed:
+        if op is not sre_constants.LITERAL:
+            break
+        prefix.append(chr(av))
+
+    return "".join(prefix).lower()
+
+
+class _Trie:
+    def __init__(self):
+        self.root = {}
+
+    def add(self, key, value):
+        node = self.root
+        for c in key:
+            node = node.setdefault(c, {})
+        node.setdefault(None, set([])).add(value)
+
+    def remove(self, key, value):
+        path = []
+        node = self.root
+
+        for c in key:
+            if c not in node:
+                return
+            path.append((node, c))
+            node = node[c]
+
+        values = node.get(None, set([]))
+        values.discard(value)
+        if not values:
+            node.pop(None, None)
+
+        # prune any branches we've left empty
+        for parent, c in reversed(path):
+            if parent[c]:
+                break
+            del parent[c]
+
+    def walk(self, s):
+        """
+        Collect the values of every key that is a prefix of ``s``.
+        """
+        node = self.root
+        found = set(node.get(None, ()))
+
+        for c in s:
+            node = node.get(c)
+            if node is None:
+                break
+            found.update(node.get(None, ()))
+
+        return found
+
+
+class CommandIndex:
+    """
+    An index of command handlers by the literal prefix of their patterns.
+
+    Command handlers which can't possibly match a message are left out of the
+    candidates, so they never have a context built for them.
+    """
+
+    def __init__(self):
+        self.plain = _Trie()
+        self.mentions = _Trie()
+        self._mention_pats = {}
+
+    def add(self, hook):
+        prefix, mention = hook.command
+        (self.mentions if mention else self.plain).add(prefix, hook)
+
+    def remove(self, hook):
+        prefix, mention = hook.command
+        (self.mentions if mention else self.plain).remove(prefix, hook)
+
+    def _mention_pat_for(self, nickname):
+        if nickname not in self._mention_pats:
+            self._mention_pats[nickname] = re.compile(
+                r"@?{}(?:[:,]?|\s)\s*(?P<rest>.+)".format(re.escape(nickname)),
+                re.IGNORECASE)
+        return self._mention_pats[nickname]
+
+    def candidates(self, message, nickname, private=False):
+        """
+        Get the set of command handlers that may match the message.
+        """
+        message = message.strip()
+        lowered = message.lower()
+
+        candidates = self.plain.walk(lowered)
+
+        if private:
+            candidates.update(self.mentions.walk(lowered))
+        else:
+            match = self._mention_pat_for(nickname).match(message)
+
+            if match is not None:
+                candidates.update(self.mentions.walk(match.group("rest").lower()))
+
+        return candidates
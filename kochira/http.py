@@ -0,0 +1,225 @@
+"""
+Shared HTTP client.
+
+Services should make their HTTP requests through here rather than calling
+``requests`` directly, so that connections are pooled and kept alive, every
+request has a timeout, and responses are cached.
+"""
+
+import re
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_tz, mktime_tz
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from tornado.httpclient import AsyncHTTPClient
+
+from . import metrics
+
+DEFAULT_TIMEOUT = (5, 20)
+POOL_CONNECTIONS = 32
+POOL_MAXSIZE = 8
+MAX_CACHED_RESPONSES = 512
+
+MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+REQUEST_SECONDS = metrics.histogram("kochira_http_request_seconds",
+                                    "Time taken by outgoing HTTP requests.",
+                                    ["method"])
+CACHE_HITS = metrics.counter("kochira_http_cache_hits_total",
+                             "HTTP requests answered from the response cache.")
+
+
+class ResponseCache:
+    """
+    An LRU of responses.
+
+    Each entry is kept with the time it expires and whatever validators the
+    response came with, so stale entries can be revalidated with a
+    conditional request instead of being fetched again.
+    """
+
+    def __init__(self, max_size=MAX_CACHED_RESPONSES):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, expires, response):
+        with self._lock:
+            self._entries[key] = (expires, response)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _freshness(response):
+    """
+    Work out how long a response may be cached for from its headers, or
+    ``None`` if it may not be stored at all.
+    """
+    cache_control = response.headers.get("cache-control", "").lower()
+
+    if "no-store" in cache_control or "private" in cache_control:
+        return None
+
+    if "no-cache" in cache_control:
+        return 0
+
+    match = MAX_AGE_RE.search(cache_control)
+    if match is not None:
+        return int(match.group(1))
+
+    expires = response.headers.get("expires")
+    if expires is not None:
+        expires = parsedate_tz(expires)
+        if expires is not None:
+            return max(0, mktime_tz(expires) - time.time())
+        return 0
+
+    return 0
+
+
+class Session(requests.Session):
+    """
+    A session with pooled keep-alive connections, a default timeout and a
+    response cache for GET requests.
+
+    The cache follows ``Cache-Control``, ``Expires`` and ``ETag`` /
+    ``Last-Modified`` unless an explicit ``ttl`` is given for a request, in
+    which case the response is kept for that many seconds regardless.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, cache=None):
+        super().__init__()
+
+        self.timeout = timeout
+        self.cache = cache if cache is not None else ResponseCache()
+
+        adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS,
+                              pool_maxsize=POOL_MAXSIZE)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def _timed_request(self, method, url, **kwargs):
+        with REQUEST_SECONDS.labels(method=method.upper()).time():
+            return super().request(method, url, **kwargs)
+
+    def request(self, method, url, ttl=None, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+
+        if method.upper() != "GET" or kwargs.get("stream"):
+            return self._timed_request(method, url, **kwargs)
+
+        key = (requests.Request(method, url, params=kwargs.get("params")).prepare().url,
+               tuple(sorted((kwargs.get("headers") or {}).items())))
+        entry = self.cache.get(key)
+        now = time.time()
+
+        if entry is not None:
+            expires, cached = entry
+
+            if expires > now:
+                CACHE_HITS.inc()
+                return cached
+
+            headers = dict(kwargs.get("headers") or {})
+
+            if "etag" in cached.headers:
+                headers["If-None-Match"] = cached.headers["etag"]
+            if "last-modified" in cached.headers:
+                headers["If-Modified-Since"] = cached.headers["last-modified"]
+
+            kwargs["headers"] = headers
+
+        response = self._timed_request(method, url, **kwargs)
+
+        if entry is not None and response.status_code == 304:
+            CACHE_HITS.inc()
+            response = entry[1]
+        elif response.status_code != 200:
+            return response
+
+        freshness = ttl if ttl is not None else _freshness(response)
+
+        if freshness is None:
+            return response
+
+        # make sure the body is read before we share the response around
+        response.content
+
+        if freshness > 0 or "etag" in response.headers or \
+            "last-modified" in response.headers:
+            self.cache.put(key, now + freshness, response)
+
+        return response
+
+
+class BoundSession:
+    """
+    A view of a session that caches responses for a fixed time by default.
+    """
+
+    def __init__(self, session, ttl=None):
+        self.session = session
+        self.ttl = ttl
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("ttl", self.ttl)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault("allow_redirects", False)
+        return self.request("HEAD", url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request("POST", url, data=data, **kwargs)
+
+
+session = Session()
+
+_default = BoundSession(session)
+request = _default.request
+get = _default.get
+head = _default.head
+post = _default.post
+
+RequestException = requests.RequestException
+
+
+_async_client_configured = False
+
+
+def fetch(request, **kwargs):
+    """
+    Fetch a request without blocking, using Tornado's asynchronous HTTP
+    client with the same default timeouts as the shared session.
+    """
+    global _async_client_configured
+
+    if not _async_client_configured:
+        connect_timeout, request_timeout = DEFAULT_TIMEOUT
+        AsyncHTTPClient.configure(None, max_clients=POOL_CONNECTIONS, defaults={
+            "connect_timeout": connect_timeout,
+            "request_timeout": connect_timeout + request_timeout
+        })
+        _async_client_configured = True
+
+    return AsyncHTTPClient().fetch(request, **kwargs)
@@ -0,0 +1,223 @@
+import logging
+import re
+from collections import namedtuple, deque, OrderedDict
+
+from . import saferegex
+
+logger = logging.getLogger(__name__)
+
+KeywordMatch = namedtuple("KeywordMatch", "key value text")
+
+_BACKREFERENCE_RE = re.compile(r"\\[1-9]|\(\?P=")
+
+
+def is_regex(what):
+    return what[0] == "/" and what[-1] == "/"
+
+
+def check_rule(what):
+    """
+    Make sure a rule is safe to match against anything anyone says, raising
+    ``saferegex.UnsafePattern`` or ``saferegex.error`` if it isn't.
+    """
+    if is_regex(what):
+        saferegex.check(what[1:-1], saferegex.I)
+
+
+class _Automaton:
+    """
+    An Aho-Corasick automaton over a set of words.
+    """
+
+    def __init__(self, words):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [set([])]
+
+        for word in words:
+            self._add(word)
+
+        self._link()
+
+    def _add(self, word):
+        state = 0
+
+        for c in word:
+            if c not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(set([]))
+                self.goto[state][c] = len(self.goto) - 1
+            state = self.goto[state][c]
+
+        self.out[state].add(word)
+
+    def _link(self):
+        queue = deque(self.goto[0].values())
+
+        while queue:
+            state = queue.popleft()
+
+            for c, next_state in self.goto[state].items():
+                queue.append(next_state)
+
+                fail = self.fail[state]
+                while fail and c not in self.goto[fail]:
+                    fail = self.fail[fail]
+
+                self.fail[next_state] = self.goto[fail].get(c, 0)
+                self.out[next_state] |= self.out[self.fail[next_state]]
+
+    def find_all(self, text):
+        """
+        Find every word that occurs in the text, in one pass.
+        """
+        found = set([])
+        state = 0
+
+        for c in text:
+            while state and c not in self.goto[state]:
+                state = self.fail[state]
+
+            state = self.goto[state].get(c, 0)
+            found |= self.out[state]
+
+        return found
+
+
+class KeywordMatcher:
+    """
+    Match a set of keyword rules against text.
+
+    Rules are either literal words, matched case-insensitively on word
+    boundaries, or regular expressions delimited by ``/``. Literal words are
+    found with a single Aho-Corasick pass and regular expressions are
+    prefiltered with one combined pattern, if it's simple enough to run
+    inline, so only the rules that actually occur in a message are ever run
+    on their own.
+
+    The matcher is rebuilt lazily, once per change to the rule set. Patterns
+    are compiled with ``saferegex`` unless another engine is given. Rules that
+    don't pass ``check_rule`` are kept in ``unsafe`` and never matched, and a
+    rule that runs over its time budget is treated as not matching.
+    """
+
+    def __init__(self, rules=(), engine=saferegex):
+        self.engine = engine
+        self.rules = OrderedDict()
+        self.unsafe = {}
+        self._patterns = {}
+        self._built = False
+
+        for key, value in rules:
+            self.add(key, value)
+
+    def add(self, key, value):
+        try:
+            check_rule(key)
+        except (saferegex.UnsafePattern, saferegex.error) as e:
+            logger.warning("Not matching rule %s: %s", key, e)
+            self.unsafe[key] = e
+        else:
+            self.unsafe.pop(key, None)
+
+        self.rules[key] = value
+        self._built = False
+
+    def remove(self, key):
+        self.rules.pop(key, None)
+        self.unsafe.pop(key, None)
+        self._patterns.pop(key, None)
+        self._built = False
+
+    def pattern_for(self, key):
+        """
+        Get the compiled pattern for a rule.
+        """
+        if key not in self._patterns:
+            if is_regex(key):
+                expr = key[1:-1]
+            else:
+                expr = r"\b{}\b".format(self.engine.escape(key))
+            self._patterns[key] = self.engine.compile(expr, self.engine.I)
+        return self._patterns[key]
+
+    def _build(self):
+        self._words = {}
+        regexes = []
+
+        for key in self.rules:
+            if key in self.unsafe:
+                continue
+
+            if is_regex(key):
+                regexes.append(key)
+            else:
+                self._words.setdefault(key.lower(), []).append(key)
+
+        self._automaton = _Automaton(self._words)
+        self._regexes = regexes
+
+        # backreferences would point at the wrong groups once the rules are
+        # combined, so we'll have to try each of them
+        if any(_BACKREFERENCE_RE.search(key) is not None for key in regexes):
+            self._prefilter = False
+        else:
+            try:
+                self._prefilter = self.engine.compile(
+                    "|".join("(?:{})".format(key[1:-1]) for key in regexes),
+                    self.engine.I) if regexes else None
+            except Exception:
+                self._prefilter = False
+
+            # if the combined pattern would have to go to the worker, one
+            # slow rule would take the whole prefilter with it
+            if getattr(self._prefilter, "isolated", False):
+                self._prefilter = False
+
+        self._built = True
+
+    def _prefilter_search(self, text):
+        try:
+            return self._prefilter.search(text) is not None
+        except saferegex.RegexTimeout:
+            # we can't tell, so try all of them
+            return True
+
+    def search(self, text):
+        """
+        Find every rule that matches the text, in rule order.
+        """
+        if not self._built:
+            self._build()
+
+        candidates = set([])
+
+        for word in self._automaton.find_all(text.lower()):
+            candidates.update(self._words[word])
+
+        if self._prefilter is False or \
+            (self._prefilter is not None and self._prefilter_search(text)):
+            candidates.update(self._regexes)
+
+        matches = []
+
+        for key, value in self.rules.items():
+            if key not in candidates:
+                continue
+
+            pattern = self.pattern_for(key)
+
+            if getattr(pattern, "disabled", False):
+                continue
+
+            try:
+                match = pattern.search(text)
+            except saferegex.RegexTimeout:
+                logger.warning("Skipping rule %s: ran over its time budget", key)
+                continue
+
+            if match is not None:
+                matches.append(KeywordMatch(key, value, match.group(0)))
+
+        return matches
@@ -0,0 +1,295 @@
+"""
+Metrics, in the Prometheus text format.
+
+The core registers its own metrics here. Services register theirs through
+``service.counter``, ``service.gauge``, ``service.histogram`` and
+``@service.collects``, and only show up while they're loaded.
+"""
+
+import bisect
+import threading
+import time
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+
+    return "{" + ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\")
+                                         .replace("\"", "\\\"")
+                                         .replace("\n", "\\n"))
+        for name, value in sorted(labels.items())) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        yield "", {}, self.value
+
+
+class _GaugeChild(_CounterChild):
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+class _Timer:
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.child.observe(time.perf_counter() - self.started)
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def samples(self):
+        total = 0
+
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield "_bucket", {"le": _format_value(bound)}, total
+
+        yield "_sum", {}, self.sum
+        yield "_count", {}, total
+
+
+class Metric:
+    """
+    A family of metrics, one per combination of label values.
+    """
+
+    type = None
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.label_names = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def _make_child(self):
+        raise NotImplementedError
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        child = self._children.get(key)
+
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._make_child())
+
+        return child
+
+    def samples(self, arg=None):
+        for key, child in list(self._children.items()):
+            for suffix, labels, value in child.samples():
+                labels = dict(labels, **dict(zip(self.label_names, key)))
+                yield suffix, labels, value
+
+    def expose(self, arg=None):
+        yield "# HELP {} {}".format(self.name, self.doc)
+        yield "# TYPE {} {}".format(self.name, self.type)
+
+        for suffix, labels, value in self.samples(arg):
+            yield "{}{}{} {}".format(self.name, suffix, _format_labels(labels),
+                                     _format_value(value))
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def _make_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def _make_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _make_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+
+class Collector(Metric):
+    """
+    A metric whose samples are worked out when it's scraped.
+
+    The function returns either a single value, or an iterable of
+    ``(suffix, labels, value)`` samples.
+    """
+
+    def __init__(self, name, doc, type, fn):
+        super().__init__(name, doc)
+        self.type = type
+        self.fn = fn
+
+    def samples(self, arg=None):
+        r = self.fn(arg)
+
+        if isinstance(r, (int, float)):
+            yield "", {}, r
+        else:
+            yield from r
+
+
+core = []
+
+
+def _register(metric):
+    core.append(metric)
+    return metric
+
+
+def counter(name, doc, labels=()):
+    return _register(Counter(name, doc, labels))
+
+
+def gauge(name, doc, labels=()):
+    return _register(Gauge(name, doc, labels))
+
+
+def histogram(name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram(name, doc, labels, buckets))
+
+
+def collects(name, doc, type="gauge"):
+    """
+    Register a function of the bot that gives the samples for a metric.
+    """
+    def _decorator(f):
+        _register(Collector(name, doc, type, f))
+        return f
+    return _decorator
+
+
+@collects("kochira_hook_calls_total", "Hook calls.", "counter")
+def _hook_calls(bot):
+    for (service, hook), stats in bot.profiler.hooks.items():
+        yield "", {"service": service, "hook": hook}, stats.calls
+
+
+@collects("kochira_hook_errors_total", "Hook calls that raised.", "counter")
+def _hook_errors(bot):
+    for (service, hook), stats in bot.profiler.hooks.items():
+        yield "", {"service": service, "hook": hook}, stats.errors
+
+
+@collects("kochira_hook_seconds", "Time hooks spent on the event loop.", "summary")
+def _hook_seconds(bot):
+    for (service, hook), stats in bot.profiler.hooks.items():
+        labels = {"service": service, "hook": hook}
+
+        for q in (50, 90, 99):
+            value = stats.times.percentile(q)
+            if value is not None:
+                yield "", dict(labels, quantile=str(q / 100)), value
+
+        yield "_sum", labels, stats.total_time
+        yield "_count", labels, stats.calls
+
+
+@collects("kochira_event_loop_lag_seconds", "How late the event loop heartbeat last ran.")
+def _loop_lag(bot):
+    lag = bot.profiler.loop_lag
+
+    if lag.count:
+        yield "", {}, lag.samples[(lag.count - 1) % len(lag.samples)]
+
+
+@collects("kochira_executor_queue_depth", "Work waiting for an executor thread.")
+def _executor_queue(bot):
+    return bot.profiler.executor_queue
+
+
+@collects("kochira_scheduler_jobs", "Jobs waiting in the scheduler.")
+def _scheduler_jobs(bot):
+    return sum(len(jobs) for jobs in bot.scheduler.jobs.values())
+
+
+@collects("kochira_scheduler_overdue_jobs", "Jobs in the scheduler that should already have run.")
+def _scheduler_overdue(bot):
+    now = time.time()
+    return sum(1 for jobs in bot.scheduler.jobs.values()
+               for job in jobs if job.run_at < now)
+
+
+def exposition(bot):
+    """
+    Render every metric, core and service, in the Prometheus text format.
+    """
+    lines = []
+
+    for metric in core:
+        lines.extend(metric.expose(bot))
+
+    for bound in list(bot.services.values()):
+        for metric in bound.service.metrics.values():
+            lines.extend(metric.expose(bot))
+
+    lines.append("")
+    return "\n".join(lines)
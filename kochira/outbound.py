@@ -0,0 +1,262 @@
+"""
+Outbound message queueing and flood control.
+"""
+
+import collections
+import contextlib
+import itertools
+import logging
+import threading
+import time
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# lanes, most important first
+URGENT = 0
+MODERATION = 1
+NORMAL = 2
+CHATTER = 3
+
+LANES = {
+    "PING": URGENT,
+    "PONG": URGENT,
+    "QUIT": URGENT,
+
+    "KICK": MODERATION,
+    "MODE": MODERATION,
+    "REMOVE": MODERATION,
+    "KILL": MODERATION,
+    "TOPIC": MODERATION,
+    "INVITE": MODERATION,
+
+    "PRIVMSG": CHATTER,
+    "NOTICE": CHATTER
+}
+
+# talking to network services usually goes along with a moderation action,
+# e.g. asking ChanServ for ops before kicking someone
+SERVICES = {"chanserv", "nickserv", "operserv", "memoserv", "hostserv",
+            "botserv", "q", "x"}
+
+_response_ids = itertools.count(1)
+
+DROPPED = metrics.counter("kochira_irc_messages_dropped_total",
+                          "Outgoing IRC messages dropped for being stale or duplicated.",
+                          ["client", "reason"])
+
+
+class OutboundQueue:
+    """
+    A queue of messages waiting to go out to the server.
+
+    Messages are released through a token bucket, so we never send more than
+    the server will put up with: a full bucket lets ``burst`` messages out at
+    once, and it refills at ``rate`` messages per second. If ``penalty_bytes``
+    is set, longer messages cost more, like on servers that penalize by
+    length.
+
+    Each message goes into a lane by its command, and lanes are emptied in
+    order, each first in, first out. Messages to network services go with
+    moderation, so asking ChanServ for ops still goes out before the kick
+    that needs them. Pings, pongs and quits skip the bucket altogether, and
+    until we're registered nothing is held back.
+
+    Chatter that has waited longer than ``max_age`` seconds is dropped, as is
+    chatter identical to a line that's already waiting from another response.
+    Lines sent as part of one response (see ``response``) aren't dropped for
+    their age once the first of them has gone out, so long replies aren't cut
+    off halfway.
+    """
+
+    def __init__(self, client, send):
+        self.client = client
+        self.send = send
+
+        self.lanes = [collections.deque() for _ in range(CHATTER + 1)]
+        self.tokens = None
+        self._pending = collections.defaultdict(collections.Counter)
+        self._responses = collections.Counter()
+        self._started = {}
+        self._local = threading.local()
+        self._last_refill = time.monotonic()
+        self._timer = None
+
+    @property
+    def config(self):
+        return self.client.config.flood
+
+    def __len__(self):
+        return sum(len(lane) for lane in self.lanes)
+
+    @contextlib.contextmanager
+    def response(self, response=None):
+        """
+        Mark everything sent from this thread in this block as part of the
+        response ``response``, from ``new_response``, or a new one.
+        """
+        outer = self.current_response()
+
+        if response is None:
+            response = new_response()
+
+        self._local.response = response
+
+        try:
+            yield response
+        finally:
+            self._local.response = outer
+
+    def current_response(self):
+        return getattr(self._local, "response", None)
+
+    def _wire(self, message):
+        return message.construct().encode(getattr(self.client, "encoding", "utf-8"),
+                                          "replace")
+
+    def _cost(self, wire):
+        penalty_bytes = self.config.penalty_bytes
+
+        if not penalty_bytes:
+            return 1
+
+        return 1 + len(wire) / penalty_bytes
+
+    def _target(self, message):
+        if not message.params:
+            return None
+        return self.client.normalize(message.params[0])
+
+    def _refill(self):
+        now = time.monotonic()
+
+        if self.tokens is None:
+            self.tokens = self.config.burst
+        else:
+            self.tokens = min(self.config.burst,
+                              self.tokens + (now - self._last_refill) * self.config.rate)
+
+        self._last_refill = now
+        return now
+
+    def put(self, message, response=None):
+        lane = LANES.get(message.command.upper(), NORMAL)
+        wire = self._wire(message)
+
+        if lane == URGENT or not getattr(self.client, "registered", True):
+            self._refill()
+            self.tokens -= self._cost(wire)
+            self.send(message)
+            return
+
+        target = self._target(message)
+
+        if lane == CHATTER and target in SERVICES:
+            lane = MODERATION
+
+        chatter = lane == CHATTER
+
+        if chatter:
+            # a response can repeat itself, but nobody else should repeat it
+            pending = self._pending[wire]
+
+            if any(other != response or response is None for other in pending):
+                DROPPED.labels(client=self.client.name, reason="duplicate").inc()
+                return
+
+            pending[response] += 1
+
+        if response is not None:
+            self._responses[response] += 1
+
+        self.lanes[lane].append((time.monotonic(), chatter, wire, target, response,
+                                 message))
+        self._pump()
+
+    def clear(self):
+        for lane in self.lanes:
+            lane.clear()
+
+        self._pending.clear()
+        self._responses.clear()
+        self._started.clear()
+
+        if self._timer is not None:
+            self.client.bot.event_loop.unschedule(self._timer)
+            self._timer = None
+
+    def _on_timer(self):
+        self._timer = None
+        self._pump()
+
+    def _pump(self):
+        now = self._refill()
+
+        # forget responses that have finished going out
+        for response, sent in list(self._started.items()):
+            if response not in self._responses and now - sent > self.config.max_age:
+                del self._started[response]
+
+        for i, lane in enumerate(self.lanes):
+            while lane:
+                queued, chatter, wire, target, response, message = lane[0]
+
+                if chatter and now - queued > self.config.max_age and \
+                    response not in self._started:
+                    lane.popleft()
+                    self._forget(chatter, wire, response)
+                    DROPPED.labels(client=self.client.name, reason="stale").inc()
+                    logger.warning("Dropped a line to %s after %.1f seconds in the send queue",
+                                   target, now - queued)
+                    continue
+
+                cost = self._cost(wire)
+
+                if self.tokens < min(cost, self.config.burst):
+                    self._wait(cost)
+                    return
+
+                lane.popleft()
+
+                if response is not None:
+                    self._started[response] = now
+
+                self._forget(chatter, wire, response)
+
+                self.tokens -= cost
+                self.send(message)
+
+    def _forget(self, chatter, wire, response):
+        if chatter:
+            pending = self._pending[wire]
+            pending[response] -= 1
+
+            if not pending[response]:
+                del pending[response]
+
+            if not pending:
+                del self._pending[wire]
+
+        if response is not None:
+            self._responses[response] -= 1
+
+            if not self._responses[response]:
+                del self._responses[response]
+
+    def _wait(self, cost):
+        if self._timer is not None:
+            return
+
+        delay = (min(cost, self.config.burst) - self.tokens) / self.config.rate
+        self._timer = self.client.bot.event_loop.schedule_in(delay, self._on_timer)
+
+
+def new_response():
+    return next(_response_ids)
+
+
+@metrics.collects("kochira_irc_send_queue_depth", "Outgoing IRC messages waiting to be sent.")
+def _send_queue_depth(bot):
+    for name, client in list(bot.clients.items()):
+        yield "", {"client": name}, len(client.outbound)
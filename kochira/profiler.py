@@ -0,0 +1,154 @@
+"""
+Lightweight profiling for hooks and the event loop.
+
+Everything here is meant to be left on: each hook call costs two clock reads
+and a couple of additions, and timings are kept in fixed-size ring buffers so
+memory use doesn't grow with uptime.
+"""
+
+import logging
+import time
+
+from pydle.async import Future
+
+logger = logging.getLogger(__name__)
+
+SAMPLES = 512
+HEARTBEAT_INTERVAL = 1.0
+
+
+class Histogram:
+    """
+    The most recent samples of some measurement, in a ring buffer.
+    """
+
+    def __init__(self, size=SAMPLES):
+        self.samples = [0.0] * size
+        self.count = 0
+
+    def add(self, value):
+        self.samples[self.count % len(self.samples)] = value
+        self.count += 1
+
+    def percentile(self, p):
+        n = min(self.count, len(self.samples))
+
+        if not n:
+            return None
+
+        samples = sorted(self.samples[:n])
+        return samples[min(n - 1, int(p / 100 * n))]
+
+
+class HookStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.times = Histogram()
+
+    @property
+    def mean_time(self):
+        if not self.calls:
+            return None
+        return self.total_time / self.calls
+
+
+class Profiler:
+    """
+    Keeps track of how long hooks take and how far behind the event loop is.
+
+    Hook times only cover the time a hook spends on the event loop, since
+    that is what holds everything else up; anything a hook defers to the
+    executor shows up in the executor's queue depth instead.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.hooks = {}
+
+        self.loop_lag = Histogram()
+        self.max_loop_lag = 0.0
+        self.executor_queue = 0
+        self.max_executor_queue = 0
+
+        self._heartbeat = None
+        self._expected = None
+
+    def stats_for(self, hook):
+        key = (hook.service.name, hook.__name__)
+
+        if key not in self.hooks:
+            self.hooks[key] = HookStats()
+
+        return self.hooks[key]
+
+    def call(self, hook, ctx, *args, **kwargs):
+        """
+        Call a hook, recording how long it took and whether it failed.
+        """
+        stats = self.stats_for(hook)
+        started = time.perf_counter()
+
+        try:
+            r = hook(ctx, *args, **kwargs)
+        except BaseException:
+            stats.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            stats.calls += 1
+            stats.total_time += elapsed
+            stats.times.add(elapsed)
+
+        if isinstance(r, Future):
+            @r.add_done_callback
+            def _callback(future):
+                if future.exception() is not None:
+                    stats.errors += 1
+
+        return r
+
+    def start(self):
+        """
+        Start measuring event loop lag.
+        """
+        self._expected = time.monotonic() + HEARTBEAT_INTERVAL
+        self._heartbeat = self.bot.event_loop.schedule_in(HEARTBEAT_INTERVAL,
+                                                          self._beat)
+
+    def stop(self):
+        if self._heartbeat is not None:
+            self.bot.event_loop.unschedule(self._heartbeat)
+            self._heartbeat = None
+
+    def _beat(self):
+        now = time.monotonic()
+        lag = max(0.0, now - self._expected)
+
+        self.loop_lag.add(lag)
+        self.max_loop_lag = max(self.max_loop_lag, lag)
+
+        # there's no public way to ask a ThreadPoolExecutor how much work it
+        # has waiting
+        queue = getattr(self.bot.executor, "_work_queue", None)
+        if queue is not None:
+            self.executor_queue = queue.qsize()
+            self.max_executor_queue = max(self.max_executor_queue,
+                                          self.executor_queue)
+
+        self._expected = now + HEARTBEAT_INTERVAL
+        self._heartbeat = self.bot.event_loop.schedule_in(HEARTBEAT_INTERVAL,
+                                                          self._beat)
+
+    def top_hooks(self, n=None, key=lambda stats: stats.total_time):
+        """
+        Get the hooks that have taken the most time, worst first.
+        """
+        hooks = sorted(self.hooks.items(), key=lambda item: key(item[1]),
+                       reverse=True)
+
+        if n is not None:
+            hooks = hooks[:n]
+
+        return hooks
@@ -0,0 +1,407 @@
+"""
+Regular expressions that are safe to take from users.
+
+Patterns are compiled with RE2 where it's installed and can handle them, so
+they run in linear time. Anything else falls back to ``re``: patterns simple
+enough that they can't backtrack badly run inline, and the rest are sent to
+a worker process that is killed if a call goes over its time budget, so one
+catastrophic pattern can't freeze the bot. A pattern that has gone over its
+budget once is disabled, and never run again.
+
+Compiled patterns are kept in an LRU cache. ``check`` should be used on any
+pattern a user is about to save, to turn away ones that are too complex to
+be worth running at all.
+"""
+
+import functools
+import itertools
+import logging
+import multiprocessing
+import re
+import sre_constants
+import sre_parse
+import threading
+
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+I = IGNORECASE = re.IGNORECASE
+S = DOTALL = re.DOTALL
+U = UNICODE = re.UNICODE
+
+escape = re.escape
+error = re.error
+
+CACHE_SIZE = 256
+BUDGET = 0.1
+
+MAX_PATTERN_LENGTH = 255
+MAX_UNBOUNDED_REPEATS = 6
+MAX_INLINE_REPEATS = 2
+
+TIMEOUTS = metrics.counter("kochira_regex_timeouts_total",
+                           "Regular expressions that ran over their time budget.")
+
+# patterns that have run over their budget, kept apart from the cache so they
+# stay disabled after being evicted from it
+_disabled = set([])
+
+_RE_PATTERN = type(re.compile(""))
+_REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+_SINGLE = (sre_constants.LITERAL, sre_constants.NOT_LITERAL,
+           sre_constants.ANY, sre_constants.IN, sre_constants.CATEGORY)
+
+
+class UnsafePattern(ValueError):
+    """
+    A pattern that's too complex to run on untrusted text.
+    """
+
+
+class RegexTimeout(Exception):
+    """
+    A pattern that ran over its time budget.
+    """
+
+
+def _subpatterns(av):
+    if isinstance(av, sre_parse.SubPattern):
+        yield av
+    elif isinstance(av, (tuple, list)):
+        for x in av:
+            yield from _subpatterns(x)
+
+
+def _analyze(p):
+    """
+    Work out how many unbounded repeats a parsed pattern has, whether any of
+    them nest, and whether it could backtrack badly: if it repeats more than
+    a single character or has backreferences.
+    """
+    repeats = 0
+    nested = False
+    complex = False
+
+    for op, av in p:
+        if op in _REPEATS:
+            lo, hi, body = av
+            inner, inner_nested, inner_complex = _analyze(body)
+
+            if hi == sre_constants.MAXREPEAT:
+                repeats += 1
+                nested = nested or inner > 0
+                complex = complex or len(body) != 1 or body[0][0] not in _SINGLE
+
+            repeats += inner
+            nested = nested or inner_nested
+            complex = complex or inner_complex
+        elif op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+            complex = True
+        else:
+            for sub in _subpatterns(av):
+                inner, inner_nested, inner_complex = _analyze(sub)
+                repeats += inner
+                nested = nested or inner_nested
+                complex = complex or inner_complex
+
+    return repeats, nested, complex
+
+
+class _Match:
+    """
+    A match made in the worker, with just enough of the match object
+    interface to be used in its place.
+    """
+
+    def __init__(self, match):
+        self.string = match.string
+        self.spans = [match.span(i) for i in range(len(match.groups()) + 1)]
+        self.groupindex = dict(match.re.groupindex)
+
+    def _index(self, group):
+        if isinstance(group, str):
+            return self.groupindex[group]
+        return group
+
+    def span(self, group=0):
+        return self.spans[self._index(group)]
+
+    def start(self, group=0):
+        return self.span(group)[0]
+
+    def end(self, group=0):
+        return self.span(group)[1]
+
+    def group(self, *groups):
+        if not groups:
+            groups = (0,)
+
+        r = []
+
+        for group in groups:
+            start, end = self.span(group)
+            r.append(self.string[start:end] if start != -1 else None)
+
+        return r[0] if len(r) == 1 else tuple(r)
+
+    def groups(self, default=None):
+        return tuple(self.group(i) if self.start(i) != -1 else default
+                     for i in range(1, len(self.spans)))
+
+    def groupdict(self, default=None):
+        return {name: self.group(i) if self.start(i) != -1 else default
+                for name, i in self.groupindex.items()}
+
+    def __getitem__(self, group):
+        return self.group(group)
+
+
+def _first(regex, strings):
+    for i, string in enumerate(strings):
+        if regex.search(string) is not None:
+            return i
+    return None
+
+
+_OPS = {
+    "search": lambda regex, string: regex.search(string),
+    "match": lambda regex, string: regex.match(string),
+    "sub": lambda regex, repl, string, count: regex.sub(repl, string, count=count),
+    "finditer": lambda regex, string, count: list(itertools.islice(regex.finditer(string), count or None)),
+    "first": _first
+}
+
+
+def _portable(r):
+    if isinstance(r, list):
+        return [_portable(x) for x in r]
+
+    if r is None or isinstance(r, (str, int)):
+        return r
+
+    return _Match(r)
+
+
+def _context():
+    # forking a process with threads running can leave it holding locks
+    # nobody will ever let go of
+    for method in ("forkserver", "spawn"):
+        try:
+            return multiprocessing.get_context(method)
+        except ValueError:
+            continue
+
+    return multiprocessing.get_context()
+
+
+def _serve(conn):
+    compile = functools.lru_cache(maxsize=CACHE_SIZE)(re.compile)
+
+    while True:
+        try:
+            pattern, flags, op, args = conn.recv()
+        except EOFError:
+            return
+
+        try:
+            r = (True, _portable(_OPS[op](compile(pattern, flags), *args)))
+        except Exception as e:
+            r = (False, e)
+
+        conn.send(r)
+
+
+class _Worker:
+    """
+    A process to run risky patterns in, started when it's first needed and
+    replaced whenever a pattern has to be cut off.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._process = None
+        self._conn = None
+
+    def _start(self):
+        context = _context()
+
+        self._conn, child = context.Pipe()
+        self._process = context.Process(target=_serve, args=(child,),
+                                        daemon=True)
+        self._process.start()
+        child.close()
+
+    def _stop(self):
+        if self._process is None:
+            return
+
+        self._process.terminate()
+        self._process.join()
+        self._conn.close()
+
+        self._process = None
+        self._conn = None
+
+    def stop(self):
+        with self._lock:
+            self._stop()
+
+    def run(self, pattern, flags, op, args, timeout):
+        with self._lock:
+            if self._process is None:
+                self._start()
+
+            try:
+                self._conn.send((pattern, flags, op, args))
+
+                if not self._conn.poll(timeout):
+                    self._stop()
+                    TIMEOUTS.inc()
+                    logger.warning("Pattern ran over its time budget: %r", pattern)
+                    raise RegexTimeout(pattern)
+
+                ok, r = self._conn.recv()
+            except (EOFError, OSError):
+                self._stop()
+                raise
+
+        if not ok:
+            raise r
+
+        return r
+
+
+_worker = _Worker()
+
+
+class Pattern:
+    """
+    A compiled pattern, with a subset of the ``re`` pattern interface. Every
+    method takes an optional ``timeout``, the most time in seconds it may
+    take if it has to go to the worker. Once a pattern has run over its time
+    budget, it's ``disabled`` and every call raises ``RegexTimeout`` straight
+    away.
+    """
+
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+
+        self.regex = None
+
+        if re2 is not None:
+            try:
+                regex = re2.compile(pattern, flags)
+            except Exception:
+                pass
+            else:
+                # some builds of re2 quietly fall back to re themselves
+                if not isinstance(regex, _RE_PATTERN):
+                    self.regex = regex
+
+        self.linear = self.regex is not None
+
+        if self.linear:
+            self.repeats = 0
+            self.nested = False
+            self.isolated = False
+        else:
+            self.regex = re.compile(pattern, flags)
+            self.repeats, self.nested, complex = _analyze(sre_parse.parse(pattern, flags))
+            self.isolated = complex or self.nested or \
+                self.repeats > MAX_INLINE_REPEATS
+
+    @property
+    def disabled(self):
+        return (self.pattern, self.flags) in _disabled
+
+    def __repr__(self):
+        return "{}({!r})".format(self.__class__.__name__, self.pattern)
+
+    def _run(self, op, *args, timeout=None):
+        if not self.isolated:
+            return _OPS[op](self.regex, *args)
+
+        if self.disabled:
+            raise RegexTimeout(self.pattern)
+
+        try:
+            return _worker.run(self.pattern, self.flags, op, args,
+                               BUDGET if timeout is None else timeout)
+        except RegexTimeout:
+            _disabled.add((self.pattern, self.flags))
+            logger.warning("Disabled pattern: %r", self.pattern)
+            raise
+
+    def search(self, string, timeout=None):
+        return self._run("search", string, timeout=timeout)
+
+    def match(self, string, timeout=None):
+        return self._run("match", string, timeout=timeout)
+
+    def finditer(self, string, count=0, timeout=None):
+        return iter(self._run("finditer", string, count, timeout=timeout))
+
+    def first(self, strings, timeout=None):
+        """
+        Find the index of the first string the pattern can be found in, all
+        within a single time budget.
+        """
+        return self._run("first", list(strings), timeout=timeout)
+
+    def sub(self, repl, string, count=0, timeout=None):
+        if not callable(repl) or not self.isolated:
+            return self._run("sub", repl, string, count, timeout=timeout)
+
+        # functions can't be sent to the worker, so find the matches there
+        # and put the string back together here
+        parts = []
+        last = 0
+
+        for match in self.finditer(string, count, timeout=timeout):
+            parts.append(string[last:match.start()])
+            parts.append(repl(match))
+            last = match.end()
+
+        parts.append(string[last:])
+        return "".join(parts)
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def compile(pattern, flags=0):
+    """
+    Compile a pattern, or get it from the cache.
+    """
+    return Pattern(pattern, flags)
+
+
+def check(pattern, flags=0):
+    """
+    Compile a pattern that's about to be saved, raising ``UnsafePattern`` if
+    it's too complex or ``error`` if it's invalid.
+    """
+    if len(pattern) > MAX_PATTERN_LENGTH:
+        raise UnsafePattern("it's too long")
+
+    compiled = compile(pattern, flags)
+
+    if compiled.nested:
+        raise UnsafePattern("it has nested repeats")
+
+    if compiled.repeats > MAX_UNBOUNDED_REPEATS:
+        raise UnsafePattern("it has too many repeats")
+
+    return compiled
+
+
+def shutdown():
+    """
+    Stop the worker process.
+    """
+    _worker.stop()
@@ -1,21 +1,156 @@
-import threading
+import functools
+import heapq
+import itertools
+import json
 import logging
+import random
+import time
+
+import peewee
+from datetime import datetime, timedelta
 from pydle.async import Future
 
+from .db import Model
 from .service import HookContext
 
 
 logger = logging.getLogger(__name__)
 
 
+# what to do with a persisted job whose time passed while the bot was down
+MISFIRE_RUN = "run"             # run it once, as soon as possible
+MISFIRE_SKIP = "skip"           # drop it, or wait for the next period
+MISFIRE_CATCH_UP = "catch_up"   # run every period that was missed
+
+MAX_CATCH_UP = 100
+
+# how the next run of a periodic job is worked out
+FIXED_RATE = "rate"             # every interval from when it was first due
+FIXED_DELAY = "delay"           # an interval after the last run finished
+
+
+def _seconds(t):
+    if isinstance(t, timedelta):
+        return t.total_seconds()
+    return t
+
+
+def _timestamp(t):
+    if isinstance(t, datetime):
+        return (t - datetime(1970, 1, 1)).total_seconds()
+    return t
+
+
+class Job(Model):
+    """
+    A job that survives restarts.
+    """
+
+    service = peewee.CharField(255)
+    task = peewee.CharField(255)
+    run_at = peewee.FloatField(index=True)
+    interval = peewee.FloatField(null=True)
+    mode = peewee.CharField(16, default=FIXED_RATE)
+    jitter = peewee.FloatField(default=0)
+    overlap = peewee.BooleanField(default=False)
+    misfire = peewee.CharField(16)
+    payload = peewee.TextField()
+
+
+class TaskStats:
+    """
+    How long a task has been taking to run.
+    """
+
+    def __init__(self):
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.last_run = None
+        self.last_time = None
+
+    @property
+    def mean_time(self):
+        if not self.runs:
+            return None
+        return self.total_time / self.runs
+
+    def record(self, started, elapsed, failed):
+        self.runs += 1
+        self.last_run = started
+        self.last_time = elapsed
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+        if failed:
+            self.failures += 1
+
+
+class ScheduledJob:
+    """
+    A job in the scheduler's queue. Jobs are ordered by when they next run,
+    and cancelled jobs are left where they are to be skipped over.
+
+    ``due`` is when the job is meant to run and ``run_at`` is that plus any
+    jitter, so that jitter never pushes a fixed-rate job off its schedule.
+    """
+
+    def __init__(self, seq, service, task, due, args, kwargs, interval=None,
+                 mode=FIXED_RATE, jitter=0, overlap=False, record=None):
+        self.seq = seq
+        self.service = service
+        self.task = task
+        self.args = args
+        self.kwargs = kwargs
+        self.interval = interval
+        self.mode = mode
+        self.jitter = jitter
+        self.overlap = overlap
+        self.record = record
+        self.cancelled = False
+        self.running = 0
+        self.set_due(due)
+
+    @property
+    def durable(self):
+        return self.record is not None
+
+    def set_due(self, due):
+        self.due = due
+        self.run_at = due + (random.uniform(0, self.jitter) if self.jitter else 0)
+
+    def __lt__(self, other):
+        return (self.run_at, self.seq) < (other.run_at, other.seq)
+
+
 class Scheduler:
+    """
+    Runs tasks at some point in the future.
+
+    Every job waits in a single min-heap, and only the earliest of them has a
+    timer on the event loop. Jobs scheduled with ``_durable=True`` are also
+    kept in the database and are put back into the queue when their service
+    is loaded again, e.g. after a restart.
+
+    Tasks that return a future, such as ``@background`` tasks running on the
+    executor, count as running until it resolves. Runs that were missed while
+    the bot was down are held back until a client has connected, so they
+    don't go out to nobody at startup.
+    """
+
     def __init__(self, bot):
         self.bot = bot
 
-        self.timeouts = {}
-        self.periods = {}
+        self.queue = []
+        self.jobs = {}
+        self.stats = {}
 
-        self._next_period_id = 0
+        self._seq = itertools.count()
+        self._timer = None
+        self._timer_at = None
+        self._missed = []
 
     def _error_handler(self, future):
         exc = future.exception()
@@ -23,74 +158,309 @@ class Scheduler:
             logging.error("Background task error",
                           exc_info=(exc.__class__, exc, exc.__traceback__))
 
-    def schedule_after(self, _time, _task, *_args, **_kwargs):
+    def _arm(self):
+        while self.queue and self.queue[0].cancelled:
+            heapq.heappop(self.queue)
+
+        if not self.queue:
+            return
+
+        run_at = self.queue[0].run_at
+
+        if self._timer is not None:
+            if self._timer_at <= run_at:
+                return
+            self.bot.event_loop.unschedule(self._timer)
+
+        self._timer_at = run_at
+        self._timer = self.bot.event_loop.schedule_in(max(0, run_at - time.time()),
+                                                      self._tick)
+
+    def _tick(self):
+        self._timer = None
+        self._timer_at = None
+
+        now = time.time()
+
+        while self.queue and self.queue[0].run_at <= now:
+            job = heapq.heappop(self.queue)
+
+            if job.cancelled:
+                continue
+
+            if job.interval is None:
+                self._run(job)
+                self._forget(job)
+                continue
+
+            if job.running and not job.overlap:
+                self.stats_for(job.task).skipped += 1
+            else:
+                self._run(job)
+
+            # fixed-delay jobs are put back once they've finished
+            if job.mode == FIXED_RATE and not job.cancelled:
+                due = job.due + job.interval
+
+                # don't try to make up for ticks that were missed while we
+                # were busy
+                if due <= now:
+                    due += ((now - due) // job.interval + 1) * job.interval
+
+                self._requeue(job, due)
+
+        self._arm()
+
+    def _requeue(self, job, due):
+        job.set_due(due)
+
+        if job.durable:
+            Job.update(run_at=due).where(Job.id == job.record).execute()
+
+        heapq.heappush(self.queue, job)
+
+    def _run(self, job):
+        ctx = HookContext(job.service, self.bot)
+        stats = self.stats_for(job.task)
+        started = time.time()
+
+        job.running += 1
+
+        def _finish(failed):
+            job.running -= 1
+            stats.record(started, time.time() - started, failed)
+
+            if job.interval is not None and job.mode == FIXED_DELAY and \
+                not job.cancelled and not job.running:
+                self._requeue(job, time.time() + job.interval)
+                self._arm()
+
+        try:
+            r = job.task(ctx, *job.args, **job.kwargs)
+        except Exception:
+            logger.exception("Error running task %s.%s", job.service.name,
+                             job.task.__name__)
+            _finish(True)
+            return
+
+        if isinstance(r, Future):
+            def _done(future):
+                self._error_handler(future)
+                _finish(future.exception() is not None)
+            r.add_done_callback(_done)
+        else:
+            _finish(False)
+
+    def _forget(self, job):
+        job.cancelled = True
+        self.jobs.get(job.service.name, set([])).discard(job)
+
+        if job.durable:
+            Job.delete().where(Job.id == job.record).execute()
+
+    def _push(self, service, task, due, args, kwargs, **options):
+        job = ScheduledJob(next(self._seq), service, task, due, args, kwargs,
+                           **options)
+        self.jobs.setdefault(service.name, set([])).add(job)
+        heapq.heappush(self.queue, job)
+        self._arm()
+        return job
+
+    def _online(self):
+        return any(client.connected for client in list(self.bot.clients.values()))
+
+    def _when_online(self, service, f, *args):
+        if self._online():
+            f(*args)
+        else:
+            self._missed.append((service, f, args))
+
+    def connected(self):
         """
-        Schedule a task to run after a given amount of time.
+        Run whatever was missed while the bot was down. Called when a client
+        has connected.
+        """
+        missed, self._missed = self._missed, []
+
+        for service, f, args in missed:
+            f(*args)
+
+    def stats_for(self, task):
+        """
+        Get the run statistics for a task.
+        """
+        key = (task.service.name, task.__name__)
+
+        if key not in self.stats:
+            self.stats[key] = TaskStats()
+
+        return self.stats[key]
+
+    def schedule_at(self, _when, _task, *_args, _interval=None,
+                    _mode=FIXED_RATE, _jitter=0, _overlap=False,
+                    _durable=False, _misfire=MISFIRE_RUN, **_kwargs):
         """
-        logger.info("Scheduling %s.%s in %s", _task.service.name, _task.__name__, _time)
+        Schedule a task to run at a given time, either a UTC ``datetime`` or a
+        UNIX timestamp.
 
-        timeout = None
-        ctx = HookContext(_task.service, self.bot)
+        If ``_interval`` is given, the task runs again every interval after
+        that, either counting from when it was due (``FIXED_RATE``) or from
+        when the last run finished (``FIXED_DELAY``). Each run may be delayed
+        by up to ``_jitter`` seconds, and a run is skipped if the last one
+        hasn't finished yet unless ``_overlap`` is set.
 
-        def _handler():
-            # ghetto-ass code for removing the timeout on completion
-            nonlocal timeout
+        If ``_durable`` is set, the job is stored in the database and will
+        still run if the bot is restarted in the meantime. Its arguments must
+        be serializable as JSON, and ``_misfire`` decides what happens if the
+        bot was down when it should have run.
+        """
+        due = _timestamp(_when)
+        service = _task.service
 
-            r = _task(ctx, *_args, **_kwargs)
+        if _interval is not None and _seconds(_interval) <= 0:
+            raise ValueError("interval must be positive")
 
-            if isinstance(r, Future):
-                r.add_done_callback(self._error_handler)
+        options = {
+            "interval": _seconds(_interval),
+            "mode": _mode,
+            "jitter": _seconds(_jitter),
+            "overlap": _overlap
+        }
 
-            self.timeouts[_task.service.name].remove(timeout)
+        logger.info("Scheduling %s.%s at %s", service.name, _task.__name__, due)
 
-        timeout = self.bot.event_loop.schedule_in(_time, _handler)
+        if _durable:
+            options["record"] = Job.create(service=service.name,
+                                           task=_task.__name__,
+                                           run_at=due, misfire=_misfire,
+                                           payload=json.dumps({
+                                               "args": _args,
+                                               "kwargs": _kwargs
+                                           }),
+                                           **options).id
 
-        self.timeouts.setdefault(_task.service.name, set([])).add(timeout)
-        return (_task.service.name, timeout)
+        return self._push(service, _task, due, _args, _kwargs, **options)
+
+    def schedule_after(self, _time, _task, *_args, **_kwargs):
+        """
+        Schedule a task to run after a given amount of time.
+        """
+        return self.schedule_at(time.time() + _seconds(_time), _task,
+                                *_args, **_kwargs)
 
     def schedule_every(self, _interval, _task, *_args, **_kwargs):
         """
         Schedule a task to run at every given interval.
         """
-        logger.info("Scheduling %s.%s every %s", _task.service.name, _task.__name__, _interval)
+        interval = _seconds(_interval)
+        return self.schedule_at(time.time() + interval, _task, *_args,
+                                _interval=interval, **_kwargs)
+
+    def unschedule(self, job):
+        """
+        Cancel a job, removing it from the database if it was durable.
+        """
+        if not job.cancelled:
+            self._forget(job)
+
+    unschedule_timeout = unschedule
+    unschedule_period = unschedule
+
+    def restore_service(self, service):
+        """
+        Put a service's durable jobs back into the queue, deciding what to do
+        with the ones that were missed.
+        """
+        tasks = {task.__name__: task for task in service.tasks}
+        now = time.time()
+        restored = 0
+
+        for record in Job.select().where(Job.service == service.name):
+            task = tasks.get(record.task)
+
+            if task is None:
+                logger.warning("Dropping job for unknown task %s.%s",
+                               service.name, record.task)
+                record.delete_instance()
+                continue
+
+            if record.interval is not None and record.interval <= 0:
+                logger.warning("Dropping job for %s.%s with an interval of %s",
+                               service.name, record.task, record.interval)
+                record.delete_instance()
+                continue
 
-        period_id = self._next_period_id
-        self._next_period_id += 1
+            payload = json.loads(record.payload)
+            args = payload["args"]
+            kwargs = payload["kwargs"]
+            options = {
+                "interval": record.interval,
+                "mode": record.mode,
+                "jitter": record.jitter,
+                "overlap": record.overlap,
+                "record": record.id
+            }
 
-        ctx = HookContext(_task.service, self.bot)
+            due = record.run_at
+            missed = 0
 
-        def _handler():
-            if period_id not in self.periods.get(_task.service.name, set([])):
-                return False
+            if due <= now:
+                if record.interval is None:
+                    missed = 1
+                else:
+                    missed = int((now - due) // record.interval) + 1
+                    due += missed * record.interval
 
-            r = _task(ctx, *_args, **_kwargs)
+                if record.misfire == MISFIRE_SKIP:
+                    missed = 0
+                elif record.misfire == MISFIRE_RUN:
+                    missed = min(missed, 1)
+                else:
+                    missed = min(missed, MAX_CATCH_UP)
 
-            if isinstance(r, Future):
-                r.add_done_callback(self._error_handler)
+            if record.interval is None and record.run_at <= now:
+                if missed:
+                    # run it as soon as we can, then forget it like any
+                    # other one-off job
+                    self._when_online(service, functools.partial(self._push, **options),
+                                      service, task, now, args, kwargs)
+                    restored += 1
+                else:
+                    record.delete_instance()
+                continue
 
-            return True
+            for _ in range(missed):
+                self._when_online(service, self._run,
+                                  ScheduledJob(None, service, task, now, args, kwargs))
 
-        self.bot.event_loop.schedule_periodically(_interval, _handler)
-        self.periods.setdefault(_task.service.name, set([])).add(period_id)
-        return (_task.service.name, period_id)
+            if due != record.run_at:
+                record.run_at = due
+                record.save()
 
-    def unschedule_timeout(self, timeout):
-        service_name, timeout = timeout
-        self.bot.event_loop.unschedule(timeout)
-        self.timeouts[service_name].remove(timeout)
+            self._push(service, task, due, args, kwargs, **options)
+            restored += 1
 
-    def unschedule_period(self, period):
-        service_name, period_id = period
-        self.periods[service_name].remove(period_id)
+        if restored:
+            logger.info("Restored %d jobs for service %s", restored,
+                        service.name)
+
+    def pending_jobs(self, service):
+        """
+        Count the durable jobs a service has waiting.
+        """
+        return Job.select().where(Job.service == service.name).count()
 
     def unschedule_service(self, service):
+        """
+        Drop all of a service's jobs from the queue. Durable jobs stay in the
+        database, to be restored when the service is loaded again.
+        """
         logger.info("Unscheduling all tasks for service %s", service.name)
 
-        if service.name in self.timeouts:
-            for timeout in list(self.timeouts[service.name]):
-                self.unschedule_timeout((service.name, timeout))
+        for job in self.jobs.pop(service.name, set([])):
+            job.cancelled = True
 
-            del self.timeouts[service.name]
+        self._missed = [missed for missed in self._missed
+                        if missed[0] is not service]
 
-        if service.name in self.periods:
-            del self.periods[service.name]
+        self._arm()
@@ -1,3 +1,4 @@
+import collections
 import functools
 import re
 import logging
@@ -9,8 +10,10 @@ import os
 from pydle.async import coroutine, Future
 
 from .auth import has_permission, requires_permission
+from .dispatch import literal_prefix
 from .userdata import UserData
-from . import config
+from . import config, http, metrics
+from .outbound import new_response
 
 from .util import Expando
 
@@ -20,6 +23,7 @@ logger = logging.getLogger(__name__)
 class Config(config.Config):
     autoload = config.Field(doc="Autoload this service?", default=True)
     enabled = config.Field(doc="Enable this service?", default=True)
+    http_cache_ttl = config.Field(doc="How long, in seconds, to cache this service's HTTP responses. By default, the server's caching headers are followed.", default=None)
 
 
 class BoundService:
@@ -29,36 +33,35 @@ class BoundService:
         self.contexts = {}
 
 
+# TODO: ugh, locales
+_translations = gettext.NullTranslations()
+
+
 class HookContext:
+    __slots__ = ("service", "bot", "client", "target", "origin", "response")
+
     def __init__(self, service, bot, client=None, target=None, origin=None):
         self.service = service
         self.bot = bot
         self.client = client
         self.target = target
         self.origin = origin
-
-        self._load_locale()
+        self.response = new_response()
 
     @property
     def config(self):
-        config = self.bot.config.services.get(self.service.name, self.service.config_factory())
-
-        if self.client is not None:
-            client_config = self.bot.config.clients[self.client.name]
-            config = config.combine(client_config.services.get(self.service.name, self.service.config_factory()))
-
-            if self.target is not None and self.target in client_config.channels:
-                channel_config = client_config.channels[self.target]
-                config = config.combine(channel_config.services.get(self.service.name, self.service.config_factory()))
-
-        return config
+        return self.bot.config_for(self.service, self.client, self.target)
 
     @property
     def storage(self):
         return self.service.binding_for(self.bot).storage
 
+    @property
+    def http(self):
+        return http.BoundSession(http.session, self.config.http_cache_ttl)
+
     def message(self, message):
-        self.client.message(self.target, message)
+        self.client.message(self.target, message, self.response)
 
     def respond(self, message):
         @coroutine
@@ -100,9 +103,9 @@ class HookContext:
 
         return locale
 
-    def _load_locale(self):
-        # TODO: ugh, locales
-        self.t = gettext.NullTranslations()
+    @property
+    def t(self):
+        return _translations
 
     def lookup_user_data(self, who=None):
         if who is None:
@@ -136,6 +139,7 @@ class Service:
         self.on_setup = None
         self.on_shutdown = None
         self.providers = {}
+        self.metrics = collections.OrderedDict()
         self.logger = logging.getLogger(self.name)
 
     def hook(self, hook, priority=0):
@@ -162,36 +166,40 @@ class Service:
             pattern += "$"
         pat = re.compile(pattern, re_flags)
 
+        # the dispatcher can only rule out messages by prefix if we know what
+        # the message will look like when we match against it
+        prefix = literal_prefix(pattern, re_flags) if strip else ""
+
         def _decorator(f):
             if not hasattr(f, "patterns"):
                 f.patterns = set([])
 
             f.patterns.add((pattern, mention))
 
-            @functools.wraps(f)
-            @coroutine
-            def _command_handler(ctx, target, origin, message):
+            def _guard(client, target, origin):
                 contexts = getattr(f, "contexts", set([]))
                 if contexts:
                     # check for contexts
-                    bound = self.binding_for(ctx.bot)
+                    bound = self.binding_for(client.bot)
 
                     my_contexts = \
-                        bound.contexts.get(ctx.client.name, {}) \
+                        bound.contexts.get(client.name, {}) \
                             .get(target, set([])) | \
-                        bound.contexts.get(ctx.client.name, {}) \
+                        bound.contexts.get(client.name, {}) \
                             .get(None, set([]))
 
                     if not my_contexts & contexts:
-                        return
+                        return False
 
                 # check for permissions
                 permissions = getattr(f, "permissions", set([]))
 
-                if not all(has_permission(ctx.client, ctx.client.users[origin], permission, target)
-                           for permission in permissions):
-                    return
+                return all(has_permission(client, client.users[origin], permission, target)
+                           for permission in permissions)
 
+            @functools.wraps(f)
+            @coroutine
+            def _command_handler(ctx, target, origin, message):
                 if strip:
                     message = message.strip()
 
@@ -227,14 +235,21 @@ class Service:
                 if eat:
                     return Service.EAT
 
+            # contexts and permissions are checked by the hook runner before
+            # it builds a context for the handler
+            _command_handler.command = (prefix, mention)
+            _command_handler.guard = _guard
             self.hook("channel_message", priority=priority)(_command_handler)
 
             if allow_private:
+                def _private_command_handler(ctx, origin, message):
+                    return _command_handler(ctx, origin, origin, message)
+
+                _private_command_handler.command = (prefix, mention)
+                _private_command_handler.guard = \
+                    lambda client, target, origin: _guard(client, origin, origin)
                 self.hook("private_message", priority=priority)(
-                    lambda client, origin, message: _command_handler(client,
-                                                                     origin,
-                                                                     origin,
-                                                                     message))
+                    _private_command_handler)
 
             self.commands.add(f)
             return f
@@ -281,6 +296,39 @@ class Service:
             return f
         return _decorator
 
+    def _metric(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, doc, labels=()):
+        """
+        Register a counter, exposed while the service is loaded.
+        """
+        return self._metric(metrics.Counter(name, doc, labels))
+
+    def gauge(self, name, doc, labels=()):
+        """
+        Register a gauge, exposed while the service is loaded.
+        """
+        return self._metric(metrics.Gauge(name, doc, labels))
+
+    def histogram(self, name, doc, labels=(), buckets=metrics.DEFAULT_BUCKETS):
+        """
+        Register a histogram, exposed while the service is loaded.
+        """
+        return self._metric(metrics.Histogram(name, doc, labels, buckets))
+
+    def collects(self, name, doc, type="gauge"):
+        """
+        Register a function that gives the samples of a metric when it's
+        scraped.
+        """
+        def _decorator(f):
+            self._metric(metrics.Collector(
+                name, doc, type, lambda bot: f(HookContext(self, bot))))
+            return f
+        return _decorator
+
     def _autocreate_models(self):
         for model in self.models:
             model.create_table(True)
@@ -291,6 +339,9 @@ class Service:
         """
         self._autocreate_models()
 
+        # pick up any jobs left over from before the service was last unloaded
+        bot.scheduler.restore_service(self)
+
         ctx = HookContext(self, bot)
 
         if self.on_setup is not None:
@@ -4,11 +4,10 @@ Hipchat support.
 Translate user IDs to @mention names.
 """
 
-import requests
 import ccy
 import time
 
-from kochira import config
+from kochira import config, http
 from kochira.service import Service, background, Config
 
 service = Service(__name__, __doc__)
@@ -26,8 +25,8 @@ def initialize_storage(ctx):
 
 
 def _update_users(auth_token, storage):
-    req = requests.get("https://api.hipchat.com/v1/users/list",
-                       params={"auth_token": auth_token})
+    req = http.get("https://api.hipchat.com/v1/users/list",
+                   params={"auth_token": auth_token})
     req.raise_for_status()
 
     users = {}
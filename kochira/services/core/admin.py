@@ -9,12 +9,26 @@ import signal
 import subprocess
 import sys
 
+from tornado.web import RequestHandler, Application
+
+from kochira import config
 from kochira.auth import requires_permission
-from kochira.service import Service
+from kochira.service import Service, Config
 
 service = Service(__name__, __doc__)
 
 
+@service.config
+class Config(Config):
+    stats_page = config.Field(doc="Show hook and event loop statistics on the web server.", default=False)
+
+
+def _ms(seconds):
+    if seconds is None:
+        return "-"
+    return "{:.1f} ms".format(seconds * 1000)
+
+
 @service.command(r"(?P<r>re)?(load|start) services? (?P<service_name>\S+)$", mention=True, priority=3000)
 @requires_permission("admin")
 def load_service(ctx, r, service_name):
@@ -84,6 +98,89 @@ def list_services(ctx):
     )
 
 
+@service.command(r"task stats(?: for (?P<service_name>\S+))?$", mention=True, priority=3000)
+@requires_permission("admin")
+def task_stats(ctx, service_name=None):
+    """
+    Task statistics.
+
+    Show how often scheduled tasks have run and how long they took, optionally
+    only for the given service.
+    """
+
+    stats = sorted((key, stats) for key, stats in ctx.bot.scheduler.stats.items()
+                   if service_name is None or key[0].endswith(service_name))
+
+    if not stats:
+        ctx.respond(ctx._("No tasks have run yet."))
+        return
+
+    for (name, task), stats in stats:
+        ctx.respond(ctx._("{service}.{task}: {runs} runs, {failures} failed, {skipped} skipped, {mean} mean, {max} max").format(
+            service=name,
+            task=task,
+            runs=stats.runs,
+            failures=stats.failures,
+            skipped=stats.skipped,
+            mean=_ms(stats.mean_time),
+            max=_ms(stats.max_time)
+        ))
+
+
+@service.command(r"!stats hooks$", priority=3000)
+@requires_permission("admin")
+def hook_stats(ctx):
+    """
+    Hook statistics.
+
+    Show the hooks that have spent the most time on the event loop.
+    """
+
+    hooks = ctx.bot.profiler.top_hooks(5)
+
+    if not hooks:
+        ctx.respond(ctx._("No hooks have run yet."))
+        return
+
+    for (name, hook), stats in hooks:
+        ctx.respond(ctx._("{service}.{hook}: {calls} calls, {errors} errors, {total} total, {p50} median, {p99} 99th percentile").format(
+            service=name,
+            hook=hook,
+            calls=stats.calls,
+            errors=stats.errors,
+            total=_ms(stats.total_time),
+            p50=_ms(stats.times.percentile(50)),
+            p99=_ms(stats.times.percentile(99))
+        ))
+
+
+@service.command(r"!stats(?: loop)?$", priority=3000)
+@requires_permission("admin")
+def loop_stats(ctx):
+    """
+    Event loop statistics.
+
+    Show how far behind the event loop has been running and how much work is
+    waiting for the executor and to be sent to each network.
+    """
+
+    profiler = ctx.bot.profiler
+
+    ctx.respond(ctx._("Event loop lag: {p50} median, {p99} 99th percentile, {max} max. Executor queue: {queue} ({max_queue} max).").format(
+        p50=_ms(profiler.loop_lag.percentile(50)),
+        p99=_ms(profiler.loop_lag.percentile(99)),
+        max=_ms(profiler.max_loop_lag),
+        queue=profiler.executor_queue,
+        max_queue=profiler.max_executor_queue
+    ))
+
+    if ctx.bot.clients:
+        ctx.respond(ctx._("Send queues: {queues}").format(
+            queues=", ".join("{name}: {depth}".format(name=name, depth=len(client.outbound))
+                             for name, client in sorted(ctx.bot.clients.items()))
+        ))
+
+
 @service.command(r"reload(?: all)? services$", mention=True, priority=3000)
 @requires_permission("admin")
 def reload_services(ctx):
@@ -181,3 +278,28 @@ def restart(ctx):
                 os.spawnv(os.P_NOWAIT, sys.executable,
                           [sys.executable] + sys.argv)
                 sys.exit(0)
+
+
+class StatsHandler(RequestHandler):
+    def get(self):
+        self.render("stats/index.html",
+                    profiler=self.application.ctx.bot.profiler,
+                    ms=_ms)
+
+
+def make_application(settings):
+    return Application([
+        (r"/", StatsHandler)
+    ], **settings)
+
+
+@service.hook("services.net.webserver")
+def webserver_config(ctx):
+    if not ctx.config.stats_page:
+        return None
+
+    return {
+        "name": "stats",
+        "title": "Stats",
+        "application_factory": make_application
+    }
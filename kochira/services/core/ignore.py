@@ -5,8 +5,9 @@ This allows the bot to ignore users.
 """
 
 from kochira.db import Model
-from peewee import CharField, Expression, fn
+from peewee import CharField
 
+from kochira import saferegex
 from kochira.auth import requires_permission
 from kochira.service import Service
 
@@ -25,6 +26,86 @@ class Ignore(Model):
         )
 
 
+def _hostmask_pattern(hostmask):
+    return "(?:{})$".format(".*".join(saferegex.escape(part) for part in hostmask.split("*")))
+
+
+class IgnoreList:
+    """
+    The ignores for a client, compiled into a single pattern if it's simple
+    enough to run inline, or one for each hostmask otherwise. Hostmasks too
+    complex to match safely are left out.
+    """
+
+    MAX_CACHED_VERDICTS = 4096
+
+    def __init__(self, hostmasks=()):
+        self.hostmasks = set(hostmasks)
+        self._compile()
+
+    def _compile(self):
+        pats = []
+
+        for hostmask in sorted(self.hostmasks):
+            try:
+                pats.append(saferegex.check(_hostmask_pattern(hostmask),
+                                            saferegex.IGNORECASE))
+            except saferegex.UnsafePattern as e:
+                service.logger.warning("Not ignoring %s: %s", hostmask, e)
+
+        if len(pats) > 1:
+            combined = saferegex.compile("|".join(pat.pattern for pat in pats),
+                                         saferegex.IGNORECASE)
+
+            # one slow hostmask shouldn't take all the others with it
+            if not combined.isolated:
+                pats = [combined]
+
+        self.pats = pats
+        self._verdicts = {}
+
+    def add(self, hostmask):
+        self.hostmasks.add(hostmask)
+        self._compile()
+
+    def remove(self, hostmask):
+        self.hostmasks.discard(hostmask)
+        self._compile()
+
+    def _match(self, hostmask):
+        for pat in self.pats:
+            try:
+                if pat.match(hostmask) is not None:
+                    return True
+            except saferegex.RegexTimeout:
+                continue
+
+        return False
+
+    def is_ignored(self, hostmask):
+        if not self.pats:
+            return False
+
+        if hostmask not in self._verdicts:
+            if len(self._verdicts) >= self.MAX_CACHED_VERDICTS:
+                self._verdicts.clear()
+            self._verdicts[hostmask] = self._match(hostmask)
+
+        return self._verdicts[hostmask]
+
+
+@service.setup
+def load_ignores(ctx):
+    ctx.storage.ignores = {}
+
+    for ignore in Ignore.select():
+        ctx.storage.ignores.setdefault(ignore.network, IgnoreList()).add(ignore.hostmask)
+
+
+def _ignores_for(ctx):
+    return ctx.storage.ignores.setdefault(ctx.client.name, IgnoreList())
+
+
 @service.command(r"(?:ignore|add ignore for) (?P<hostmask>\S+)$", mention=True)
 @requires_permission("ignore")
 def add_ignore(ctx, hostmask):
@@ -41,7 +122,17 @@ def add_ignore(ctx, hostmask):
         ))
         return
 
+    try:
+        saferegex.check(_hostmask_pattern(hostmask), saferegex.IGNORECASE)
+    except saferegex.UnsafePattern as e:
+        ctx.respond(ctx._("Sorry, I can't ignore {hostmask}: {reason}.").format(
+            hostmask=hostmask,
+            reason=e
+        ))
+        return
+
     Ignore.create(hostmask=hostmask, network=ctx.client.name).save()
+    _ignores_for(ctx).add(hostmask)
 
     ctx.respond(ctx._("Okay, now ignoring everything from {hostmask}.").format(
         hostmask=hostmask
@@ -81,13 +172,21 @@ def remove_ignore(ctx, hostmask):
         ))
         return
 
+    _ignores_for(ctx).remove(hostmask)
+
     ctx.respond(ctx._("Okay, stopped ignoring everything from {hostmask}.").format(
         hostmask=hostmask
     ))
 
 
 @service.hook("channel_message", priority=2000)
-def ignore_message(ctx, target, origin, message):
-    if Ignore.select().where(Expression(ctx.client.users[origin].hostmask, "ilike", fn.replace(Ignore.hostmask, "*", "%")),
-                             Ignore.network == ctx.client.name).exists():
+@service.hook("private_message", priority=2000)
+@service.hook("channel_notice", priority=2000)
+@service.hook("private_notice", priority=2000)
+@service.hook("ctcp_action", priority=2000)
+@service.hook("invite", priority=2000)
+def ignore_message(ctx, *args):
+    user = ctx.client.users.get(ctx.origin)
+
+    if user is not None and _ignores_for(ctx).is_ignored(user.hostmask):
         return service.EAT
@@ -4,7 +4,13 @@ IRC message logger.
 Enables logging of messages to flat files.
 """
 
+import gzip
+import os
+import queue
+import shutil
 import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
 
 from kochira import config
@@ -13,33 +19,225 @@ from pathlib import Path
 
 service = Service(__name__, __doc__)
 
+# what a queued item is
+LINE = "line"
+FLUSH = "flush"
+STOP = "stop"
+
+# how long to wait for the writer to finish up when stopping it
+STOP_TIMEOUT = 5
+
 
 @service.config
 class Config(Config):
     log_dir = config.Field(doc="Path to the log directory.", default="logs")
+    flush_interval = config.Field(doc="Maximum time, in seconds, that lines are buffered before being written.", default=1)
+    flush_size = config.Field(doc="Maximum number of bytes buffered per log before being written.", default=65536)
+    max_open_files = config.Field(doc="Maximum number of log files to keep open at once.", default=256)
+    rotate_size = config.Field(doc="Rotate logs once they grow past this many bytes. Set to 0 to disable.", default=0)
+    rotate_daily = config.Field(doc="Rotate logs at the start of each day (UTC).", default=False)
+    compress_rotated = config.Field(doc="Compress rotated logs with gzip.", default=False)
+
+
+class LogWriter(threading.Thread):
+    """
+    Writes log lines from a queue on a background thread.
+
+    Lines are buffered per log and written out in batches, either when the
+    buffer grows past ``flush_size`` or after ``flush_interval`` seconds. Only
+    ``max_open_files`` handles are kept open, closing the least recently used
+    ones first.
+    """
+
+    def __init__(self, path, flush_interval, flush_size, max_open_files,
+                 rotate_size=0, rotate_daily=False, compress_rotated=False):
+        super().__init__(name="logger", daemon=True)
+
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.max_open_files = max_open_files
+        self.rotate_size = rotate_size
+        self.rotate_daily = rotate_daily
+        self.compress_rotated = compress_rotated
+
+        self.queue = queue.Queue()
+
+        self._buffers = {}
+        self._handles = OrderedDict()
+        self._last_flush = time.monotonic()
+
+    def write(self, client_name, channel, ts, line):
+        self.queue.put((LINE, (client_name, channel, ts, line)))
+
+    def flush(self):
+        """
+        Write out everything buffered so far and close all handles, without
+        waiting for it to happen. Returns an event that is set once it has.
+        """
+        done = threading.Event()
+        self.queue.put((FLUSH, done))
+        return done
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """
+        Write out everything buffered so far and stop the writer, waiting at
+        most ``timeout`` seconds for it.
+        """
+        done = threading.Event()
+        self.queue.put((STOP, done))
+
+        if not done.wait(timeout):
+            service.logger.warning("Log writer did not stop within %s seconds",
+                                   timeout)
+            return
+
+        self.join(timeout)
+
+    def run(self):
+        while True:
+            timeout = max(0, self._last_flush + self.flush_interval - time.monotonic())
+
+            try:
+                kind, arg = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                kind, arg = None, None
+
+            if kind in (FLUSH, STOP):
+                try:
+                    self._flush_all()
+                    self._close_all()
+                except Exception:
+                    service.logger.exception("Log writer failed")
+                finally:
+                    arg.set()
+
+                if kind == STOP:
+                    return
+                continue
+
+            try:
+                if kind == LINE:
+                    self._buffer(*arg)
+
+                if time.monotonic() - self._last_flush >= self.flush_interval:
+                    self._flush_all()
+            except Exception:
+                service.logger.exception("Log writer failed")
+
+    def _buffer(self, client_name, channel, ts, line):
+        k = (client_name, channel)
+        buffer = self._buffers.setdefault(k, [0, ts, []])
+
+        # don't let a day's worth of lines end up in the next day's log
+        if self.rotate_daily and buffer[2] and buffer[1].date() != ts.date():
+            self._flush(k)
+            buffer = self._buffers.setdefault(k, [0, ts, []])
+
+        buffer[0] += len(line)
+        buffer[1] = ts
+        buffer[2].append(line)
+
+        if buffer[0] >= self.flush_size:
+            self._flush(k)
+
+    def _flush_all(self):
+        self._last_flush = time.monotonic()
+
+        for k in list(self._buffers):
+            self._flush(k)
+
+    def _flush(self, k):
+        _, ts, lines = self._buffers.pop(k)
+
+        f = self._get_file_handle(k, ts)
+        f.write(b"".join(lines))
+        f.flush()
 
+        if self.rotate_size and f.tell() >= self.rotate_size:
+            self._rotate(k, ts)
 
-def _is_log_open(ctx, channel):
-    return (ctx.client.name, channel) in ctx.storage.handles
+    def _path_for(self, k):
+        client_name, channel = k
+        return self.path / client_name / (channel + ".log")
 
+    def _get_file_handle(self, k, ts):
+        if k in self._handles:
+            f, opened = self._handles[k]
 
-def _get_file_handle(ctx, channel):
-    k = (ctx.client.name, channel)
+            if self.rotate_daily and opened != ts.date():
+                self._rotate(k, ts)
+            else:
+                self._handles.move_to_end(k)
+                return f
 
-    if k not in ctx.storage.handles:
-        client_name_path = ctx.storage.path / ctx.client.name
+        path = self._path_for(k)
 
-        if not client_name_path.exists():
-            client_name_path.mkdir(parents=True)
+        if not path.parent.exists():
+            path.parent.mkdir(parents=True)
 
-        path = client_name_path / (channel + ".log")
-        f = path.open("ab")
+        if self.rotate_daily and path.exists():
+            opened = datetime.utcfromtimestamp(path.stat().st_mtime).date()
+
+            if opened != ts.date():
+                self._rotate_path(path, opened)
+
+        while len(self._handles) >= self.max_open_files:
+            _, (f, _) = self._handles.popitem(last=False)
+            f.close()
 
+        f = path.open("ab")
         service.logger.debug("Opened handle for: %s", path)
 
-        ctx.storage.handles[k] = f
+        self._handles[k] = (f, ts.date())
+        return f
+
+    def _rotate(self, k, ts):
+        f, opened = self._handles.pop(k)
+        f.close()
+
+        self._rotate_path(self._path_for(k),
+                          opened if self.rotate_daily else ts)
+
+    def _rotate_path(self, path, stamp):
+        if self.rotate_daily and not self.rotate_size:
+            suffix = stamp.strftime("%Y-%m-%d")
+        else:
+            suffix = datetime.utcnow().strftime("%Y-%m-%d-%H%M%S")
+
+        rotated = self._unused_name(path.with_name(path.name + "." + suffix))
+        path.rename(rotated)
+
+        if self.compress_rotated:
+            with rotated.open("rb") as src, \
+                gzip.open(str(rotated) + ".gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.unlink(str(rotated))
 
-    return ctx.storage.handles[k]
+        service.logger.debug("Rotated log: %s", path)
+
+    def _unused_name(self, rotated):
+        # rotating more than once in the same second (or day) mustn't
+        # overwrite the log we rotated before
+        candidate = rotated
+        n = 0
+
+        while candidate.exists() or \
+            candidate.with_name(candidate.name + ".gz").exists():
+            n += 1
+            candidate = rotated.with_name("{}.{}".format(rotated.name, n))
+
+        return candidate
+
+    def _close_all(self):
+        for f, _ in self._handles.values():
+            f.close()
+        self._handles.clear()
+        service.logger.debug("Log handles closed")
+
+
+def _is_log_open(ctx, channel):
+    return (ctx.client.name, channel) in ctx.storage.logs
 
 
 def _hostmask_for(client, nickname):
@@ -55,14 +253,11 @@ def _hostmask_for(client, nickname):
 def log(ctx, channel, what):
     now = datetime.utcnow()
 
-    f = _get_file_handle(ctx, channel)
-
-    with ctx.storage.lock:
-        f.write(("{now} {what}\n".format(
-            now=now.isoformat(),
-            what=what
-        )).encode("utf-8"))
-        f.flush()
+    ctx.storage.logs.add((ctx.client.name, channel))
+    ctx.storage.writer.write(ctx.client.name, channel, now, ("{now} {what}\n".format(
+        now=now.isoformat(),
+        what=what
+    )).encode("utf-8"))
 
 
 def log_message(ctx, target, origin, message, format):
@@ -86,29 +281,28 @@ def log_global(ctx, origin, what):
         log(ctx, origin, what)
 
 
-def close_all_handles(storage):
-    with storage.lock:
-        for f in storage.handles.values():
-            f.close()
-        storage.handles = {}
-    service.logger.debug("Log handles closed")
-
-
 @service.setup
 def setup_logger(ctx):
-    ctx.storage.handles = {}
-    ctx.storage.path = Path(ctx.config.log_dir)
-    ctx.storage.lock = threading.Lock()
+    ctx.storage.logs = set([])
+    ctx.storage.writer = LogWriter(Path(ctx.config.log_dir),
+                                   flush_interval=ctx.config.flush_interval,
+                                   flush_size=ctx.config.flush_size,
+                                   max_open_files=ctx.config.max_open_files,
+                                   rotate_size=ctx.config.rotate_size,
+                                   rotate_daily=ctx.config.rotate_daily,
+                                   compress_rotated=ctx.config.compress_rotated)
+    ctx.storage.writer.start()
 
 
 @service.shutdown
 def shutdown_logger(ctx):
-    close_all_handles(ctx.storage)
+    ctx.storage.writer.stop()
 
 
 @service.hook("sighup")
 def flush_log_handles(ctx):
-    close_all_handles(ctx.storage)
+    ctx.storage.writer.flush()
+    ctx.storage.logs = set([])
 
 
 @service.hook("own_message", priority=10000)
@@ -5,6 +5,8 @@ Players take turns describing a word or phrase on a drawn card to their partner
 without using five common additional words.
 """
 
+import random
+
 from collections import OrderedDict
 
 from kochira.auth import requires_permission
@@ -51,12 +53,16 @@ class Game:
     TURN_DURATION = 60
 
     def __init__(self):
-        q = Taboo.select().order_by(peewee.fn.Random())
+        # shuffle just the ids, rather than having the database sort every
+        # card, and fetch each card as it's drawn
+        card_ids = [card_id for card_id, in Taboo.select(Taboo.id).tuples()]
 
-        if not q.exists():
+        if not card_ids:
             raise TabooStateError(TabooStateError.NO_MORE_CARDS)
 
-        self.cards = iter(q)
+        random.shuffle(card_ids)
+
+        self.cards = self._deal(card_ids)
         self.started = False
 
         self.players = []
@@ -64,6 +70,14 @@ class Game:
 
         self._turn_index = 0
 
+    @staticmethod
+    def _deal(card_ids):
+        for card_id in card_ids:
+            try:
+                yield Taboo.get(Taboo.id == card_id)
+            except Taboo.DoesNotExist:
+                continue
+
     def draw(self):
         try:
             self.card = next(self.cards)
@@ -5,7 +5,6 @@ Kick people for using bad languages.
 """
 
 import re
-import requests
 
 from kochira import config
 from kochira.service import Service, Config
@@ -28,7 +27,7 @@ class Config(Config):
 
 @service.hook("channel_message", priority=2500)
 def check_bad_languages(ctx, target, origin, message):
-    resp = requests.get("http://ws.detectlanguage.com/0.2/detect", params={"q": message, "key": ctx.config.api_key}).json()
+    resp = ctx.http.get("http://ws.detectlanguage.com/0.2/detect", params={"q": message, "key": ctx.config.api_key}).json()
     if any(detection["language"] in ctx.config.languages for detection in resp["data"]["detections"] if detection["isReliable"]):
         ctx.client.rawmsg("KICK", ctx.target, ctx.origin, ctx.config.kick_message)
         return Service.EAT
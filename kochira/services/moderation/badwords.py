@@ -9,16 +9,14 @@ import itertools
 
 from peewee import CharField
 
-from kochira import config
+from kochira import config, saferegex
 from kochira.auth import requires_permission
 from kochira.db import Model
+from kochira.keywords import KeywordMatcher, is_regex, check_rule
 from kochira.service import Service, Config
 
 service = Service(__name__, __doc__)
 
-def is_regex(what):
-    return what[0] == "/" and what[-1] == "/"
-
 CONTROL_CODE_RE = re.compile(
     "\x1f|\x02|\x12|\x0f|\x16|\x03(?:\d{1,2}(?:,\d{1,2})?)?", re.UNICODE)
 
@@ -44,6 +42,18 @@ class Config(Config):
     kick_message = config.Field(doc="Kick message.", default="Bad word: {match}")
 
 
+@service.setup
+def load_badwords(ctx):
+    ctx.storage.badwords = {}
+
+    for badword in Badword.select().order_by(Badword.id):
+        _badwords_for(ctx, badword.client_name, badword.channel).add(badword.word, None)
+
+
+def _badwords_for(ctx, client_name, channel):
+    return ctx.storage.badwords.setdefault((client_name, channel), KeywordMatcher())
+
+
 @service.command("(?P<word>.+) is a bad word", mention=True)
 @requires_permission("badword")
 def add_badword(ctx, word):
@@ -59,7 +69,17 @@ def add_badword(ctx, word):
         ctx.respond(ctx._("That's already a bad word."))
         return
 
+    try:
+        check_rule(word)
+    except saferegex.UnsafePattern as e:
+        ctx.respond(ctx._("Sorry, I can't use that as a bad word: {reason}.").format(reason=e))
+        return
+    except saferegex.error:
+        ctx.respond(ctx._("Couldn't parse that pattern."))
+        return
+
     Badword.create(client_name=ctx.client.name, channel=ctx.target, word=word).save()
+    _badwords_for(ctx, ctx.client.name, ctx.target).add(word, None)
 
     ctx.respond(ctx._("Okay, whoever says that will be kicked."))
 
@@ -78,6 +98,8 @@ def remove_badword(ctx, word):
         ctx.respond(ctx._("That's not a bad word."))
         return
 
+    _badwords_for(ctx, ctx.client.name, ctx.target).remove(word)
+
     ctx.respond(ctx._("Okay, that's not a bad word anymore."))
 
 
@@ -106,27 +128,26 @@ def check_badwords(ctx, target, origin, message):
             ctx.client.rawmsg("KICK", ctx.target, ctx.origin,
                               ctx.config.kick_message.format(match=match))
 
-    for badword in Badword.select().where(Badword.client_name == ctx.client.name,
-                                          Badword.channel == ctx.target):
-        if is_regex(badword.word):
-            expr = badword.word[1:-1]
-        else:
-            expr = r"\b{}\b".format(re.escape(badword.word))
+    matches = _badwords_for(ctx, ctx.client.name, ctx.target).search(
+        strip_control_codes(message))
+
+    if not matches:
+        return
+
+    match = matches[0]
 
-        match = re.search(expr, strip_control_codes(message), re.I)
-        if match is not None:
-            op_modes = set(itertools.takewhile(lambda x: x != "v",
-                                               ctx.client._nickname_prefixes.values()))
+    op_modes = set(itertools.takewhile(lambda x: x != "v",
+                                       ctx.client._nickname_prefixes.values()))
 
-            ops = set([])
+    ops = set([])
 
-            for op_mode in op_modes:
-                ops.update(ctx.client.channels[target].modes.get(op_mode, []))
+    for op_mode in op_modes:
+        ops.update(ctx.client.channels[target].modes.get(op_mode, []))
 
-            if ctx.client.nickname not in ops and ctx.config.chanserv_op is not None:
-                ctx.client.message("ChanServ", ctx.config.chanserv_op.format(
-                                   target=ctx.target, me=ctx.client.nickname))
-                ctx.bot.event_loop.schedule(lambda: _callback(match.group(0)))
-            else:
-                _callback(match.group(0))
-            return Service.EAT
+    if ctx.client.nickname not in ops and ctx.config.chanserv_op is not None:
+        ctx.client.message("ChanServ", ctx.config.chanserv_op.format(
+                           target=ctx.target, me=ctx.client.nickname))
+        ctx.bot.event_loop.schedule(lambda: _callback(match.text))
+    else:
+        _callback(match.text)
+    return Service.EAT
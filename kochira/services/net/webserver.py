@@ -7,7 +7,7 @@ server.
 
 from docutils.core import publish_parts
 
-from kochira import config
+from kochira import config, metrics
 from kochira.service import Service, Config, HookContext
 
 import copy
@@ -29,6 +29,7 @@ class Config(Config):
     title = config.Field(doc="Title for the web site.", default="Kochira")
     motd = config.Field(doc="MOTD for the web site, formatted in reStructuredText.", default="(no message of the day)")
     base_url = config.Field(doc="Base URL for the web server.")
+    metrics = config.Field(doc="Serve metrics in the Prometheus text format at /metrics.", default=False)
 
 
 def _get_application_confs(bot):
@@ -87,6 +88,15 @@ class IndexHandler(RequestHandler):
                     clients=sorted(self.application._ctx.bot.clients.items()))
 
 
+class MetricsHandler(RequestHandler):
+    def get(self):
+        if not self.application._ctx.config.metrics:
+            raise HTTPError(404)
+
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.exposition(self.application._ctx.bot))
+
+
 class NotFoundHandler(RequestHandler):
     def get(self):
         self.set_status(404)
@@ -155,6 +165,7 @@ base_path = os.path.join(os.path.dirname(__file__), "webserver")
 def setup_webserver(ctx):
     ctx.storage.application = Application([
         (r"/", IndexHandler),
+        (r"/metrics", MetricsHandler),
         (r"/(\S+)/.*", MainHandler),
         (r".*", NotFoundHandler)
     ],
@@ -17,6 +17,10 @@ import kochira.timeout as timeout
 
 service = Service(__name__, __doc__)
 
+# how far back to look for our own shouts, and how many of them to explain
+WHO_SAID_THAT_LINES = 50
+WHO_SAID_THAT_LIMIT = 5
+
 @service.config
 class Config(Config):
     reply = config.Field(doc="Whether or not to generate replies.", default=True)
@@ -82,9 +86,16 @@ def who_said_that(ctx):
     Get information for who originally said the last shout.
     """
 
-    shouts = {entry.text.strip(): i
-              for i, entry in enumerate(ctx.client.backlogs[ctx.target])
-              if is_shout(entry.text) and entry.who == ctx.client.nickname}
+    shouts = {}
+
+    for entry in ctx.client.backlogs[ctx.target].latest(WHO_SAID_THAT_LINES):
+        if entry.who != ctx.client.nickname or not is_shout(entry.text):
+            continue
+
+        shouts.setdefault(entry.text.strip(), len(shouts))
+
+        if len(shouts) >= WHO_SAID_THAT_LIMIT:
+            break
 
     q = list(Shout.select() \
         .where((Shout.message << list(shouts.keys())) if shouts else False))
@@ -10,9 +10,13 @@ import random
 import re
 import operator
 import itertools
+import threading
+import array
+import bisect
+import time
 
 from datetime import datetime
-from peewee import CharField, TextField, DateTimeField, fn, SQL
+from peewee import CharField, TextField, DateTimeField, SQL, OperationalError
 from whoosh.analysis import StemmingAnalyzer
 import whoosh.fields
 import whoosh.index
@@ -26,15 +30,18 @@ from kochira.db import Model, database
 from kochira.service import Service, Config, background
 from kochira.auth import requires_permission
 
-from tornado.web import RequestHandler, Application
+from tornado.web import RequestHandler, Application, HTTPError
 
 
 service = Service(__name__, __doc__)
 
 @service.config
 class Config(Config):
-    index_path = config.Field(doc="Path to the full-text index.", default="quotes")
+    search_backend = config.Field(doc="Full-text search backend: \"whoosh\", or \"fts5\" to search with SQLite instead. Run \"migrate quotes to fts5\" before switching.", default="whoosh")
+    index_path = config.Field(doc="Path to the Whoosh full-text index.", default="quotes")
     comicstrip_server = config.Field(doc="URL to comicstrip server.")
+    commit_interval = config.Field(doc="How often, in seconds, to commit changes to the full-text index.", default=5)
+    commit_limit = config.Field(doc="Commit changes to the full-text index once this many are waiting.", default=100)
 
 
 stem_ana = StemmingAnalyzer()
@@ -63,27 +70,411 @@ class Quote(Model):
         )
 
 
+class QuoteIndex:
+    """
+    The full-text index of quotes, kept with Whoosh.
+
+    Changes are buffered and committed together every ``commit_interval``
+    seconds, or once ``commit_limit`` of them are waiting, on a background
+    thread that also merges small segments as it goes. One searcher is kept
+    and only refreshed when the index has changed, so a quote won't turn up
+    in searches until the commit after it was added.
+    """
+
+    def __init__(self, path, commit_interval, commit_limit):
+        if not whoosh.index.exists_in(path):
+            self.index = whoosh.index.create_in(path, WHOOSH_SCHEMA)
+        else:
+            self.index = whoosh.index.open_dir(path)
+
+        self.writer = whoosh.writing.BufferedWriter(self.index,
+                                                    period=commit_interval,
+                                                    limit=commit_limit)
+        self.searcher = self.index.searcher()
+        self.parser = QueryParser("quote", schema=WHOOSH_SCHEMA)
+        self._lock = threading.Lock()
+
+    def add(self, quote):
+        self.writer.add_document(id=quote.id, by=quote.by,
+                                 quote=quote.quote, channel=quote.channel,
+                                 network=quote.network, ts=quote.ts)
+
+    def delete(self, qid):
+        self.writer.delete_by_term("id", qid)
+
+    def _search(self, query, limit):
+        # searchers aren't safe to share between threads, and refresh() may
+        # close the one it replaces
+        with self._lock:
+            self.searcher = self.searcher.refresh()
+            results = self.searcher.search(self.parser.parse(query),
+                                           limit=limit)
+            return len(results), [r["id"] for r in results]
+
+    def ids(self, query):
+        _, qids = self._search(query, None)
+        return qids
+
+    def find(self, query):
+        qids = self.ids(query)
+
+        return Quote.select() \
+            .where(Quote.id << SQL("({})".format(", ".join(str(qid) for qid in qids))))
+
+    def search(self, query, limit, offset=0):
+        _, qids = self._search(query, offset + limit)
+        return [(qid, None) for qid in qids[offset:]]
+
+    def count(self, query):
+        n, _ = self._search(query, 1)
+        return n
+
+    def optimize(self):
+        # the timer thread commits through this writer too, so merge through
+        # it rather than racing it with a second one for the index lock
+        with self.writer.lock:
+            commitargs = self.writer.commitargs
+            self.writer.commitargs = dict(commitargs, optimize=True)
+
+            try:
+                self.writer.commit()
+            finally:
+                self.writer.commitargs = commitargs
+
+    def close(self):
+        self.writer.close()
+
+        with self._lock:
+            self.searcher.close()
+
+
+FTS_TABLE = "quote_fts"
+FTS_PROGRESS_TABLE = "quote_fts_progress"
+FTS_COLUMNS = ("quote", "by", "channel", "network")
+FTS_OPERATORS = {"AND", "OR", "NOT"}
+
+FTS_FIELD_EXPR = re.compile(r"^(?P<field>\w+):(?P<value>.+)$")
+FTS_ID_EXPR = re.compile(r"^\s*id:(?P<qid>\d+)\s*$")
+
+
+def _fts_string(s):
+    return '"{}"'.format(s.replace('"', '""'))
+
+
+def _fts_query(query):
+    """
+    Turn a query in the syntax the web interface uses into an FTS5 query.
+    Terms are quoted, so nothing a user types can be a syntax error. If
+    there's nothing left to search for, the query is empty.
+    """
+    terms = []
+
+    for term in query.split():
+        if term in FTS_OPERATORS:
+            if terms and terms[-1] not in FTS_OPERATORS:
+                terms.append(term)
+                continue
+
+            # FTS5 has no unary NOT, so "a AND NOT b" is "a NOT b", and a NOT
+            # that can't be an operator is searched for as a word rather than
+            # quietly turning the query inside out
+            if term == "NOT":
+                if terms and terms[-1] == "AND":
+                    terms[-1] = term
+                else:
+                    terms.append(_fts_string(term))
+
+            # other operators can't lead or follow each other
+            continue
+
+        match = FTS_FIELD_EXPR.match(term)
+
+        if match is not None and match.group("field") in FTS_COLUMNS:
+            terms.append("{}:{}".format(match.group("field"),
+                                        _fts_string(match.group("value"))))
+        else:
+            terms.append(_fts_string(term))
+
+    # or dangle at the end
+    if terms and terms[-1] in FTS_OPERATORS:
+        terms.pop()
+
+    return " ".join(terms)
+
+
+class FTSQuoteIndex:
+    """
+    The full-text index of quotes, kept in an SQLite FTS5 table.
+
+    The table indexes the quote table's own rows, and triggers keep it up to
+    date whenever a quote is added, changed or deleted, so nothing has to be
+    written to it separately. Results are ranked with BM25.
+    """
+
+    MIGRATE_CHUNK_SIZE = 1000
+
+    def __init__(self):
+        self.create()
+
+    def create(self):
+        table = Quote._meta.db_table
+        columns = ", ".join('"{}"'.format(column) for column in FTS_COLUMNS)
+        new_values = ", ".join('new."{}"'.format(column) for column in FTS_COLUMNS)
+        old_values = ", ".join('old."{}"'.format(column) for column in FTS_COLUMNS)
+
+        # while the index is being populated, only quotes it has already
+        # reached are kept up to date by the triggers
+        indexed = "(SELECT coalesce(max(upto), 9223372036854775807) FROM {progress})".format(
+            progress=FTS_PROGRESS_TABLE)
+
+        with database.transaction():
+            database.execute_sql(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+                "{columns}, content='{table}', content_rowid='id', "
+                "tokenize='porter unicode61')".format(
+                    fts=FTS_TABLE, table=table, columns=columns))
+
+            database.execute_sql(
+                "CREATE TABLE IF NOT EXISTS {progress}(upto INTEGER NOT NULL)".format(
+                    progress=FTS_PROGRESS_TABLE))
+
+            database.execute_sql(
+                "CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} "
+                "WHEN new.id <= {indexed} BEGIN "
+                "INSERT INTO {fts}(rowid, {columns}) VALUES (new.id, {new}); "
+                "END".format(fts=FTS_TABLE, table=table, columns=columns,
+                             new=new_values, indexed=indexed))
+
+            database.execute_sql(
+                "CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} "
+                "WHEN old.id <= {indexed} BEGIN "
+                "INSERT INTO {fts}({fts}, rowid, {columns}) VALUES ('delete', old.id, {old}); "
+                "END".format(fts=FTS_TABLE, table=table, columns=columns,
+                             old=old_values, indexed=indexed))
+
+            database.execute_sql(
+                "CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE ON {table} "
+                "WHEN old.id <= {indexed} BEGIN "
+                "INSERT INTO {fts}({fts}, rowid, {columns}) VALUES ('delete', old.id, {old}); "
+                "INSERT INTO {fts}(rowid, {columns}) VALUES (new.id, {new}); "
+                "END".format(fts=FTS_TABLE, table=table, columns=columns,
+                             old=old_values, new=new_values, indexed=indexed))
+
+    def _drop_triggers(self):
+        for suffix in ("ai", "ad", "au"):
+            database.execute_sql("DROP TRIGGER IF EXISTS {fts}_{suffix}".format(
+                fts=FTS_TABLE, suffix=suffix))
+
+    def add(self, quote):
+        pass
+
+    def delete(self, qid):
+        pass
+
+    def _match(self, sql, query, *params):
+        """
+        Run a statement with a ``MATCH ?`` for a user's query, finding nothing
+        if the query has nothing to search for or FTS5 won't take it.
+        """
+        fts_query = _fts_query(query)
+
+        if not fts_query:
+            return []
+
+        try:
+            return database.execute_sql(sql.format(fts=FTS_TABLE),
+                                        (fts_query,) + params).fetchall()
+        except OperationalError:
+            return []
+
+    def ids(self, query):
+        match = FTS_ID_EXPR.match(query)
+
+        if match is not None:
+            return [quote.id for quote in self.find(query)]
+
+        return [qid for qid, in self._match(
+            "SELECT rowid FROM {fts} WHERE {fts} MATCH ?", query)]
+
+    def find(self, query):
+        match = FTS_ID_EXPR.match(query)
+
+        if match is not None:
+            return Quote.select().where(Quote.id == int(match.group("qid")))
+
+        # the subquery runs whenever the results are read, so make sure it
+        # can find something first
+        if not self._match("SELECT 1 FROM {fts} WHERE {fts} MATCH ? LIMIT 1", query):
+            return Quote.select().where(SQL("0"))
+
+        return Quote.select() \
+            .where(Quote.id << SQL("(SELECT rowid FROM {fts} WHERE {fts} MATCH ?)".format(fts=FTS_TABLE),
+                                   _fts_query(query)))
+
+    def search(self, query, limit, offset=0):
+        match = FTS_ID_EXPR.match(query)
+
+        if match is not None:
+            return [(quote.id, None) for quote in self.find(query)][offset:offset + limit]
+
+        return self._match(
+            "SELECT rowid, snippet({fts}, 0, '\x02', '\x02', '...', 8) FROM {fts} "
+            "WHERE {fts} MATCH ? ORDER BY bm25({fts}) LIMIT ? OFFSET ?",
+            query, limit, offset)
+
+    def count(self, query):
+        return self.find(query).count()
+
+    def optimize(self):
+        database.execute_sql("INSERT INTO {fts}({fts}) VALUES ('optimize')".format(fts=FTS_TABLE))
+
+    def populate(self):
+        """
+        Index every existing quote, a chunk at a time. Returns how many quotes
+        were indexed.
+
+        Each chunk is its own transaction, so other writers aren't held up
+        for the whole migration. An external content table is corrupted by
+        deleting a quote that was never indexed, so how far we've got is kept
+        in a table the triggers check, and they leave quotes past it alone
+        until we reach them.
+        """
+        table = Quote._meta.db_table
+        columns = ", ".join('"{}"'.format(column) for column in FTS_COLUMNS)
+
+        self.create()
+
+        with database.transaction():
+            # triggers made before they checked the progress table
+            self._drop_triggers()
+            self.create()
+
+            database.execute_sql("DELETE FROM {progress}".format(progress=FTS_PROGRESS_TABLE))
+            database.execute_sql("INSERT INTO {progress}(upto) VALUES (0)".format(
+                progress=FTS_PROGRESS_TABLE))
+            database.execute_sql("INSERT INTO {fts}({fts}) VALUES ('delete-all')".format(fts=FTS_TABLE))
+
+        done = 0
+        after = 0
+
+        while True:
+            with database.transaction():
+                upto, = database.execute_sql(
+                    "SELECT max(id) FROM (SELECT id FROM {table} WHERE id > ? "
+                    "ORDER BY id LIMIT ?)".format(table=table),
+                    (after, self.MIGRATE_CHUNK_SIZE)).fetchone()
+
+                if upto is None:
+                    database.execute_sql("DELETE FROM {progress}".format(
+                        progress=FTS_PROGRESS_TABLE))
+                    break
+
+                cursor = database.execute_sql(
+                    "INSERT INTO {fts}(rowid, {columns}) SELECT id, {columns} "
+                    "FROM {table} WHERE id > ? AND id <= ?".format(
+                        fts=FTS_TABLE, table=table, columns=columns),
+                    (after, upto))
+
+                database.execute_sql("UPDATE {progress} SET upto = ?".format(
+                    progress=FTS_PROGRESS_TABLE), (upto,))
+
+                done += cursor.rowcount
+                after = upto
+
+        return done
+
+    def close(self):
+        pass
+
+
+class QuoteIds:
+    """
+    The id of every quote, overall and by channel, in sorted arrays.
+
+    Picking a random quote from these is constant time, where asking the
+    database to ``ORDER BY RANDOM()`` sorts the whole table. They're loaded
+    the first time they're needed and kept up to date as quotes are added and
+    deleted.
+    """
+
+    def __init__(self):
+        self.all = None
+        self.by_channel = {}
+        self._lock = threading.Lock()
+
+    def _load(self):
+        self.all = array.array("q")
+
+        for qid, network, channel in Quote.select(Quote.id, Quote.network, Quote.channel) \
+            .order_by(Quote.id).tuples().iterator():
+            self.all.append(qid)
+            self.by_channel.setdefault((network, channel), array.array("q")).append(qid)
+
+    def add(self, quote):
+        with self._lock:
+            if self.all is None:
+                return
+
+            for ids in (self.all,
+                        self.by_channel.setdefault((quote.network, quote.channel),
+                                                   array.array("q"))):
+                ids.insert(bisect.bisect_left(ids, quote.id), quote.id)
+
+    def remove(self, qid):
+        with self._lock:
+            if self.all is None:
+                return
+
+            for ids in itertools.chain([self.all], self.by_channel.values()):
+                i = bisect.bisect_left(ids, qid)
+                if i < len(ids) and ids[i] == qid:
+                    del ids[i]
+
+    def random(self, network=None, channel=None):
+        with self._lock:
+            if self.all is None:
+                self._load()
+
+            if network is None:
+                ids = self.all
+            else:
+                ids = self.by_channel.get((network, channel), ())
+
+            if not ids:
+                return None
+
+            return random.choice(ids)
+
+
 @service.setup
 def initialize_model(ctx):
-    if not whoosh.index.exists_in(ctx.config.index_path):
-        ctx.storage.index = whoosh.index.create_in(ctx.config.index_path, WHOOSH_SCHEMA)
+    if ctx.config.search_backend == "fts5":
+        ctx.storage.index = FTSQuoteIndex()
     else:
-        ctx.storage.index = whoosh.index.open_dir(ctx.config.index_path)
+        ctx.storage.index = QuoteIndex(ctx.config.index_path,
+                                       ctx.config.commit_interval,
+                                       ctx.config.commit_limit)
 
-    ctx.storage.quote_qp = QueryParser("quote", schema=WHOOSH_SCHEMA)
+    ctx.storage.quote_ids = QuoteIds()
+    ctx.storage.counts = {}
     ctx.storage.last_people_mappings = {}
 
 
+@service.shutdown
+def close_index(ctx):
+    ctx.storage.index.close()
+
+
 def _add_quote(storage, network, channel, origin, quote):
     with database.transaction():
         quote = Quote.create(by=origin, quote=quote, channel=channel,
                              network=network, ts=datetime.utcnow())
         quote.save()
 
-        with storage.index.writer() as writer:
-            writer.add_document(id=quote.id, by=quote.by,
-                                quote=quote.quote, channel=quote.channel,
-                                network=quote.network, ts=quote.ts)
+        storage.index.add(quote)
+
+    storage.quote_ids.add(quote)
+    storage.counts.clear()
 
     return quote
 
@@ -108,7 +499,10 @@ def add_quote(ctx, quote):
 def _delete_quote(storage, qid):
     with database.transaction():
         Quote.delete().where(Quote.id == qid).execute()
-        storage.index.delete_by_term("id", qid)
+        storage.index.delete(qid)
+
+    storage.quote_ids.remove(qid)
+    storage.counts.clear()
 
 
 @service.command(r"[iI](?: am|'m)(?: very| quite| extremely) butthurt about quote (?P<qid>\d+)$", mention=True)
@@ -214,6 +608,35 @@ def last_quote(ctx):
     ))
 
 
+# a quote we pick might have been deleted from under us, so give up after this
+# many tries
+RANDOM_TRIES = 3
+
+
+def _random_quote(storage, query=None, network=None, channel=None):
+    """
+    Pick a random quote, either out of those matching a query or out of all
+    of them, optionally only from one channel.
+    """
+    qids = storage.index.ids(query) if query is not None else None
+
+    for _ in range(RANDOM_TRIES):
+        if qids is not None:
+            qid = random.choice(qids) if qids else None
+        else:
+            qid = storage.quote_ids.random(network, channel)
+
+        if qid is None:
+            return None
+
+        try:
+            return Quote.get(Quote.id == qid)
+        except Quote.DoesNotExist:
+            continue
+
+    return None
+
+
 @service.command(r"(?:give me a )?random quote(?: matching (?P<query>.+))?$", mention=True)
 @service.command(r"!quote rand(?: (?P<query>.+))?$")
 def rand_quote(ctx, query=None):
@@ -224,21 +647,12 @@ def rand_quote(ctx, query=None):
     used.
     """
 
-    if query is not None:
-        q = _find_quotes(ctx.storage, query)
-    else:
-        q = Quote.select()
-
-    q = q \
-        .order_by(fn.Random()) \
-        .limit(1)
+    quote = _random_quote(ctx.storage, query)
 
-    if not q.exists():
+    if quote is None:
         ctx.respond(ctx._("Couldn't find any quotes."))
         return
 
-    quote = q[0]
-
     ctx.respond(ctx._("Quote {id}: {text}").format(
         id=quote.id,
         text=quote.quote
@@ -294,21 +708,15 @@ def roulette(ctx, query=None):
     """
 
     if query is not None:
-        q = _find_quotes(ctx.storage, query)
+        quote = _random_quote(ctx.storage, query)
     else:
-        q = Quote.select() \
-            .where(Quote.network == ctx.client.network,
-                   Quote.channel == ctx.target)
+        quote = _random_quote(ctx.storage, network=ctx.client.network,
+                              channel=ctx.target)
 
-    q = q \
-        .order_by(fn.Random()) \
-        .limit(1)
-
-    if not q.exists():
+    if quote is None:
         ctx.respond(ctx._("Couldn't find any quotes."))
         return
 
-    quote = q[0]
     text, people_mappings = prism_power(quote.quote, quote.quote)
 
     ctx.storage.last_people_mappings[ctx.client.network, ctx.target] = people_mappings
@@ -333,15 +741,11 @@ def reveal(ctx):
 
 
 def _find_quotes(storage, query):
-    q = storage.quote_qp.parse(query)
+    return storage.index.find(query).order_by(Quote.id.desc())
 
-    with storage.index.searcher() as searcher:
-        results = searcher.search(q, limit=None)
-        qids = [r["id"] for r in results]
 
-    return Quote.select() \
-        .where(Quote.id << SQL("({})".format(", ".join(str(qid) for qid in qids)))) \
-        .order_by(Quote.id.desc())
+FIND_LIMIT = 20
+SNIPPET_LIMIT = 3
 
 
 @service.command(r"find (?:a )?quote matching (?P<query>.+)$", mention=True)
@@ -352,24 +756,66 @@ def find_quote(ctx, query):
 
     Full-text search for a given quote.
     """
-    quotes = list(_find_quotes(ctx.storage, query))
+    num = ctx.storage.index.count(query)
 
-    if not quotes:
+    if not num:
         ctx.respond(ctx._("Couldn't find any quotes."))
-    elif len(quotes) == 1:
+    elif num == 1:
+        quote = _find_quotes(ctx.storage, query).get()
+
         ctx.respond(ctx._("Quote {id}: {text}").format(
-            id=quotes[0].id,
-            text=quotes[0].quote
+            id=quote.id,
+            text=quote.quote
         ))
     else:
-        qids = [quote.id for quote in quotes]
+        results = ctx.storage.index.search(query, FIND_LIMIT)
+
+        if num <= SNIPPET_LIMIT and all(snippet is not None for _, snippet in results):
+            qids = ["{qid} ({snippet})".format(qid=qid, snippet=snippet)
+                    for qid, snippet in results]
+        else:
+            qids = [str(qid) for qid, _ in results]
+
+        if num > len(results):
+            qids.append("...")
 
         ctx.respond(ctx._("Found {num} quotes: {qids}").format(
-            num=len(qids),
-            qids=", ".join(str(qid) for qid in qids)
+            num=num,
+            qids=", ".join(qids)
         ))
 
 
+@service.command(r"optimize quote index$", mention=True)
+@requires_permission("admin")
+@background
+def optimize_index(ctx):
+    """
+    Optimize quote index.
+
+    Merge the full-text index into a single segment.
+    """
+    ctx.storage.index.optimize()
+    ctx.respond(ctx._("Quote index optimized."))
+
+
+@service.command(r"migrate quotes to fts5$", mention=True)
+@requires_permission("admin")
+@background
+def migrate_to_fts(ctx):
+    """
+    Migrate quotes to FTS5.
+
+    Index every quote in an SQLite FTS5 table, so the ``fts5`` search backend
+    can be used. It is kept up to date from then on, whichever backend is in
+    use.
+    """
+    num = FTSQuoteIndex().populate()
+
+    ctx.respond(ctx._("Indexed {num} quotes. Set search_backend to \"fts5\" to use them.").format(
+        num=num
+    ))
+
+
 DIALOG_EXPR = re.compile(
     r"(?:<[ !~&@%+]?(?P<who>[A-Za-z0-9{}\[\]|^`\\_-]+)>) (?P<text>.*)")
 
@@ -386,22 +832,15 @@ def comic_quote(ctx, query=None):
         ctx.respond(ctx._("I don't have comic support."))
         return
 
-    if query is not None:
-        q = _find_quotes(ctx.storage, query)
-    else:
-        q = Quote.select()
-
-    q = q \
-        .order_by(fn.Random()) \
-        .limit(1)
+    quote = _random_quote(ctx.storage, query)
 
-    if not q.exists():
+    if quote is None:
         ctx.respond(ctx._("Couldn't find any quotes."))
         return
 
     ctx.respond(ctx._("Comic: {comicstrip_server}/{id}").format(
         comicstrip_server=ctx.config.comicstrip_server,
-        id=q[0].id))
+        id=quote.id))
 
 
 def guess_newlines(text):
@@ -412,35 +851,84 @@ def guess_newlines(text):
     return text.split("\n")
 
 
+COUNT_TTL = 60
+MAX_CACHED_COUNTS = 256
+
+
+def _count_quotes(storage, query):
+    """
+    Count the quotes matching a query, remembering the answer for a little
+    while since every page of results needs it.
+    """
+    now = time.time()
+    cached = storage.counts.get(query)
+
+    if cached is not None and cached[0] > now:
+        return cached[1]
+
+    if query:
+        count = storage.index.count(query)
+    else:
+        count = Quote.select().count()
+
+    if len(storage.counts) >= MAX_CACHED_COUNTS:
+        storage.counts.clear()
+
+    storage.counts[query] = (now + COUNT_TTL, count)
+    return count
+
+
 class IndexHandler(RequestHandler):
+    def _get_id_argument(self, name):
+        try:
+            return int(self.get_argument(name))
+        except (HTTPError, ValueError):
+            return None
+
     def get(self):
         try:
             limit = int(self.get_argument("limit", 20))
         except ValueError:
             limit = 20
 
-        try:
-            offset = int(self.get_argument("offset", 0))
-        except ValueError:
-            offset = 0
+        # pages are given by the quote ids either side of them, so each page
+        # is an index lookup however deep it is
+        before = self._get_id_argument("before")
+        after = self._get_id_argument("after")
 
         query = self.get_argument("q", "")
+        storage = self.application.ctx.storage
 
         if query:
-            q = _find_quotes(self.application.ctx.storage, query)
+            q = _find_quotes(storage, query)
         else:
             q = Quote.select()
 
-        q = q.order_by(Quote.id.desc())
+        if after is not None:
+            quotes = list(q.where(Quote.id > after)
+                           .order_by(Quote.id.asc())
+                           .limit(limit + 1))
+            has_newer = len(quotes) > limit
+            quotes = quotes[:limit][::-1]
+            has_older = True
+        else:
+            if before is not None:
+                q = q.where(Quote.id < before)
+
+            quotes = list(q.order_by(Quote.id.desc()).limit(limit + 1))
+            has_older = len(quotes) > limit
+            quotes = quotes[:limit]
+            has_newer = before is not None
 
         is_prism_power = self.get_argument("prism_power", "") == "activate"
 
         self.render("quotes/index.html",
                     query=query,
-                    quotes=q.limit(limit).offset(offset),
-                    count=q.count(),
+                    quotes=quotes,
+                    count=_count_quotes(storage, query),
                     limit=limit,
-                    offset=offset,
+                    has_newer=has_newer and bool(quotes),
+                    has_older=has_older and bool(quotes),
                     get_quote_text=(lambda quote: prism_power("\n".join(guess_newlines(quote.quote)), quote.quote)[0].split("\n"))
                                    if is_prism_power else
                                    (lambda quote: guess_newlines(quote.quote)),
@@ -21,6 +21,11 @@ service = Service(__name__, __doc__)
 
 cal = parsedatetime.Calendar()
 
+# how long to wait for the channel to be joined before a missed reminder is
+# kept for when they're next seen instead
+JOIN_RETRY_DELAY = 15
+JOIN_RETRIES = 8
+
 
 def parse_time(s):
     result, what = cal.parse(s)
@@ -49,38 +54,48 @@ class Reminder(Model):
 
 @service.setup
 def reschedule_reminders(ctx):
+    # timed reminders are durable jobs now, so they come back on their own;
+    # this only picks up ones saved before that was the case
+    if ctx.bot.scheduler.pending_jobs(service):
+        return
+
     for reminder in Reminder.select() \
         .where(~(Reminder.duration >> None)):
-        dt = (reminder.ts + timedelta(seconds=reminder.duration)) - datetime.utcnow()
+        ts = reminder.ts + timedelta(seconds=reminder.duration)
+        ctx.bot.scheduler.schedule_at(ts, play_timed_reminder, reminder.id,
+                                      _durable=True)
 
-        if dt < timedelta(0):
-            reminder.delete_instance()
-            continue
 
-        ctx.bot.scheduler.schedule_after(dt, play_timed_reminder, reminder)
+@service.task
+def play_timed_reminder(ctx, reminder_id, attempts=0):
+    try:
+        reminder = Reminder.get(Reminder.id == reminder_id)
+    except Reminder.DoesNotExist:
+        return
 
+    client = ctx.bot.clients.get(reminder.client_name)
 
-@service.task
-def play_timed_reminder(ctx, reminder):
-    needs_archive = False
-
-    if reminder.client_name in ctx.bot.clients:
-        client = ctx.bot.clients[reminder.client_name]
-
-        if reminder.channel in client.channels:
-            if reminder.who in client.channels[reminder.channel]["users"]:
-                client.message(reminder.channel, ctx._("{who}: {origin} wanted you to know: {message}").format(
-                    who=reminder.who,
-                    origin=reminder.origin,
-                    message=reminder.message
-                ))
-            else:
-                needs_archive = True
-                reminder.duration = None
-                reminder.save()
-
-    if not needs_archive:
+    # a reminder missed while we were down can come due before we've joined
+    # the channel it's for
+    if (client is None or reminder.channel not in client.channels) and \
+        attempts < JOIN_RETRIES:
+        ctx.bot.scheduler.schedule_after(JOIN_RETRY_DELAY, play_timed_reminder,
+                                         reminder_id, attempts=attempts + 1,
+                                         _durable=True)
+        return
+
+    if client is not None and reminder.channel in client.channels and \
+        reminder.who in client.channels[reminder.channel]["users"]:
+        client.message(reminder.channel, ctx._("{who}: {origin} wanted you to know: {message}").format(
+            who=reminder.who,
+            origin=reminder.origin,
+            message=reminder.message
+        ))
         reminder.delete_instance()
+    else:
+        # they're not around, so keep it for when they're next seen
+        reminder.duration = None
+        reminder.save()
 
 def natural_join(ctx, xs):
     if len(xs) == 0:
@@ -138,14 +153,15 @@ def add_timed_reminder(ctx, whos, duration, message):
                                    duration=dt.total_seconds())
         reminder.save()
 
+        # ... but also schedule it
+        ctx.bot.scheduler.schedule_after(dt, play_timed_reminder, reminder.id,
+                                         _durable=True)
+
     ctx.respond(ctx._("Okay, I'll let {whos} know in around {dt}.").format(
         whos=natural_join(ctx, whos),
         dt=humanize.naturaltime(-dt)
     ))
 
-    # ... but also schedule it
-    ctx.bot.scheduler.schedule_after(dt, play_timed_reminder, reminder)
-
 
 @service.command(r"(?:remind|tell) (?P<whos>.+?) (?:about|to|that) (?P<message>.+)$", mention=True)
 def add_reminder(ctx, whos, message):
@@ -6,17 +6,23 @@ Record when a user was last seen.
 
 import humanize
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from peewee import CharField, TextField, DateTimeField
 
-from kochira.db import Model
-from kochira.service import Service
+from kochira import config
+from kochira.db import Model, database
+from kochira.service import Service, Config
 
 from pydle.client import DEFAULT_NICKNAME
 
 service = Service(__name__, __doc__)
 
 
+@service.config
+class Config(Config):
+    flush_interval = config.Field(doc="How often, in seconds, to write last seen records to the database.", default=10)
+
+
 @service.model
 class Seen(Model):
     who = CharField(255)
@@ -177,53 +183,115 @@ class Seen(Model):
         return getattr(self, "_format_" + self.event, self._format_unknown)(ctx, show_channel)
 
 
-def update_seen(client, event, who, channel=None, message=None, target=None):
-    now = datetime.utcnow()
-    who = client.normalize(who)
+# keep each batched insert well under SQLite's limit on bound variables
+FLUSH_CHUNK_SIZE = 100
 
-    try:
-        seen = Seen.get(Seen.who == who,
-                        Seen.network == client.network)
-    except Seen.DoesNotExist:
-        seen = Seen.create(who=who, channel=channel,
-                           network=client.network,
-                           ts=now, event=event,
-                           message=message, target=target)
-    else:
-        seen.ts = now
-        seen.channel = channel
-        seen.event = event
-        seen.message = message
-        seen.target = target
 
-    seen.save()
+@service.setup
+def setup_seen(ctx):
+    ctx.storage.pending = {}
+    ctx.storage.flushing = []
+    ctx.bot.scheduler.schedule_every(timedelta(seconds=ctx.config.flush_interval),
+                                     flush_seen)
+
+
+@service.shutdown
+def shutdown_seen(ctx):
+    # go through the writer so we can't race a flush that's still running
+    database.submit_write(write_seen, ctx.storage.pending).result()
+    ctx.storage.pending = {}
+
+
+def write_seen(pending):
+    rows = list(pending.values())
+
+    with database.transaction():
+        for i in range(0, len(rows), FLUSH_CHUNK_SIZE):
+            Seen.insert_many(rows[i:i + FLUSH_CHUNK_SIZE]).upsert().execute()
+
+
+@service.task
+def flush_seen(ctx):
+    if not ctx.storage.pending:
+        return
+
+    # swap the table out on the event loop, so updates that come in while
+    # we're writing go into the next batch
+    pending = ctx.storage.pending
+    ctx.storage.pending = {}
+    ctx.storage.flushing.append(pending)
+
+    storage = ctx.storage
+
+    def _written(exc):
+        storage.flushing.remove(pending)
+
+        if exc is not None:
+            service.logger.error("Could not write last seen records",
+                                 exc_info=(exc.__class__, exc, exc.__traceback__))
+
+            # put the batch back for the next flush, without clobbering
+            # anything newer
+            for key, row in pending.items():
+                storage.pending.setdefault(key, row)
+
+    @database.submit_write(write_seen, pending).add_done_callback
+    def _callback(future):
+        ctx.bot.event_loop.schedule(lambda: _written(future.exception()))
+
+
+def update_seen(ctx, event, who, channel=None, message=None, target=None):
+    who = ctx.client.normalize(who)
+
+    ctx.storage.pending[who, ctx.client.network] = {
+        "who": who,
+        "channel": channel,
+        "network": ctx.client.network,
+        "ts": datetime.utcnow(),
+        "event": event,
+        "message": message,
+        "target": target
+    }
+
+
+def get_seen(ctx, who):
+    key = (who, ctx.client.network)
+
+    # look at what hasn't made it to the database yet first, newest first
+    for batch in [ctx.storage.pending] + ctx.storage.flushing[::-1]:
+        pending = batch.get(key)
+
+        if pending is not None:
+            return Seen(**pending)
+
+    return Seen.get(Seen.who == who, Seen.network == ctx.client.network)
 
 
 @service.hook("join", priority=5000)
 def on_join(ctx, target, origin):
-    update_seen(ctx.client, "join", origin, target)
+    update_seen(ctx, "join", origin, target)
 
 
 @service.hook("kill", priority=5000)
 def on_kill(ctx, target, by, message=None):
-    update_seen(ctx.client, "kill", target=target)
-    update_seen(ctx.client, "killed", target=by)
+    update_seen(ctx, "kill", target=target)
+    update_seen(ctx, "killed", target=by)
 
 
 @service.hook("kick", priority=5000)
 def on_kick(ctx, channel, target, by, message=None):
-    update_seen(ctx.client, "kick", by, channel, message, target=target)
-    update_seen(ctx.client, "kicked", target, channel, message, target=by)
+    update_seen(ctx, "kick", by, channel, message, target=target)
+    update_seen(ctx, "kicked", target, channel, message, target=by)
 
 
 @service.hook("mode_change", priority=5000)
 def on_mode_change(ctx, channel, modes, by):
-    update_seen(ctx.client, "mode_change", by, channel, " ".join(modes))
+    update_seen(ctx, "mode_change", by, channel, " ".join(modes))
 
 
 @service.hook("channel_message", priority=5000)
 def on_channel_message(ctx, target, origin, message):
-    update_seen(ctx.client, "channel_message", origin, target, message)
+    update_seen(ctx, "channel_message", origin, target, message)
 
 
 @service.hook("nick_change", priority=5000)
@@ -231,33 +299,33 @@ def on_nick_change(ctx, old, new):
     if old == DEFAULT_NICKNAME:
         return
 
-    update_seen(ctx.client, "nick_change", old, None, target=new)
-    update_seen(ctx.client, "nick_changed", new, None, target=old)
+    update_seen(ctx, "nick_change", old, None, target=new)
+    update_seen(ctx, "nick_changed", new, None, target=old)
 
 
 @service.hook("channel_notice", priority=5000)
 def on_channel_notice(ctx, target, origin, message):
-    update_seen(ctx.client, "channel_notice", origin, target, message)
+    update_seen(ctx, "channel_notice", origin, target, message)
 
 
 @service.hook("part", priority=5000)
 def on_part(ctx, target, origin, message=None):
-    update_seen(ctx.client, "part", origin, target, message)
+    update_seen(ctx, "part", origin, target, message)
 
 
 @service.hook("topic_change", priority=5000)
 def on_topic_change(ctx, target, message, by):
-    update_seen(ctx.client, "topic_change", by, target, message)
+    update_seen(ctx, "topic_change", by, target, message)
 
 
 @service.hook("quit", priority=5000)
 def on_quit(ctx, origin, message=None):
-    update_seen(ctx.client, "quit", origin, None, message)
+    update_seen(ctx, "quit", origin, None, message)
 
 
 @service.hook("ctcp_action", priority=5000)
 def on_ctcp_action(ctx, origin, target, message):
-    update_seen(ctx.client, "ctcp_action", origin, target, message)
+    update_seen(ctx, "ctcp_action", origin, target, message)
 
 
 @service.command(r"!seen (?P<who>\S+)")
@@ -272,7 +340,7 @@ def seen(ctx, who):
     who_n = ctx.client.normalize(who)
 
     try:
-        seen = Seen.get(Seen.who == who_n, Seen.network == ctx.client.network)
+        seen = get_seen(ctx, who_n)
     except Seen.DoesNotExist:
         ctx.respond(ctx._("I have never seen {who}.").format(
             who=who
@@ -5,7 +5,6 @@ This service enables the bot to perform automatic corrections for given
 keywords.
 """
 
-import re2
 from peewee import CharField
 from tornado.web import RequestHandler, Application
 
@@ -13,6 +12,8 @@ from kochira.db import Model
 
 from kochira.service import Service
 from kochira.auth import requires_permission
+from kochira import saferegex
+from kochira.keywords import KeywordMatcher, is_regex, check_rule
 
 service = Service(__name__, __doc__)
 
@@ -28,8 +29,10 @@ class Correction(Model):
         )
 
 
-def is_regex(what):
-    return what[0] == "/" and what[-1] == "/"
+@service.setup
+def load_corrections(ctx):
+    ctx.storage.corrections = KeywordMatcher(((correction.what, correction.correction)
+                                              for correction in Correction.select().order_by(Correction.id)))
 
 
 @service.command(r"stop correcting (?P<what>.+)$", mention=True)
@@ -50,6 +53,7 @@ def remove_correction(ctx, what):
         return
 
     Correction.delete().where(Correction.what == what).execute()
+    ctx.storage.corrections.remove(what)
 
     ctx.respond(ctx._("Okay, I won't correct {what} anymore.").format(
         what=what if is_regex(what) else "\"" + what + "\""
@@ -76,17 +80,29 @@ def make_case_corrector(target):
 
 @service.hook("channel_message")
 def do_correction(ctx, target, origin, message):
-    corrected = message
+    corrections = ctx.storage.corrections
+    order = {key: i for i, key in enumerate(corrections.rules)}
 
-    for correction in Correction.select():
-        if is_regex(correction.what):
-            expr = correction.what[1:-1]
-        else:
-            expr = r"\b{}\b".format(re2.escape(correction.what))
-        expr = re2.compile(expr, re2.I)
-        corrected = expr.sub(
-            make_case_corrector("\x1f" + correction.correction + "\x1f"),
-            corrected)
+    corrected = message
+    matches = corrections.search(corrected)
+
+    # each correction applies to what the ones before it left, so one can
+    # pick up where another left off
+    while matches:
+        match = matches.pop(0)
+        expr = corrections.pattern_for(match.key)
+
+        try:
+            result = expr.sub(
+                make_case_corrector("\x1f" + match.value + "\x1f"),
+                corrected)
+        except saferegex.RegexTimeout:
+            continue
+
+        if result != corrected:
+            corrected = result
+            matches = [later for later in corrections.search(corrected)
+                       if order[later.key] > order[match.key]]
 
     if message != corrected:
         ctx.message(ctx._("<{origin}> {corrected}").format(
@@ -111,7 +127,17 @@ def add_correction(ctx, what, correction):
         ))
         return
 
+    try:
+        check_rule(what)
+    except saferegex.UnsafePattern as e:
+        ctx.respond(ctx._("Sorry, I can't correct that: {reason}.").format(reason=e))
+        return
+    except saferegex.error:
+        ctx.respond(ctx._("Couldn't parse that pattern."))
+        return
+
     Correction.create(what=what, correction=correction).save()
+    ctx.storage.corrections.add(what, correction)
 
     ctx.respond(ctx._("Okay, I'll correct {what}.").format(
         what=what if is_regex(what) else "\"" + what + "\""
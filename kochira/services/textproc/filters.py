@@ -70,13 +70,12 @@ def boldscript(s):
 
 def run_filter(f, ctx, text=None):
     if text is None:
-        if not ctx.client.backlogs.get(ctx.target, []):
-            return
+        backlog = ctx.client.backlogs[ctx.target]
 
-        if len(ctx.client.backlogs[ctx.target]) < 2:
+        if len(backlog) < 2:
             return
 
-        _, text = ctx.client.backlogs[ctx.target][1]
+        text = backlog[1].text
 
     text = f(text)
 
@@ -21,7 +21,7 @@ class BufferedClient(Client):
         self.__dict__.update(client.__dict__)
         self.buffer = []
 
-    def message(self, target, message):
+    def message(self, target, message, response=None):
         self.buffer.append(message)
 
 
@@ -6,7 +6,6 @@ users.
 """
 
 import random
-import re2
 from peewee import CharField
 from tornado.web import RequestHandler, Application
 
@@ -14,6 +13,8 @@ from kochira.db import Model
 
 from kochira.service import Service
 from kochira.auth import requires_permission
+from kochira import saferegex
+from kochira.keywords import KeywordMatcher, is_regex, check_rule
 
 service = Service(__name__, __doc__)
 
@@ -29,8 +30,10 @@ class Reply(Model):
         )
 
 
-def is_regex(what):
-    return what[0] == "/" and what[-1] == "/"
+@service.setup
+def load_replies(ctx):
+    ctx.storage.replies = KeywordMatcher(((reply.what, reply.reply)
+                                          for reply in Reply.select().order_by(Reply.id)))
 
 
 @service.command(r"stop replying to (?P<what>.+)$", mention=True)
@@ -51,6 +54,7 @@ def remove_reply(ctx, what):
         return
 
     Reply.delete().where(Reply.what == what).execute()
+    ctx.storage.replies.remove(what)
 
     ctx.respond(ctx._("Okay, I won't reply to {what} anymore.").format(
         what=what if is_regex(what) else "\"" + what + "\""
@@ -59,17 +63,8 @@ def remove_reply(ctx, what):
 
 @service.hook("channel_message")
 def do_reply(ctx, target, origin, message):
-    replies = []
-
-    for reply in Reply.select():
-        if is_regex(reply.what):
-            expr = reply.what[1:-1]
-        else:
-            expr = r"\b{}\b".format(re2.escape(reply.what))
-        match = re2.search(expr, message, re2.I)
-        if match is not None:
-            expr = re2.compile(expr, re2.I)
-            replies.append(expr.sub(reply.reply, match.group(0)))
+    replies = [ctx.storage.replies.pattern_for(match.key).sub(match.value, match.text)
+               for match in ctx.storage.replies.search(message)]
 
     if not replies:
         return
@@ -93,7 +88,17 @@ def add_reply(ctx, what, reply):
         ))
         return
 
+    try:
+        check_rule(what)
+    except saferegex.UnsafePattern as e:
+        ctx.respond(ctx._("Sorry, I can't reply to that: {reason}.").format(reason=e))
+        return
+    except saferegex.error:
+        ctx.respond(ctx._("Couldn't parse that pattern."))
+        return
+
     Reply.create(what=what, reply=reply).save()
+    ctx.storage.replies.add(what, reply)
 
     ctx.respond(ctx._("Okay, I'll reply to {what}.").format(
         what=what if is_regex(what) else "\"" + what + "\""
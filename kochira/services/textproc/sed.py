@@ -4,9 +4,8 @@ Sed-style find and replacement.
 Finds patterns in text and replaces it with other terms.
 """
 
-import re
-
-from kochira.service import Service
+from kochira import saferegex
+from kochira.service import Service, background
 
 service = Service(__name__, __doc__)
 
@@ -24,29 +23,44 @@ def sed(ctx, pattern, replacement, who=None, flags=None):
     if flags is None:
         flags = ""
 
-    re_flags = re.UNICODE
+    re_flags = saferegex.UNICODE
 
     if "i" in flags:
-        re_flags |= re.IGNORECASE
+        re_flags |= saferegex.IGNORECASE
     if "s" in flags:
-        re_flags |= re.DOTALL
+        re_flags |= saferegex.DOTALL
 
     try:
-        expr = re.compile(pattern, re_flags)
+        expr = saferegex.check(pattern, re_flags)
+    except saferegex.UnsafePattern as e:
+        ctx.respond(ctx._("Sorry, I can't use that pattern: {reason}.").format(reason=e))
+        return
     except:
         ctx.respond(ctx._("Couldn't parse that pattern."))
         return
 
-    for entry in list(ctx.client.backlogs.get(ctx.target, []))[1:]:
-        if who is None or entry.who == who:
-            match = expr.search(entry.text)
+    # the newest line is this command for now, but someone may have spoken
+    # by the time we get to run in the background
+    entries = list(ctx.client.backlogs[ctx.target].find(who=who, skip=1))
+
+    return _substitute(ctx, expr, replacement, flags, entries)
+
+
+@background
+def _substitute(ctx, expr, replacement, flags, entries):
+    try:
+        i = expr.first(entry.text for entry in entries)
 
-            if match is not None:
-                try:
-                    msg = expr.sub("\x1f" + replacement + "\x1f", entry.text, count=0 if "g" in flags else 1)
-                except:
-                    ctx.respond(ctx._("Couldn't parse that pattern."))
-                    return
+        if i is None:
+            return
+
+        entry = entries[i]
+        msg = expr.sub("\x1f" + replacement + "\x1f", entry.text, count=0 if "g" in flags else 1)
+    except saferegex.RegexTimeout:
+        ctx.respond(ctx._("Sorry, that pattern took too long."))
+        return
+    except:
+        ctx.respond(ctx._("Couldn't parse that pattern."))
+        return
 
-                ctx.message("<{who}> {message}".format(who=entry.who, message=msg))
-                break
+    ctx.message("<{who}> {message}".format(who=entry.who, message=msg))
@@ -9,7 +9,6 @@ import datetime
 import json
 import operator
 import re
-import requests
 
 from kochira import config
 from kochira.service import Service, Config, background
@@ -22,6 +21,7 @@ class Config(Config):
     comic_server = config.Field(doc="Comic server to connect to.")
     clump_interval = config.Field(doc="Time to use for dialog clumping, in seconds.", type=float, default=10 * 60)
     imgur_clientid = config.Field(doc="Client ID for use with Imgur.")
+    max_lines = config.Field(doc="Most lines of backlog to draw a comic from.", type=int, default=100)
 
 
 CONTROL_CODE_RE = re.compile(
@@ -156,10 +156,10 @@ def make_comic_spec(title, lines, clump_interval, nicks):
 
 @service.provides("make_comic")
 def make_comic(ctx, spec):
-    resp = requests.post(ctx.config.comic_server, stream=True, data=json.dumps(spec))
+    resp = ctx.http.post(ctx.config.comic_server, stream=True, data=json.dumps(spec))
     resp.raise_for_status()
 
-    ulim = requests.post("https://api.imgur.com/3/upload.json",
+    ulim = ctx.http.post("https://api.imgur.com/3/upload.json",
                          headers={"Authorization": "Client-ID " + ctx.config.imgur_clientid},
                          data={"image": resp.raw.read()})
     ulim.raise_for_status()
@@ -176,7 +176,7 @@ def comic(ctx):
     Generate a comic.
     """
     comic_spec = make_comic_spec(ctx._("{channel}: the comic").format(channel=ctx.target),
-                                 list(ctx.client.backlogs[ctx.target])[1:],
+                                 ctx.client.backlogs[ctx.target].latest(ctx.config.max_lines, skip=1),
                                  ctx.config.clump_interval, ctx.client.channels[ctx.target].users)
     try:
         comic = make_comic(ctx, comic_spec)
@@ -5,7 +5,6 @@ Retrieves FMLs from FMyLife.
 """
 
 import io
-import requests
 import lxml.etree
 
 from urllib.parse import quote_plus
@@ -31,7 +30,7 @@ def fml(ctx):
     Get a random FML entry.
     """
 
-    r = requests.get("http://api.betacie.com/view/random/nocomment", params={
+    r = ctx.http.get("http://api.betacie.com/view/random/nocomment", params={
         "language": ctx.config.language,
         "key": ctx.config.api_key
     })
@@ -4,7 +4,6 @@ Google web search.
 Run queries on Google and return results.
 """
 
-import requests
 
 from kochira import config
 from kochira.service import Service, background, Config, coroutine
@@ -44,7 +43,7 @@ def search(ctx, term, num: int=None):
     if not timeout.handle(ctx):
         return
 
-    r = requests.get(
+    r = ctx.http.get(
         "https://www.googleapis.com/customsearch/v1",
         params={
             "key": ctx.config.api_key,
@@ -5,11 +5,10 @@ Look up and reverse look up addresses.
 """
 
 import re
-import requests
 import urllib.parse
 from geopy.distance import vincenty, great_circle
 
-from kochira import config
+from kochira import config, http
 from kochira.service import Service, background, Config, coroutine
 from kochira.userdata import UserData
 
@@ -29,7 +28,7 @@ class GeocodingError(Exception):
 
 
 def _geocode(where):
-    resp = requests.get(
+    resp = http.get(
         "https://maps.googleapis.com/maps/api/geocode/json",
         params={
             "address": where,
@@ -162,7 +161,7 @@ def nearby_search(ctx, what, where=None, radius : int=None, num : int=None):
 
     location = results[0]["geometry"]["location"]
 
-    resp = requests.get(
+    resp = ctx.http.get(
         "https://maps.googleapis.com/maps/api/place/nearbysearch/json",
         params={
             "key": ctx.config.api_key,
@@ -255,7 +254,7 @@ def distance(ctx, path, start_loc=None):
             crow_flies += great_circle((a_coords["lat"], a_coords["lng"]),
                                        (b_coords["lat"], b_coords["lng"])).km
 
-    routes = requests.get(
+    routes = ctx.http.get(
         "https://maps.googleapis.com/maps/api/directions/json",
         params={
             "key": ctx.config.api_key,
@@ -4,7 +4,6 @@ Google image search.
 Find image results.
 """
 
-import requests
 
 from kochira import config
 from kochira.service import Service, background, Config, coroutine
@@ -29,7 +28,7 @@ def image(ctx, term, num: int=None):
     that result.
     """
 
-    r = requests.get(
+    r = ctx.http.get(
         "https://ajax.googleapis.com/ajax/services/search/images",
         params={
             "safe": "on" if ctx.config.safesearch else "off",
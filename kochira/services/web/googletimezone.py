@@ -4,7 +4,6 @@ Google time zone.
 Get time zone information for places.
 """
 
-import requests
 import time
 from datetime import datetime
 
@@ -51,7 +50,7 @@ def timezone(ctx, where=None):
 
     now = time.time()
 
-    resp = requests.get(
+    resp = ctx.http.get(
         "https://maps.googleapis.com/maps/api/timezone/json",
         params={
             "sensor": "false",
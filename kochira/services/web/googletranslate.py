@@ -4,9 +4,9 @@ Translation between languages.
 Use Google Translate to perform translations between languages.
 """
 
-import requests
 import pycountry
 
+from kochira import http
 from kochira.service import Service, background
 
 service = Service(__name__, __doc__)
@@ -22,7 +22,7 @@ for language in pycountry.languages.objects:
 
 
 def perform_translation(term, sl, tl):
-    return requests.get(
+    return http.get(
         "http://translate.google.com/translate_a/single",
         params={
             "client": "t",
@@ -5,14 +5,13 @@ Allow users to display their now playing status and compare music tastes using
 Last.fm.
 """
 
-import requests
 import gzip
 import humanize
 from datetime import datetime
 from lxml import etree
 import io
 
-from kochira import config
+from kochira import config, http
 from kochira.userdata import UserData
 from kochira.service import Service, background, Config, coroutine
 
@@ -30,7 +29,7 @@ def query_lastfm(api_key, method, arguments):
         "api_key": api_key
     })
 
-    r = requests.get(
+    r = http.get(
         "http://ws.audioscrobbler.com/2.0/",
         params=params
     )
@@ -153,7 +152,7 @@ def make_spotify_query(params):
 
 
 def spotify_search(**params):
-    return requests.get("https://api.spotify.com/v1/search", params={
+    return http.get("https://api.spotify.com/v1/search", params={
         "q": make_spotify_query(params),
         "type": "track"
     }).json()["tracks"]["items"]
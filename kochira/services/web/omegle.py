@@ -11,10 +11,10 @@ from pydle.async import Future, coroutine, parallel
 
 from urllib.parse import urlencode
 
-from kochira import config
+from kochira import config, http
 from kochira.service import Service, Config, coroutine
 
-from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPError
+from tornado.httpclient import HTTPRequest, HTTPError
 
 service = Service(__name__, __doc__)
 
@@ -42,7 +42,6 @@ class OmegleError(Exception):
 class Connection:
     def __init__(self, host):
         self.host = host
-        self.http_client = AsyncHTTPClient()
         self.id = None
 
     @coroutine
@@ -64,7 +63,7 @@ class Connection:
         else:
             raise ValueError("unknown method")
 
-        return (yield self.http_client.fetch(req)).body.decode("utf-8")
+        return (yield http.fetch(req)).body.decode("utf-8")
 
     def _request(self, endpoint, **params):
         if self.id is None:
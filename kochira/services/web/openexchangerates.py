@@ -4,11 +4,10 @@ Open Exchange Rates currency conversion.
 Convert between currencies using Open Exchange Rates.
 """
 
-import requests
 import ccy
 import time
 
-from kochira import config
+from kochira import config, http
 from kochira.service import Service, background, Config, coroutine
 from kochira.userdata import UserData
 
@@ -30,7 +29,7 @@ def _update_currencies(app_id, storage):
     now = time.time()
 
     if storage.names is None:
-        req = requests.get("http://openexchangerates.org/api/currencies.json")
+        req = http.get("http://openexchangerates.org/api/currencies.json")
         req.raise_for_status()
 
         storage.names = req.json()
@@ -39,7 +38,7 @@ def _update_currencies(app_id, storage):
             storage.names["XBT"] = storage.names["BTC"]
 
     if storage.last_update + 60 * 60 <= now:
-        req = requests.get(
+        req = http.get(
             "https://openexchangerates.org/api/latest.json",
             params={
                 "app_id": app_id,
@@ -11,7 +11,6 @@ import ccy
 import dateutil.parser
 import json
 import re
-import requests
 import urllib.parse
 
 service = Service(__name__, __doc__)
@@ -52,7 +51,7 @@ def flight_search(ctx, slice_specs, num_adults: int=1):
         })
 
     ctx.respond(ctx._("This might take a while..."))
-    resp = requests.post(
+    resp = ctx.http.post(
         "https://www.googleapis.com/qpxExpress/v1/trips/search",
         params={
             "key": ctx.config.api_key
@@ -6,7 +6,6 @@ An alternative brain that only cares about sentiments.
 
 import random
 import re
-import requests
 
 from kochira.service import Service, background
 
@@ -29,7 +28,7 @@ def do_reply(ctx, target, origin, message):
 
     message = message.strip()
 
-    r = requests.post("http://text-processing.com/api/sentiment/", data={"text": message}).json()
+    r = ctx.http.post("http://text-processing.com/api/sentiment/", data={"text": message}).json()
     replies = REPLIES.get(r["label"], [])
 
     if replies:
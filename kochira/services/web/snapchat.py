@@ -7,7 +7,6 @@ Allows users to send Snapchats to channels.
 import os
 import glob
 import humanize
-import requests
 import tempfile
 import subprocess
 
@@ -15,6 +14,7 @@ from datetime import datetime, timedelta
 from pysnap import Snapchat, MEDIA_VIDEO_NOAUDIO, MEDIA_VIDEO
 
 from kochira import config
+from kochira.scheduler import FIXED_DELAY
 from kochira.service import Service, Config, background, HookContext
 
 service = Service(__name__, __doc__)
@@ -67,7 +67,10 @@ def make_snapchat(ctx):
 
         ctx.storage.snapchats.append(snapchat)
 
-    ctx.bot.scheduler.schedule_every(timedelta(seconds=30), poll_for_updates)
+    # wait for each poll to finish before counting down to the next one, so a
+    # slow poll can't pile up behind itself
+    ctx.bot.scheduler.schedule_every(timedelta(seconds=30), poll_for_updates,
+                                     _mode=FIXED_DELAY)
 
 
 def check_snapchat(ctx, snapchat):
@@ -85,7 +88,7 @@ def check_snapchat(ctx, snapchat):
             blob = convert_to_gif(blob)
 
         if blob is not None:
-            ulim = requests.post("https://api.imgur.com/3/upload.json",
+            ulim = ctx.http.post("https://api.imgur.com/3/upload.json",
                                  headers={"Authorization": "Client-ID " + ctx.config.imgur_clientid},
                                  data={"image": blob}).json()
             if ulim["status"] != 200:
@@ -117,6 +120,7 @@ def check_snapchat(ctx, snapchat):
 
 
 @service.task
+@background
 def poll_for_updates(ctx):
     for snapchat in ctx.storage.snapchats:
-        ctx.bot.executor.submit(check_snapchat, ctx, snapchat)
+        check_snapchat(ctx, snapchat)
@@ -4,7 +4,6 @@ UrbanDictionary lookup.
 Retrieves definitions of terms from UrbanDictionary.
 """
 
-import requests
 
 from kochira.service import Service, background
 
@@ -20,7 +19,7 @@ def define(ctx, term, num: int=None):
     Look up the given term on UrbanDictionary.
     """
 
-    r = requests.get("http://api.urbandictionary.com/v0/define", params={
+    r = ctx.http.get("http://api.urbandictionary.com/v0/define", params={
         "term": term
     }).json()
 
@@ -4,15 +4,20 @@ URL scanner.
 Fetches and displays metadata for web pages, images and more.
 """
 
+import codecs
 import humanize
 import re
-import requests
-import tempfile
+import struct
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import timedelta
-from bs4 import BeautifulSoup
-from PIL import Image
+from html.parser import HTMLParser
+from urllib.parse import urlsplit
+from PIL import ImageFile
 
-from kochira import config
+from kochira import config, http
 from kochira.service import Service, background, Config
 
 service = Service(__name__, __doc__)
@@ -21,73 +26,398 @@ service = Service(__name__, __doc__)
 @service.config
 class Config(Config):
     max_size = config.Field(doc="Maximum request size.", default=5 * 1024 * 1024)
+    cache_ttl = config.Field(doc="How long, in seconds, to remember what a URL points to.", default=10 * 60)
+    dedup_interval = config.Field(doc="Don't describe a URL again if it was posted in the same channel this many seconds ago.", default=60)
+    max_fetches = config.Field(doc="Maximum number of URLs to fetch at once, across all channels.", default=8)
+    max_fetches_per_host = config.Field(doc="Maximum number of URLs to fetch at once from any one host.", default=2)
 
 
+DESCRIBE_SECONDS = service.histogram("kochira_url_describe_seconds",
+                                     "Time taken to describe a URL.")
+
 HEADERS = {
     'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.8; rv:23.0) Gecko/20130426 Firefox/23.0'
 }
 
-def handle_html(content):
-    soup = BeautifulSoup(content)
+CHUNK_SIZE = 2048
+
+# links to a busy host past this many are dropped rather than queued
+MAX_WAITING_PER_HOST = 8
 
-    title = None
+CHARSET_RE = re.compile(r"charset\s*=\s*[\"']?([\w.:-]+)", re.IGNORECASE)
+META_CHARSET_RE = re.compile(br"""<meta[^>]+charset\s*=\s*["']?([\w.:-]+)""", re.IGNORECASE)
 
-    if soup.title is not None:
-        title = re.sub(r"\s+", " ", soup.title.string.strip())
+# a GIF graphic control extension, which comes before every frame of an
+# animation and holds its delay in hundredths of a second
+GIF_FRAME_RE = re.compile(br"\x21\xf9\x04[\s\S]([\s\S]{2})[\s\S]\x00")
+GIF_FRAME_LENGTH = 8
 
-    if not title:
-        title = "(no title)"
 
-    return "\x02Web Page Title:\x02 {title}".format(
-        title=title
-    )
+def _decoder_for(encoding):
+    try:
+        return codecs.getincrementaldecoder(encoding)("replace")
+    except LookupError:
+        return None
+
 
+def _sniff_encoding(chunk):
+    """
+    Work out the encoding of a page that didn't say in its headers, from a
+    ``<meta charset>`` or ``http-equiv`` tag, or failing that by whether it
+    looks like UTF-8.
+    """
+    match = META_CHARSET_RE.search(chunk)
+
+    if match is not None:
+        return match.group(1).decode("ascii")
 
-def get_num_image_frames(im):
     try:
-        while True:
-             im.seek(im.tell() + 1)
-    except EOFError:
-        pass
+        # the chunk may end partway through a character
+        codecs.getincrementaldecoder("utf-8")().decode(chunk)
+    except UnicodeDecodeError:
+        return "cp1252"
+
+    return "utf-8"
+
+
+class _TitleParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.in_title = False
+        self.done = False
+        self.title = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "title" and not self.done:
+            self.in_title = True
+
+    def handle_endtag(self, tag):
+        if tag == "title" and self.in_title:
+            self.in_title = False
+            self.done = True
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title.append(data)
+
+
+class HTMLExtractor:
+    """
+    Find the title of a page, stopping as soon as it has been seen.
+    """
 
-    return im.tell()
+    needs_size = False
 
+    def __init__(self, charset):
+        # without a charset in the headers, we'll have to look at the page
+        self.decoder = _decoder_for(charset) if charset is not None else None
+        self.parser = _TitleParser()
 
-def handle_image(content):
-    with tempfile.NamedTemporaryFile() as f:
-        f.write(content)
-        im = Image.open(f.name)
+    def feed(self, chunk):
+        if self.decoder is None:
+            self.decoder = _decoder_for(_sniff_encoding(chunk)) or \
+                _decoder_for("utf-8")
 
-    nframes = get_num_image_frames(im)
+        self.parser.feed(self.decoder.decode(chunk))
+        return self.parser.done
 
-    info = "\x02Image Info:\x02 {w} x {h}; {size}".format(
-        size=humanize.naturalsize(len(content)),
-        w=im.size[0],
-        h=im.size[1]
-    )
+    def describe(self, size, complete):
+        title = re.sub(r"\s+", " ", "".join(self.parser.title).strip())
 
-    if nframes > 1:
-        info += "; animated {t}, {n} frames".format(
-            n=nframes,
-            t=timedelta(seconds=nframes * im.info["duration"] // 1000)
+        if not title:
+            title = "(no title)"
+
+        return "\x02Web Page Title:\x02 {title}".format(
+            title=title
         )
 
-    return info
 
+class ImageExtractor:
+    """
+    Find the dimensions of an image from its header. Only GIFs are read any
+    further, and then only to count their frames and add up their delays as
+    they stream past; nothing but the header is kept.
+    """
+
+    needs_size = True
+
+    def __init__(self, charset):
+        self.parser = ImageFile.Parser()
+        self.image = None
+        self.frames = 0
+        self.duration = 0
+        self._tail = b""
+
+    def _count_frames(self, chunk):
+        # a frame's extension may be split between chunks, so look again at
+        # the end of the last one, without counting what was seen there
+        data = self._tail + chunk
+
+        for match in GIF_FRAME_RE.finditer(data):
+            if match.end() > len(self._tail):
+                self.frames += 1
+                self.duration += struct.unpack("<H", match.group(1))[0] * 10
+
+        self._tail = data[-(GIF_FRAME_LENGTH - 1):]
 
-HANDLERS = {
-    "text/html": handle_html,
-    "application/xhtml+xml": handle_html,
-    "image/jpeg": handle_image,
-    "image/png": handle_image,
-    "image/gif": handle_image,
-    "image/webp": handle_image
+    def feed(self, chunk):
+        if self.image is None:
+            self.parser.feed(chunk)
+            self.image = self.parser.image
+
+        if self.image is None or self.image.format == "GIF":
+            self._count_frames(chunk)
+            return False
+
+        return True
+
+    def describe(self, size, complete):
+        im = self.image
+
+        if im is None:
+            raise ValueError("couldn't read image header")
+
+        info = "\x02Image Info:\x02 {w} x {h}".format(
+            w=im.size[0],
+            h=im.size[1]
+        )
+
+        if size is not None:
+            info += "; " + humanize.naturalsize(size)
+
+        if im.format == "GIF":
+            frames = self.frames if complete else 0
+        else:
+            # some formats list their frames up front
+            frames = getattr(im, "n_frames", 1)
+
+        if frames > 1:
+            if im.format == "GIF":
+                info += "; animated {t}, {n} frames".format(
+                    n=frames,
+                    t=timedelta(seconds=self.duration // 1000)
+                )
+            else:
+                info += "; animated, {n} frames".format(n=frames)
+        elif im.format == "GIF" and "loop" in im.info:
+            info += "; animated"
+
+        return info
+
+
+EXTRACTORS = {
+    "text/html": HTMLExtractor,
+    "application/xhtml+xml": HTMLExtractor,
+    "image/jpeg": ImageExtractor,
+    "image/png": ImageExtractor,
+    "image/gif": ImageExtractor,
+    "image/webp": ImageExtractor
 }
 
+
+def describe_url(ctx, url):
+    """
+    Stream the URL just far enough to describe it, reading no more than
+    ``max_size`` bytes.
+    """
+    resp = ctx.http.get(url, headers=HEADERS, verify=False, stream=True)
+
+    try:
+        content_type, _, params = resp.headers.get("content-type", "text/html").partition(";")
+
+        if content_type not in EXTRACTORS:
+            return "\x02Content Type:\x02 " + content_type
+
+        # requests assumes ISO-8859-1 for any text without a charset, so only
+        # go by the headers if they say explicitly
+        charset = CHARSET_RE.search(params)
+
+        extractor = EXTRACTORS[content_type](charset.group(1) if charset is not None else None)
+
+        size = resp.headers.get("content-length")
+        size = int(size) if size is not None and size.isdigit() else None
+
+        read = 0
+        done = False
+        complete = False
+
+        # the extractors only hold on to what they need, so all we have to
+        # keep track of is how much we've read. Without a Content-Length, the
+        # only way to know the size is to read to the end
+        for chunk in resp.iter_content(CHUNK_SIZE):
+            chunk = chunk[:ctx.config.max_size - read]
+            read += len(chunk)
+
+            if not done:
+                try:
+                    done = extractor.feed(chunk)
+                except Exception:
+                    done = True
+
+            if done and (size is not None or not extractor.needs_size):
+                break
+
+            if read >= ctx.config.max_size:
+                break
+        else:
+            complete = True
+
+            if size is None:
+                size = read
+
+        try:
+            return extractor.describe(size, complete)
+        except Exception:
+            return "\x02Content Type:\x02 " + content_type
+    finally:
+        resp.close()
+
+
+@service.setup
+def setup_url(ctx):
+    ctx.storage.lock = threading.Lock()
+    ctx.storage.cache = {}
+    ctx.storage.recent = {}
+    ctx.storage.hosts = {}
+
+    # fetches get their own pool, so a message full of links can't tie up
+    # the bot's executor
+    ctx.storage.fetcher = ThreadPoolExecutor(ctx.config.max_fetches)
+
+
+@service.shutdown
+def shutdown_url(ctx):
+    ctx.storage.fetcher.shutdown(wait=False)
+
+
+def _cached(ctx, url):
+    now = time.time()
+
+    with ctx.storage.lock:
+        if url in ctx.storage.cache:
+            expires, info = ctx.storage.cache[url]
+            if expires > now:
+                return info
+            del ctx.storage.cache[url]
+
+    return None
+
+
+def _fetch(ctx, url):
+    """
+    Get a future for the description of a URL.
+
+    Only ``max_fetches_per_host`` fetches from any one host are handed to the
+    fetcher pool at a time, so a burst of links to one slow host can't take
+    up every fetcher. The rest wait here, and past ``MAX_WAITING_PER_HOST``
+    they're dropped, resolving to ``None``. A host is forgotten as soon as
+    nothing is running or waiting for it.
+    """
+    fut = Future()
+    info = _cached(ctx, url)
+
+    if info is not None:
+        fut.set_result(info)
+        return fut
+
+    host = urlsplit(url).hostname or ""
+
+    with ctx.storage.lock:
+        # [running, waiting]
+        entry = ctx.storage.hosts.setdefault(host, [0, deque()])
+
+        if entry[0] >= ctx.config.max_fetches_per_host:
+            if len(entry[1]) >= MAX_WAITING_PER_HOST:
+                fut.set_result(None)
+            else:
+                entry[1].append((url, fut))
+            return fut
+
+        entry[0] += 1
+
+    _start_fetch(ctx, host, url, fut)
+    return fut
+
+
+def _start_fetch(ctx, host, url, fut):
+    def _done(inner):
+        if inner.exception() is not None:
+            fut.set_exception(inner.exception())
+        else:
+            fut.set_result(inner.result())
+
+        with ctx.storage.lock:
+            entry = ctx.storage.hosts[host]
+
+            if entry[1]:
+                next_url, next_fut = entry[1].popleft()
+            else:
+                next_url = None
+                entry[0] -= 1
+
+                if not entry[0]:
+                    del ctx.storage.hosts[host]
+
+        if next_url is not None:
+            _start_fetch(ctx, host, next_url, next_fut)
+
+    try:
+        inner = ctx.storage.fetcher.submit(_cached_info, ctx, url)
+    except RuntimeError as e:
+        # the service is being unloaded
+        inner = Future()
+        inner.set_exception(e)
+
+    inner.add_done_callback(_done)
+
+
+def _cached_info(ctx, url):
+    now = time.time()
+    info = _cached(ctx, url)
+
+    if info is not None:
+        return info
+
+    try:
+        with DESCRIBE_SECONDS.time():
+            info = describe_url(ctx, url)
+    except http.RequestException as e:
+        # don't remember errors, they might be transient
+        return "\x02Error:\x02 " + str(e)
+
+    with ctx.storage.lock:
+        # drop anything stale before the cache gets too big
+        for k, (expires, _) in list(ctx.storage.cache.items()):
+            if expires <= now:
+                del ctx.storage.cache[k]
+
+        ctx.storage.cache[url] = (now + ctx.config.cache_ttl, info)
+
+    return info
+
+
+def _recently_posted(ctx, url):
+    now = time.time()
+
+    with ctx.storage.lock:
+        recent = ctx.storage.recent.setdefault((ctx.client.name, ctx.target), {})
+
+        for k, ts in list(recent.items()):
+            if ts + ctx.config.dedup_interval <= now:
+                del recent[k]
+
+        if url in recent:
+            return True
+
+        recent[url] = now
+        return False
+
+
 @service.hook("channel_message")
 @background
 def detect_urls(ctx, origin, target, message):
     found_info = {}
+    pending = []
 
     urls = re.findall(r'http[s]?://[^\s<>"]+|www\.[^\s<>"]+', message)
 
@@ -95,33 +425,27 @@ def detect_urls(ctx, origin, target, message):
         if not (url.startswith("http:") or url.startswith("https:")):
             url = "http://" + url
 
+        url = ''.join([c for c in url if 31 < ord(c) < 127])
+
         if url not in found_info:
-            try:
-                url = ''.join([i for i in url if 31 < ord(i) < 127])
-                resp = requests.head(url, headers=HEADERS, verify=False)
-            except requests.RequestException as e:
-                info = "\x02Error:\x02 " + str(e)
-            else:
-                content_type = resp.headers.get("content-type", "text/html").split(";")[0]
-
-                if content_type in HANDLERS:
-                    resp = requests.get(url, headers=HEADERS, verify=False,
-                                        stream=True)
-                    content = b""
-
-                    for chunk in resp.iter_content(2048):
-                        content += chunk
-                        if len(content) > ctx.config.max_size:
-                            resp.close()
-                            info = "\x02Content Type:\x02 " + content_type
-                            continue
-
-                    info = HANDLERS[content_type](content)
-                else:
-                    info = "\x02Content Type:\x02 " + content_type
-            found_info[url] = info
-        else:
-            info = found_info[url]
+            if _recently_posted(ctx, url):
+                continue
+
+            found_info[url] = _fetch(ctx, url)
+
+        pending.append((i, found_info[url]))
+
+    # everything is fetched at once, but replies still go out in the order
+    # the links were posted
+    for i, fut in pending:
+        try:
+            info = fut.result()
+        except Exception:
+            service.logger.exception("Couldn't describe %s", urls[i])
+            continue
+
+        if info is None:
+            continue
 
         if len(urls) == 1:
             ctx.message(info)
@@ -5,7 +5,6 @@ Extract a Wikipedia excerpt for the given query.
 """
 
 import bs4
-import requests
 
 from kochira.service import Service, background
 
@@ -22,7 +21,7 @@ def lookup(ctx, term):
     Look up the article.
     """
 
-    r = requests.get("http://en.wikipedia.org/w/api.php", params={
+    r = ctx.http.get("http://en.wikipedia.org/w/api.php", params={
         "format": "json",
         "action": "query",
         "prop": "extracts|info",
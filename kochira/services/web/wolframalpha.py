@@ -5,7 +5,6 @@ Runs queries on Wolfram|Alpha.
 """
 
 import re
-import requests
 from lxml import etree
 
 from kochira import config
@@ -53,7 +52,7 @@ def compute(ctx, query, who=None):
     if location is not None:
         params["latlong"] = "{lat},{lng}".format(**location)
 
-    resp = requests.get("http://api.wolframalpha.com/v2/query",
+    resp = ctx.http.get("http://api.wolframalpha.com/v2/query",
         params=params,
         stream=True
     )
@@ -4,7 +4,6 @@ Wordnik lookup.
 Retrieves definitions of terms from Wordnik.
 """
 
-import requests
 
 from urllib.parse import quote_plus
 from kochira import config
@@ -28,7 +27,7 @@ def define(ctx, term, num: int=None):
     Look up the given term on Wordnik.
     """
 
-    r = requests.get("http://api.wordnik.com/v4/word.json/{word}/definitions".format(
+    r = ctx.http.get("http://api.wordnik.com/v4/word.json/{word}/definitions".format(
         word=quote_plus(term)
     ), params={
         "api_key": ctx.config.api_key
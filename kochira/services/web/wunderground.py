@@ -4,7 +4,6 @@ Weather Underground forecast.
 Get weather data from Weather Underground.
 """
 
-import requests
 
 from kochira import config
 from kochira.service import Service, background, Config, coroutine
@@ -48,7 +47,7 @@ def weather(ctx, where=None):
 
     location = results[0]["geometry"]["location"]
 
-    r = requests.get("http://api.wunderground.com/api/{api_key}/conditions/q/{lat},{lng}.json".format(
+    r = ctx.http.get("http://api.wunderground.com/api/{api_key}/conditions/q/{lat},{lng}.json".format(
         api_key=ctx.config.api_key,
         **location
     )).json()
@@ -129,7 +128,7 @@ def forecast(ctx, where=None, num: int=0):
 
     location = results[0]["geometry"]["location"]
 
-    r = requests.get("http://api.wunderground.com/api/{api_key}/forecast/q/{lat},{lng}.json".format(
+    r = ctx.http.get("http://api.wunderground.com/api/{api_key}/forecast/q/{lat},{lng}.json".format(
         api_key=ctx.config.api_key,
         **location
     )).json()
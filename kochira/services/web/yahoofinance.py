@@ -5,7 +5,6 @@ Get stock price information.
 """
 
 import csv
-import requests
 import io
 
 from kochira import config
@@ -27,7 +26,7 @@ def stock_price(ctx, symbol):
     """
 
     (sym, exchange, name, last_trade_price, last_trade_time, change, change_pct), = csv.reader(
-        io.StringIO(requests.get(
+        io.StringIO(ctx.http.get(
             "http://download.finance.yahoo.com/d/quotes.csv",
             params={"s": symbol, "f": "sxnl1t1c1p2"}).text),
         delimiter=",", quotechar="\"")
@@ -4,7 +4,6 @@ YouTube search.
 Run queries on YouTube and return results.
 """
 
-import requests
 
 from kochira import config
 from kochira.service import Service, background, Config, coroutine
@@ -29,7 +28,7 @@ def search(ctx, term, num: int=None):
     that result.
     """
 
-    r = requests.get(
+    r = ctx.http.get(
         "https://www.googleapis.com/youtube/v3/search",
         params={
             "key": ctx.config.api_key,
@@ -55,7 +54,7 @@ def search(ctx, term, num: int=None):
         ctx.respond(ctx._("Couldn't find anything matching \"{term}\".").format(term=term))
         return
 
-    r = requests.get(
+    r = ctx.http.get(
         "https://www.googleapis.com/youtube/v3/videos",
         params={
             "key": ctx.config.api_key,
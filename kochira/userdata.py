@@ -2,6 +2,8 @@ import copy
 import json
 import peewee
 import collections
+import threading
+import time
 from .db import Model, database
 
 from pydle.async import coroutine
@@ -27,7 +29,69 @@ class UserDataKVPair(Model):
         )
 
 
+class IdentityCache:
+    """
+    A cache of which account each nickname is logged in as.
+
+    Entries are dropped when the user changes nickname, quits, or leaves the
+    last channel we share with them, and the whole cache is dropped when we
+    disconnect, so nobody can take over a nickname and inherit its account.
+    Every entry also expires: those learned from account-notify or
+    extended-join after ``ACCOUNT_TTL`` seconds, and those learned from WHOIS
+    after ``WHOIS_TTL`` seconds, since we won't hear about them changing.
+    """
+
+    ACCOUNT_TTL = 3600
+    WHOIS_TTL = 300
+
+    UNKNOWN = object()
+
+    def __init__(self):
+        self._identities = {}
+
+    def get(self, nickname):
+        """
+        Get the account for a nickname, ``None`` if they're known to not be
+        logged in, or ``IdentityCache.UNKNOWN`` if we don't know.
+        """
+        account, expires = self._identities.get(nickname, (self.UNKNOWN, None))
+
+        if expires is not None and expires < time.monotonic():
+            del self._identities[nickname]
+            return self.UNKNOWN
+
+        return account
+
+    def update(self, nickname, account, from_whois=False):
+        self._identities[nickname] = (
+            account,
+            time.monotonic() + (self.WHOIS_TTL if from_whois else self.ACCOUNT_TTL)
+        )
+
+    def invalidate(self, nickname):
+        self._identities.pop(nickname, None)
+
+    def __iter__(self):
+        return iter(list(self._identities))
+
+    def clear(self):
+        self._identities.clear()
+
+
 class UserData(collections.MutableMapping):
+    MAX_CACHED = 1024
+
+    # SQLite only allows so many bound variables per statement
+    SAVE_CHUNK_SIZE = 200
+
+    # maps (network, account) to the (network, account) it is an alias of
+    _aliases = {}
+
+    # an LRU of (network, account) to their fields, as last saved
+    _records = collections.OrderedDict()
+
+    _cache_lock = threading.Lock()
+
     def __init__(self, bot, network, account):
         self.bot = bot
         self.network = network
@@ -35,37 +99,65 @@ class UserData(collections.MutableMapping):
         self.refresh()
 
     def refresh(self):
-        self._pre_fields = {kv.key: kv.value
-                            for kv in self._all_kv_pairs_query()}
+        key = (self.network, self.account)
 
-        if "_alias" in self._pre_fields:
-            self.network = self._pre_fields["_alias"]["network"]
-            self.account = self._pre_fields["_alias"]["account"]
-            self.refresh()
+        with self._cache_lock:
+            self.network, self.account = self._aliases.get(key, key)
+            fields = self._records.get((self.network, self.account))
 
-        self._fields = copy.deepcopy(self._pre_fields)
+            if fields is not None:
+                self._records.move_to_end((self.network, self.account))
+
+        if fields is None:
+            fields = {kv.key: kv.value
+                      for kv in self._all_kv_pairs_query()}
+
+            if "_alias" in fields:
+                self.network = fields["_alias"]["network"]
+                self.account = fields["_alias"]["account"]
+                self.refresh()
+
+                with self._cache_lock:
+                    self._aliases[key] = (self.network, self.account)
+                return
+
+            self._cache_fields(fields)
+
+        self._take_snapshot(fields)
+
+    def _take_snapshot(self, fields):
+        # the snapshot is shared with the cache and never modified: values are
+        # only copied out of it when they are first read, so that in-place
+        # changes to them don't leak back into it
+        self._pre_fields = fields
+        self._fields = dict(fields)
+        self._owned = set([])
+
+    def _cache_fields(self, fields):
+        with self._cache_lock:
+            self._records[self.network, self.account] = fields
+            self._records.move_to_end((self.network, self.account))
+
+            while len(self._records) > self.MAX_CACHED:
+                self._records.popitem(last=False)
 
     def _all_kv_pairs_query(self):
         return UserDataKVPair.select().where(UserDataKVPair.account == self.account,
                                              UserDataKVPair.network == self.network)
 
-    def _make_kv_pair(self, key, value):
-        kv_pair = UserDataKVPair.create(account=self.account,
-                                        network=self.network,
-                                        key=key, value=value)
-        return kv_pair
-
+    def __getitem__(self, key):
+        value = self._fields[key]
 
-    def _get_kv_pair(self, key):
-        return UserDataKVPair.get(UserDataKVPair.account == self.account,
-                                  UserDataKVPair.network == self.network,
-                                  UserDataKVPair.key == key)
+        if key not in self._owned:
+            if isinstance(value, (dict, list)):
+                value = self._fields[key] = copy.deepcopy(value)
+            self._owned.add(key)
 
-    def __getitem__(self, key):
-        return self._fields[key]
+        return value
 
     def __setitem__(self, key, value):
         self._fields[key] = value
+        self._owned.add(key)
 
     def __delitem__(self, key):
         del self._fields[key]
@@ -77,24 +169,34 @@ class UserData(collections.MutableMapping):
         return len(self._fields)
 
     def save(self):
-        added_fields = set(self._fields) - set(self._pre_fields)
-        deleted_fields = set(self._pre_fields) - set(self._fields)
-        updated_fields = set(self._pre_fields) & set(self._fields)
+        deleted_fields = list(set(self._pre_fields) - set(self._fields))
+        changed_fields = [k for k, v in self._fields.items()
+                          if k not in self._pre_fields or self._pre_fields[k] != v]
 
         with database.transaction():
-            for k in deleted_fields:
-                self._get_kv_pair(k).delete_instance()
-
-            for k in added_fields:
-                self._make_kv_pair(k, self._fields[k]).save()
-
-            for k in updated_fields:
-                if self._pre_fields[k] != self._fields[k]:
-                    kv = self._get_kv_pair(k)
-                    kv.value = self._fields[k]
-                    kv.save()
-
-        self.refresh()
+            for i in range(0, len(deleted_fields), self.SAVE_CHUNK_SIZE):
+                UserDataKVPair.delete().where(UserDataKVPair.account == self.account,
+                                              UserDataKVPair.network == self.network,
+                                              UserDataKVPair.key << deleted_fields[i:i + self.SAVE_CHUNK_SIZE]).execute()
+
+            for i in range(0, len(changed_fields), self.SAVE_CHUNK_SIZE):
+                UserDataKVPair.insert_many([{
+                    "account": self.account,
+                    "network": self.network,
+                    "key": k,
+                    "value": self._fields[k]
+                } for k in changed_fields[i:i + self.SAVE_CHUNK_SIZE]]).upsert().execute()
+
+        if "_alias" in self._fields:
+            # we've just become an alias, so forget anything we know about
+            # ourselves and let refresh follow the alias
+            with self._cache_lock:
+                self._records.pop((self.network, self.account), None)
+            self.refresh()
+        else:
+            fields = dict(self._fields)
+            self._cache_fields(fields)
+            self._take_snapshot(fields)
 
 
     class DoesNotExist(Exception): pass
@@ -103,18 +205,24 @@ class UserData(collections.MutableMapping):
     @coroutine
     def lookup(cls, client, nickname):
         if client.config.authenticated_userdata:
-            whois = yield client.whois(nickname)
+            account = client.identities.get(client.normalize(nickname))
 
-            if whois is None:
-                raise cls.DoesNotExist
+            if account is IdentityCache.UNKNOWN:
+                whois = yield client.whois(nickname)
+
+                if whois is None:
+                    raise cls.DoesNotExist
+
+                account = None
 
-            account = None
+                if whois.identified:
+                    account = nickname
 
-            if whois.identified:
-                account = nickname
+                if whois.account is not None:
+                    account = whois.account
 
-            if whois.account is not None:
-                account = whois.account
+                client.identities.update(client.normalize(nickname), account,
+                                         from_whois=True)
 
             if account is None:
                 raise cls.DoesNotExist